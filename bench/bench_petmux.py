@@ -0,0 +1,235 @@
+#!/usr/bin/python3
+"""
+Benchmarks the petmux overhead with synthetic configurations against a fake
+tmux stub that records its invocations, and against a private tmux server on
+its own socket.
+
+    bench_petmux.py [--target stub|tmux|all] [--scale N] [--output FILE]
+"""
+import sys
+import os
+import io
+import time
+import tempfile
+import argparse
+import contextlib
+import subprocess
+import yaml
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'src'))
+import petmux
+
+# PetMux options for each mode: (is_control, is_batch)
+MODE_DICT = {
+    'default': (False, False),
+    'batch': (False, True),
+    'control': (True, False),
+    'control+batch': (True, True),
+}
+
+
+def make_configs(scale):
+    """
+    Builds the synthetic configurations
+
+    :param      scale:  The number of keywords per configuration
+    :type       scale:  int
+
+    :returns:   The scenario name, keyword, keyword count, sequences and config
+    :rtype:     list(tuple(str, str, int, list(str), dict))
+    """
+    def window(panes):
+        return {
+            'NEW_WINDOW': 'bench',
+            'NEW_PANES': [ {'p{}'.format(idx): {'SHELL': ['cd .', 'true']}} for idx in range(1, panes + 1) ],
+        }
+
+    def cmds(cmd_list):
+        return {'WINDOW': 'bench', 'CMDS': cmd_list}
+
+    return [
+        ('defines', 'DEFINES', scale * 4, ['setup'], {
+            'DEFINES': { 'VAR{}'.format(idx): 'value{} ${{VAR{}}}'.format(idx, idx - 1) for idx in range(scale * 4) },
+            'setup': window(1),
+        }),
+        ('new_panes', 'NEW_PANES', scale, ['setup'], {
+            'setup': window(scale),
+        }),
+        ('shell', 'SHELL', scale * 4, ['setup', 'run'], {
+            'setup': window(1),
+            'run': cmds([{'PANE': 'p1', 'SHELL': [ 'true {}'.format(idx) for idx in range(scale * 4) ]}]),
+        }),
+        ('extract', 'EXTRACT', scale, ['setup', 'run'], {
+            'setup': window(1),
+            'run': cmds([ {'PANE': 'p1', 'EXTRACT': ['echo value={}'.format(idx), r'value=(\d+)', 'VALUE']} for idx in range(scale) ]),
+        }),
+        ('capture', 'CAPTURE', scale, ['setup', 'run'], {
+            'setup': window(1),
+            'run': cmds([ {'PANE': 'p1', 'SHELL': 'echo {}'.format(idx), 'CAPTURE': {'INCREMENTAL': True}} for idx in range(scale) ]),
+        }),
+    ]
+
+
+def bench_startup(config, repeat=5):
+    """
+    Measures the configuration load time without and with the plan cache
+
+    :param      config:  The configuration
+    :type       config:  dict
+    :param      repeat:  The number of loads to average
+    :type       repeat:  int
+
+    :returns:   The cold and warm load time [in S]
+    :rtype:     tuple(float, float)
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.environ['XDG_CACHE_HOME'] = tmp_dir
+        file_name = os.path.join(tmp_dir, 'bench.yaml')
+        with open(file_name, 'w') as file:
+            yaml.dump(config, file)
+        start = time.perf_counter()
+        for idx in range(repeat):
+            petmux.Plan.load(file_name, False)
+        cold = (time.perf_counter() - start) / repeat
+        petmux.Plan.load(file_name)
+        start = time.perf_counter()
+        for idx in range(repeat):
+            petmux.Plan.load(file_name)
+        warm = (time.perf_counter() - start) / repeat
+    return cold, warm
+
+
+@contextlib.contextmanager
+def quiet():
+    """
+    Silences the output of petmux and the tmux processes it runs
+    """
+    sys.stdout.flush()
+    fd_list = [ os.dup(fd) for fd in (1, 2) ]
+    with open(os.devnull, 'w') as devnull:
+        for fd in (1, 2):
+            os.dup2(devnull.fileno(), fd)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                yield
+        finally:
+            for fd, fd_saved in zip((1, 2), fd_list):
+                os.dup2(fd_saved, fd)
+                os.close(fd_saved)
+
+
+def bench_run(config, sequence_list, mode, socket=None):
+    """
+    Runs the sequences and measures the time
+
+    :param      config:         The configuration
+    :type       config:         dict
+    :param      sequence_list:  The sequences to run
+    :type       sequence_list:  list(str)
+    :param      mode:           The PetMux mode
+    :type       mode:           str
+    :param      socket:         The tmux server socket
+    :type       socket:         str
+
+    :returns:   The init and run time [in S]
+    :rtype:     tuple(float, float)
+    """
+    is_control, is_batch = MODE_DICT[mode]
+    with quiet():
+        start = time.perf_counter()
+        pm = petmux.PetMux(config, 'bench', is_debug=False, is_control=is_control, is_batch=is_batch, socket=socket, is_detached=True)
+        init = time.perf_counter() - start
+        try:
+            pm.kill()
+            start = time.perf_counter()
+            for sequence in sequence_list:
+                while sequence:
+                    sequence = pm.run(sequence)
+            pm.tmux.flush()
+            run = time.perf_counter() - start
+        finally:
+            pm.tmux.close()
+    return init, run
+
+
+def count_stub(log_file):
+    """
+    Counts the recorded tmux invocations and commands
+
+    :param      log_file:  The stub log file
+    :type       log_file:  str
+
+    :returns:   The number of invocations and commands
+    :rtype:     tuple(int, int)
+    """
+    if not os.path.exists(log_file):
+        return 0, 0
+    with open(log_file) as file:
+        line_list = file.read().splitlines()
+    os.remove(log_file)
+    return len(line_list), sum(line.count(' ; ') + 1 for line in line_list)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="PetMux benchmarks")
+    parser.add_argument('-t', '--target', action="store", default='all', choices=['stub', 'tmux', 'all'], help="Benchmark target")
+    parser.add_argument('-n', '--scale', action="store", type=int, default=16, help="Number of keywords per configuration")
+    parser.add_argument('-m', '--mode', action="store", default=' '.join(MODE_DICT), help='PetMux modes: --mode "{}"'.format(' '.join(MODE_DICT)))
+    parser.add_argument('-o', '--output', action="store", default=None, help="Also write the report to a file")
+    args = parser.parse_args(args)
+
+    report_list = []
+    def report(line):
+        print(line)
+        report_list.append(line)
+
+    config_list = make_configs(args.scale)
+    report("Startup (scale {})".format(args.scale))
+    report("  {:<12} {:>10} {:>10}".format('SCENARIO', 'PARSE ms', 'CACHED ms'))
+    for name, keyword, count, sequence_list, config in config_list:
+        cold, warm = bench_startup(config)
+        report("  {:<12} {:>10.2f} {:>10.2f}".format(name, cold * 1000, warm * 1000))
+
+    target_list = ['stub', 'tmux'] if args.target == 'all' else [args.target]
+    for target in target_list:
+        socket = 'petmux-bench-{}'.format(os.getpid())
+        path = os.environ['PATH']
+        log_file = os.path.join(tempfile.gettempdir(), 'petmux-bench-{}.log'.format(os.getpid()))
+        if target == 'stub':
+            os.environ['PATH'] = BENCH_DIR + os.pathsep + path
+            os.environ['PETMUX_STUB_LOG'] = log_file
+        else:
+            subprocess.run(['tmux', '-L', socket, '-f', '/dev/null', 'new-session', '-d', '-s', 'bench', '-x', '200', '-y', '50', ';',
+                            'set', '-g', 'base-index', '1', ';', 'set', '-g', 'pane-base-index', '1', ';',
+                            'set', '-g', 'default-shell', '/bin/sh'], check=True)
+        report("\nSequences against {} (scale {})".format('the tmux stub' if target == 'stub' else 'a private tmux server', args.scale))
+        report("  {:<12} {:<14} {:>8} {:>9} {:>7} {:>7} {:>10} {:>9}".format('SCENARIO', 'MODE', 'INIT ms', 'RUN ms', 'PROCS', 'CMDS', 'PROC/KEY', 'CMDS/s'))
+        try:
+            for name, keyword, count, sequence_list, config in config_list:
+                for mode in args.mode.split():
+                    if target == 'stub' and MODE_DICT[mode][0]:
+                        # The stub has no control mode
+                        continue
+                    count_stub(log_file)
+                    init, run = bench_run(config, sequence_list, mode, socket)
+                    procs, cmds = count_stub(log_file)
+                    if target == 'stub':
+                        report("  {:<12} {:<14} {:>8.2f} {:>9.2f} {:>7} {:>7} {:>10.2f} {:>9.0f}".format(
+                            name, mode, init * 1000, run * 1000, procs, cmds, procs / count, cmds / (init + run)))
+                    else:
+                        report("  {:<12} {:<14} {:>8.2f} {:>9.2f} {:>7} {:>7} {:>10} {:>9}".format(
+                            name, mode, init * 1000, run * 1000, '-', '-', '-', '-'))
+        finally:
+            os.environ['PATH'] = path
+            if target == 'tmux':
+                subprocess.run(['tmux', '-L', socket, 'kill-server'])
+            if os.path.exists(log_file):
+                os.remove(log_file)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write('\n'.join(report_list) + '\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -30,8 +30,32 @@ import tempfile
 import re
 import time
 import argparse
-import yaml
+import threading
+import queue
+import select
+import shutil
+import codecs
+import copy
+import itertools
+import shlex
+import hashlib
+import pickle
+import gzip
+import selectors
+import inspect
+import collections
+import datetime
+import contextlib
+import socket
+import signal
 import json
+import math
+import struct
+import sqlite3
+import asyncio
+import concurrent.futures
+import ctypes
+import ctypes.util
 
 # Colors for debug
 RED = "\033[1;31m"
@@ -43,275 +67,4119 @@ CYN = "\033[1;36m"
 NON = "\033[0m"
 
 
+class TmuxControl:
+    """
+    This class wraps a persistent tmux control mode (tmux -C) connection.
+    Commands are written to the client's stdin and the replies are parsed
+    from the %begin/%end/%error blocks on its stdout.
+    """
+    def __init__(self, session=None, tmux_args=['tmux'], cwd=None, env=None):
+        """
+        Attaches a control mode client to the session
+
+        :param      session:    The session name, None for the most recent session
+        :type       session:    str
+        :param      tmux_args:  The tmux command and server socket options
+        :type       tmux_args:  list(str)
+        :param      cwd:        The working directory, None for the current one
+        :type       cwd:        str
+        :param      env:        The environment, None for the current one
+        :type       env:        dict
+        """
+        args = tmux_args + ['-C', 'attach-session']
+        if session:
+            args += ['-t', session]
+        self.proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, cwd=cwd, env=env)
+        self.reply_queue = queue.Queue()
+        self.output_dict = {}
+        self.lock = threading.Lock()
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+        # The first reply belongs to the attach-session itself
+        if self._reply() is None:
+            raise OSError("tmux control mode failed to attach")
+
+    def _read(self):
+        """
+        Reader thread that splits the control mode stream into replies
+        """
+        block = None
+        for line in self.proc.stdout:
+            line = line.rstrip(b'\n')
+            if block is None:
+                if line.startswith(b'%output '):
+                    part_list = line.split(b' ', 2) + [b'']
+                    for callback in self.output_dict.get(part_list[1].decode('utf-8'), []):
+                        callback(TmuxControl.unescape(part_list[2]))
+                elif line.startswith(b'%begin '):
+                    block_num = line.split()[2]
+                    block = []
+                elif line.startswith(b'%exit'):
+                    break
+            elif (line.startswith(b'%end ') or line.startswith(b'%error ')) and line.split()[2] == block_num:
+                self.reply_queue.put((line.startswith(b'%error '), block))
+                block = None
+            else:
+                block.append(line)
+        # Wake up any waiter, the client is gone
+        self.reply_queue.put(None)
+
+    @staticmethod
+    def unescape(data):
+        """
+        Decodes the octal escapes (e.g. \\015) used by %output notifications
+
+        :param      data:  The escaped pane output
+        :type       data:  bytes
+
+        :returns:   The pane output
+        :rtype:     bytes
+        """
+        return re.sub(rb'\\([0-7]{3})', lambda m: bytes([int(m.group(1), 8)]), data)
+
+    def subscribe(self, pane_id, callback):
+        """
+        Registers a callback for the output of a pane
+
+        :param      pane_id:   The pane id (e.g. %3)
+        :type       pane_id:   str
+        :param      callback:  Called with the pane output
+        :type       callback:  function(bytes)
+        """
+        self.output_dict.setdefault(pane_id, []).append(callback)
+
+    def unsubscribe(self, pane_id, callback):
+        """
+        Removes a callback registered by subscribe()
+
+        :param      pane_id:   The pane id (e.g. %3)
+        :type       pane_id:   str
+        :param      callback:  The registered callback
+        :type       callback:  function(bytes)
+        """
+        callback_list = self.output_dict.get(pane_id, [])
+        if callback in callback_list:
+            callback_list.remove(callback)
+        if not callback_list:
+            self.output_dict.pop(pane_id, None)
+
+    def _reply(self):
+        reply = self.reply_queue.get()
+        if reply is None:
+            # Keep the sentinel for the next waiter
+            self.reply_queue.put(None)
+        return reply
+
+    def command(self, cmd):
+        """
+        Sends a command and waits for the reply
+
+        :param      cmd:  The tmux command line
+        :type       cmd:  str
+
+        :returns:   The error flag and the list of output lines or None if the
+                    connection was lost
+        :rtype:     tuple(boolean, list(bytes))
+        """
+        return self.pipeline([cmd])[-1]
+
+    def pipeline(self, cmd_list):
+        """
+        Sends a list of commands in one write, then collects the replies.  Each
+        command is its own line, so an error does not affect the others.
+
+        :param      cmd_list:  The tmux command lines
+        :type       cmd_list:  list(str)
+
+        :returns:   The reply for each command, None if the connection was lost
+        :rtype:     list(tuple(boolean, list(bytes)))
+        """
+        with self.lock:
+            try:
+                self.proc.stdin.write(b''.join(cmd.encode('utf-8') + b'\n' for cmd in cmd_list))
+                self.proc.stdin.flush()
+            except (BrokenPipeError, ValueError):
+                return [None] * len(cmd_list)
+            return [self._reply() for cmd in cmd_list]
+
+    def close(self):
+        """
+        Detaches the control mode client
+        """
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.proc.wait()
+
+
+class Template:
+    """
+    This class describes a compiled '${VAR}' template.  The text is split once
+    into literal and variable segments, then rendered in a single pass.
+    '${VAR:-default}' uses the default if VAR is unset or empty, references can
+    be nested (e.g. '${DIR_${MODE}}') and '$${' is a literal '${'.  Variables
+    that are not set are left as is for the shell to expand.
+    """
+    TOKEN = re.compile(r'\$\$\{|\$\{|\}|:-')
+    # Compiled templates by text
+    template_dict = {}
+    TEMPLATE_MAX = 4096
+
+    def __init__(self, text):
+        """
+        Compiles the template text
+
+        :param      text:  The text
+        :type       text:  str
+        """
+        self.segment_list = Template._parse(text, 0, ())[0]
+        self.is_literal = all(type(segment) is str for segment in self.segment_list)
+        self.literal = ''.join(self.segment_list) if self.is_literal else None
+        # The last render as (var_dict, dependency list, result)
+        self.cache = None
+
+    @staticmethod
+    def compile(text):
+        """
+        Gets the compiled template of the text
+
+        :param      text:  The text
+        :type       text:  str
+
+        :returns:   The template
+        :rtype:     Template
+        """
+        template = Template.template_dict.get(text)
+        if template is None:
+            if len(Template.template_dict) >= Template.TEMPLATE_MAX:
+                Template.template_dict.clear()
+            template = Template.template_dict[text] = Template(text)
+        return template
+
+    @staticmethod
+    def _parse(text, pos, stop_list):
+        """
+        Splits the text into a list of segments, each either a literal string
+        or a variable as (name segments, default segments or None, source text)
+
+        :param      text:       The text
+        :type       text:       str
+        :param      pos:        The position to start from
+        :type       pos:        int
+        :param      stop_list:  The tokens that end the segment list
+        :type       stop_list:  tuple(str)
+
+        :returns:   The segments, position after the stop token and the stop
+                    token or None if the end of text was reached
+        :rtype:     tuple(list, int, str)
+        """
+        segment_list = []
+        literal = ''
+        token = None
+        while True:
+            match = Template.TOKEN.search(text, pos)
+            if match is None:
+                literal += text[pos:]
+                pos = len(text)
+                token = None
+                break
+            literal += text[pos:match.start()]
+            token = match.group()
+            pos = match.end()
+            if token in stop_list:
+                break
+            if token == '$${':
+                literal += '${'
+            elif token == '${':
+                start = match.start()
+                name_list, pos, stop = Template._parse(text, pos, ('}', ':-'))
+                default_list = None
+                if stop == ':-':
+                    default_list, pos, stop = Template._parse(text, pos, ('}',))
+                if stop is None:
+                    # Not terminated, so it's not a variable
+                    literal += text[start:]
+                    break
+                if literal:
+                    segment_list.append(literal)
+                    literal = ''
+                segment_list.append((name_list, default_list, text[start:pos]))
+            else:
+                literal += token
+        if literal:
+            segment_list.append(literal)
+        return segment_list, pos, token if token in stop_list else None
+
+    def render(self, var_dict, version_dict=None):
+        """
+        Renders the template.  If a version dictionary is given, the result is
+        reused until a variable it depends on changes version.
+
+        :param      var_dict:      The variables
+        :type       var_dict:      dict
+        :param      version_dict:  The version of each variable
+        :type       version_dict:  dict
+
+        :returns:   The rendered text
+        :rtype:     str
+        """
+        if self.is_literal:
+            return self.literal
+        cache = self.cache
+        if version_dict is not None and cache and cache[0] is var_dict:
+            if all(version_dict.get(name) == version for name, version in cache[1]):
+                return cache[2]
+        dep_list = []
+        result = Template._render(self.segment_list, var_dict, version_dict or {}, dep_list, ())
+        if version_dict is not None:
+            self.cache = (var_dict, dep_list, result)
+        return result
+
+    @staticmethod
+    def _render(segment_list, var_dict, version_dict, dep_list, name_stack):
+        """
+        Renders a segment list
+
+        :param      segment_list:  The segments
+        :type       segment_list:  list
+        :param      var_dict:      The variables
+        :type       var_dict:      dict
+        :param      version_dict:  The version of each variable
+        :type       version_dict:  dict
+        :param      dep_list:      The variables used with their versions
+        :type       dep_list:      list(tuple(str, int))
+        :param      name_stack:    The variables being expanded, to stop cycles
+        :type       name_stack:    tuple(str)
+
+        :returns:   The rendered text
+        :rtype:     str
+        """
+        text_list = []
+        for segment in segment_list:
+            if type(segment) is str:
+                text_list.append(segment)
+                continue
+            name_list, default_list, source = segment
+            name = Template._render(name_list, var_dict, version_dict, dep_list, name_stack)
+            dep_list.append((name, version_dict.get(name)))
+            if name in name_stack:
+                # A variable that refers to itself, leave it for the shell
+                text_list.append(source)
+                continue
+            value = var_dict.get(name)
+            if value is not None:
+                value = '{}'.format(value)
+                if '${' in value:
+                    # Expand the references in the value
+                    template = Template.compile(value)
+                    value = Template._render(template.segment_list, var_dict, version_dict, dep_list, name_stack + (name,))
+            if default_list is not None and not value:
+                value = Template._render(default_list, var_dict, version_dict, dep_list, name_stack)
+            elif value is None:
+                value = source
+            text_list.append(value)
+        return ''.join(text_list)
+
+
+class PaneMonitor:
+    """
+    This class multiplexes the live output of panes to their subscribers.  Over
+    control mode the output is taken from the %output notifications on the
+    control client's reader thread.  Otherwise each pane is piped into a FIFO
+    with pipe-pane and all of the FIFOs are read by one thread.  A pane is only
+    piped once no matter how many subscribers it has.
+    """
+    def __init__(self, tmux):
+        """
+        Constructs a new pane monitor
+
+        :param      tmux:  The tmux instance
+        :type       tmux:  Tmux
+        """
+        self.tmux = tmux
+        self.lock = threading.Lock()
+        self.pane_dict = {}
+        self.selector = None
+        self.thread = None
+        self.wake_fds = None
+
+    def watch(self, pane_str, callback):
+        """
+        Subscribes to the output of a pane
+
+        :param      pane_str:  The target pane string
+        :type       pane_str:  str
+        :param      callback:  Called with each chunk of output
+        :type       callback:  function(bytes)
+
+        :returns:   The handle for unwatch() or None if the pane wasn't found
+        :rtype:     tuple
+        """
+        try:
+            id_list = self.tmux._cmd("display-message -p -t {} '#{{pane_id}} #{{session_id}}'".format(pane_str), check_output=True).decode('utf-8').split()
+        except subprocess.CalledProcessError:
+            id_list = []
+        if len(id_list) != 2:
+            print("{}Error: Unknown pane {}{}".format(RED, pane_str, NON))
+            return None
+        pane_id = id_list[0]
+        with self.lock:
+            entry = self.pane_dict.get(pane_id)
+            if entry is None:
+                entry = self.pane_dict[pane_id] = {'callback_list': []}
+                self._start(pane_id, id_list[1], entry)
+            entry['callback_list'].append(callback)
+        return (pane_id, callback)
+
+    def unwatch(self, handle):
+        """
+        Unsubscribes from the output of a pane
+
+        :param      handle:  The handle returned by watch()
+        :type       handle:  tuple
+        """
+        pane_id, callback = handle
+        with self.lock:
+            entry = self.pane_dict.get(pane_id)
+            if entry and callback in entry['callback_list']:
+                entry['callback_list'].remove(callback)
+                if not entry['callback_list']:
+                    del self.pane_dict[pane_id]
+                    self._stop(pane_id, entry)
+
+    def _start(self, pane_id, session_id, entry):
+        entry['dispatch'] = lambda data: self._dispatch(entry, data)
+        if self.tmux._control_open():
+            # NOTE: Output notifications are only sent for panes in the client's session
+            client_id = self.tmux._cmd("display-message -p '#{session_id}'", check_output=True).decode('utf-8').strip()
+            if client_id == session_id:
+                self.tmux.control.subscribe(pane_id, entry['dispatch'])
+                return
+        entry['fifo_dir'] = tempfile.mkdtemp(prefix='petmux')
+        fifo = os.path.join(entry['fifo_dir'], 'pane')
+        os.mkfifo(fifo)
+        # NOTE: Hold a write end so reads don't see EOF before and after the pipe
+        entry['fd_list'] = [os.open(fifo, os.O_RDONLY | os.O_NONBLOCK), os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)]
+        self.tmux._cmd("""pipe-pane -t {} -o 'cat > {}' """.format(pane_id, fifo), defer=True)
+        if self.thread is None:
+            self.selector = selectors.DefaultSelector()
+            self.wake_fds = os.pipe()
+            self.selector.register(self.wake_fds[0], selectors.EVENT_READ)
+            self.thread = threading.Thread(target=self._read, daemon=True)
+            self.thread.start()
+        self.selector.register(entry['fd_list'][0], selectors.EVENT_READ, entry)
+        os.write(self.wake_fds[1], b'.')
+
+    def _stop(self, pane_id, entry):
+        if 'fifo_dir' not in entry:
+            if self.tmux.control:
+                self.tmux.control.unsubscribe(pane_id, entry['dispatch'])
+            return
+        self.tmux._cmd("""pipe-pane -t {}""".format(pane_id), defer=True)
+        self.selector.unregister(entry['fd_list'][0])
+        os.write(self.wake_fds[1], b'.')
+        for fd in entry['fd_list']:
+            os.close(fd)
+        shutil.rmtree(entry['fifo_dir'], ignore_errors=True)
+
+    def _dispatch(self, entry, data):
+        for callback in list(entry['callback_list']):
+            callback(data)
+
+    def _read(self):
+        """
+        Reader thread for the FIFOs of all of the piped panes
+        """
+        while True:
+            for key, events in self.selector.select():
+                if key.data is None:
+                    if not os.read(self.wake_fds[0], 512):
+                        return
+                    continue
+                try:
+                    data = os.read(key.fd, 65536)
+                except (BlockingIOError, OSError):
+                    continue
+                if data:
+                    self._dispatch(key.data, data)
+
+    def close(self):
+        """
+        Stops monitoring all of the panes
+        """
+        with self.lock:
+            for pane_id, entry in self.pane_dict.items():
+                self._stop(pane_id, entry)
+            self.pane_dict.clear()
+        if self.thread:
+            # Closing the write end wakes the reader thread with EOF
+            os.close(self.wake_fds[1])
+            self.thread.join()
+            os.close(self.wake_fds[0])
+            self.selector.close()
+            self.thread = None
+
+
+class PaneStream:
+    """
+    This class streams the live output of a pane through the pane monitor
+    """
+    def __init__(self, tmux, pane_str):
+        """
+        Constructs a new pane stream, call open() to start streaming
+
+        :param      tmux:      The tmux instance
+        :type       tmux:      Tmux
+        :param      pane_str:  The target pane string
+        :type       pane_str:  str
+        """
+        self.tmux = tmux
+        self.pane_str = pane_str
+        self.chunk_queue = queue.Queue()
+        self.handle = None
+
+    def open(self):
+        """
+        Starts streaming the pane output
+        """
+        self.handle = self.tmux.monitor.watch(self.pane_str, self.chunk_queue.put)
+        self.tmux.waker_set.add(self._wake)
+
+    def _wake(self):
+        """
+        Ends a read that is waiting, when the run is cancelled
+        """
+        self.chunk_queue.put(b'')
+
+    def read(self, timeout):
+        """
+        Reads the next chunk of output
+
+        :param      timeout:  The time to wait for output [in S]
+        :type       timeout:  number
+
+        :returns:   The output or b'' if none arrived before the timeout
+        :rtype:     bytes
+        """
+        try:
+            data = self.chunk_queue.get(timeout=max(timeout, 0))
+        except queue.Empty:
+            return b''
+        # Coalesce what has already arrived
+        while not self.chunk_queue.empty():
+            data += self.chunk_queue.get()
+        return data
+
+    def close(self):
+        """
+        Stops streaming the pane output
+        """
+        self.tmux.waker_set.discard(self._wake)
+        if self.handle:
+            self.tmux.monitor.unwatch(self.handle)
+            self.handle = None
+
+
+class AsyncPaneStream(PaneStream):
+    """
+    This class streams the live output of a pane to an event loop, so it can be
+    read without holding a thread
+    """
+    def __init__(self, tmux, pane_str, loop):
+        """
+        Constructs a new pane stream, call open() to start streaming
+
+        :param      tmux:      The tmux instance
+        :type       tmux:      Tmux
+        :param      pane_str:  The target pane string
+        :type       pane_str:  str
+        :param      loop:      The event loop of the reader
+        :type       loop:      asyncio.AbstractEventLoop
+        """
+        PaneStream.__init__(self, tmux, pane_str)
+        self.loop = loop
+        self.chunk_queue = asyncio.Queue()
+
+    def open(self):
+        """
+        Starts streaming the pane output
+        """
+        # NOTE: The output arrives on the monitor's thread
+        self.handle = self.tmux.monitor.watch(self.pane_str, self._put)
+        self.tmux.waker_set.add(self._wake)
+
+    def _put(self, data):
+        self.loop.call_soon_threadsafe(self.chunk_queue.put_nowait, data)
+
+    def _wake(self):
+        """
+        Ends a read that is waiting
+        """
+        self._put(b'')
+
+    async def read(self, timeout):
+        """
+        Reads the next chunk of output
+
+        :param      timeout:  The time to wait for output [in S]
+        :type       timeout:  number
+
+        :returns:   The output or b'' if none arrived before the timeout
+        :rtype:     bytes
+        """
+        try:
+            data = await asyncio.wait_for(self.chunk_queue.get(), max(timeout, 0))
+        except asyncio.TimeoutError:
+            return b''
+        # Coalesce what has already arrived
+        while not self.chunk_queue.empty():
+            data += self.chunk_queue.get_nowait()
+        return data
+
+
+class PaneLogger:
+    """
+    This class writes the streamed output of a pane to a log file.  ANSI escape
+    sequences are stripped, each line is time stamped and the file is rotated
+    by size or age with the rotated files compressed.  Only a partial line is
+    held in memory.
+    """
+    ANSI = re.compile(r'\x1b(\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(\x07|\x1b\\)|[PX^_][^\x1b]*\x1b\\|[@-Z\\-_])|[\x00-\x08\x0b-\x1f\x7f]')
+    LINE_MAX = 65536
+
+    def __init__(self, file, max_size=0, rotate=0, keep=5, compress='gzip', is_timestamp=True, is_strip=True):
+        """
+        Constructs a new pane logger
+
+        :param      file:          The log file name
+        :type       file:          str
+        :param      max_size:      Rotates when the file is bigger [in bytes], 0 to disable
+        :type       max_size:      int
+        :param      rotate:        Rotates when the file is older [in S], 0 to disable
+        :type       rotate:        number
+        :param      keep:          The number of rotated files to keep
+        :type       keep:          int
+        :param      compress:      gzip to compress the rotated files, otherwise None
+        :type       compress:      str
+        :param      is_timestamp:  Indicates if lines are time stamped
+        :type       is_timestamp:  boolean
+        :param      is_strip:      Indicates if ANSI escape sequences are stripped
+        :type       is_strip:      boolean
+        """
+        self.file = file
+        self.max_size = max_size
+        self.rotate = rotate
+        self.keep = keep
+        self.compress = compress
+        self.is_timestamp = is_timestamp
+        self.is_strip = is_strip
+        self.lock = threading.Lock()
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.partial = ''
+        self.fobj = None
+        # The rotated segments waiting to be compressed, in order
+        self.segment_queue = queue.Queue()
+        self.segment_cnt = itertools.count(1)
+        self.worker = None
+        self._open()
+
+    def _open(self):
+        if os.path.dirname(self.file):
+            os.makedirs(os.path.dirname(self.file), exist_ok=True)
+        # NOTE: Binary, so the size is counted in bytes like max_size
+        self.fobj = open(self.file, 'ab')
+        self.size = self.fobj.tell()
+        self.opened = time.time()
+
+    def _rotate(self):
+        self.fobj.close()
+        if self.compress == 'gzip':
+            # Compress in the background so the pane output isn't held up.
+            # NOTE: The segment gets a unique name and the rotated files are
+            #       only shifted once it is compressed, so rotating again while
+            #       a segment is compressed can't lose either one
+            segment = '{}.{}-{}'.format(self.file, os.getpid(), next(self.segment_cnt))
+            os.replace(self.file, segment)
+            if not self.worker:
+                self.worker = threading.Thread(target=self._compress)
+                self.worker.start()
+            self.segment_queue.put(segment)
+        else:
+            self._shift('')
+            os.replace(self.file, '{}.1'.format(self.file))
+        self._open()
+
+    def _shift(self, ext):
+        """
+        Shifts the rotated files up by one, dropping the oldest one
+
+        :param      ext:   The extension of the rotated files (e.g. .gz)
+        :type       ext:   str
+        """
+        for idx in range(self.keep - 1, 0, -1):
+            if os.path.exists('{}.{}{}'.format(self.file, idx, ext)):
+                os.replace('{}.{}{}'.format(self.file, idx, ext), '{}.{}{}'.format(self.file, idx + 1, ext))
+
+    def _compress(self):
+        """
+        Worker thread that compresses the rotated segments one at a time, in
+        the order they were rotated
+        """
+        while True:
+            segment = self.segment_queue.get()
+            if segment is None:
+                return
+            with open(segment, 'rb') as fin, gzip.open(segment + '.gz', 'wb') as fout:
+                shutil.copyfileobj(fin, fout)
+            self._shift('.gz')
+            os.replace(segment + '.gz', '{}.1.gz'.format(self.file))
+            os.remove(segment)
+
+    def write(self, data):
+        """
+        Writes a chunk of pane output
+
+        :param      data:  The pane output
+        :type       data:  bytes
+        """
+        with self.lock:
+            if self.fobj is None:
+                return
+            text = self.partial + self.decoder.decode(data)
+            line_list = text.split('\n')
+            self.partial = line_list.pop()
+            if len(self.partial) > PaneLogger.LINE_MAX:
+                line_list.append(self.partial)
+                self.partial = ''
+            self._write_lines(line_list)
+
+    def _write_lines(self, line_list):
+        if not line_list:
+            return
+        stamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3] + ' ' if self.is_timestamp else ''
+        text = ''.join('{}{}\n'.format(stamp, PaneLogger.ANSI.sub('', line) if self.is_strip else line.rstrip('\r')) for line in line_list)
+        data = text.encode('utf-8')
+        self.fobj.write(data)
+        self.fobj.flush()
+        self.size += len(data)
+        if (self.max_size and self.size >= self.max_size) or (self.rotate and time.time() - self.opened >= self.rotate):
+            self._rotate()
+
+    def close(self):
+        """
+        Writes any partial line and closes the log file
+        """
+        with self.lock:
+            if self.fobj:
+                self._write_lines([self.partial] if self.partial else [])
+                self.fobj.close()
+                self.fobj = None
+        # Wait for the rotated segments to be compressed
+        if self.worker:
+            self.segment_queue.put(None)
+            self.worker.join()
+            self.worker = None
+
+
+class Archive:
+    """
+    This class keeps the output of panes across runs in a SQLite full text
+    (FTS5) index, where each line is stored with its run, time, session,
+    sequence, window and pane.  Lines are queued by the pane readers and
+    written by a background thread, which inserts all of the lines queued
+    while the last transaction was written in one transaction, so a busy pane
+    doesn't hold up the sequence.  A transaction that fails (e.g. the
+    database is locked) is retried, and the lines are dropped, and counted,
+    if it keeps failing or the queue is full.
+    """
+    # The most lines written in one transaction
+    BATCH_MAX = 5000
+    # The most lines queued, beyond which lines are dropped
+    QUEUE_MAX = 100000
+    # The retries of a failed transaction and the first delay [in S], which
+    # doubles with each retry
+    RETRY_MAX = 5
+    RETRY_DELAY = 0.2
+    SCHEMA_LIST = [
+        "CREATE TABLE IF NOT EXISTS run(id INTEGER PRIMARY KEY, start REAL, config TEXT, argv TEXT)",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS line USING fts5(text, run UNINDEXED, time UNINDEXED, session UNINDEXED, sequence UNINDEXED, window UNINDEXED, pane UNINDEXED)",
+    ]
+    # NOTE: Without FTS5, the lines are kept in a table and searched with LIKE
+    SCHEMA_PLAIN = "CREATE TABLE IF NOT EXISTS line(text TEXT, run INTEGER, time REAL, session TEXT, sequence TEXT, window TEXT, pane TEXT)"
+    COLUMN_LIST = ['run', 'time', 'session', 'sequence', 'window', 'pane', 'text']
+
+    def __init__(self, file):
+        """
+        Opens the archive, creating it if needed
+
+        :param      file:  The SQLite database file
+        :type       file:  str
+        """
+        self.file = file
+        if os.path.dirname(file):
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+        self.db = sqlite3.connect(file)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(Archive.SCHEMA_LIST[0])
+        try:
+            self.db.execute(Archive.SCHEMA_LIST[1])
+            self.is_fts = True
+        except sqlite3.OperationalError:
+            self.db.execute(Archive.SCHEMA_PLAIN)
+            self.is_fts = False
+        self.db.commit()
+        self.run_id = None
+        self.queue = queue.Queue(Archive.QUEUE_MAX)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.drop_cnt = 0
+        # The decoder, incomplete line and key of each pane's output
+        self.partial_dict = {}
+
+    @staticmethod
+    def default_file():
+        """
+        Gets the default archive file in the cache directory
+
+        :returns:   The archive file name
+        :rtype:     str
+        """
+        return os.path.join(Plan.cache_dir(), 'archive.db')
+
+    def start(self, config_file, argv):
+        """
+        Starts a run, which the lines added until close() are part of
+
+        :param      config_file:  The configuration file
+        :type       config_file:  str
+        :param      argv:         The command line arguments
+        :type       argv:         list(str)
+
+        :returns:   The run id
+        :rtype:     int
+        """
+        with self.db:
+            cursor = self.db.execute('INSERT INTO run(start, config, argv) VALUES (?, ?, ?)', (time.time(), os.path.abspath(config_file), json.dumps(argv)))
+        self.run_id = cursor.lastrowid
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+        return self.run_id
+
+    def _write(self):
+        """
+        Writer thread that inserts the queued lines in batches
+        """
+        try:
+            db = sqlite3.connect(self.file)
+            db.execute('PRAGMA synchronous=NORMAL')
+        except sqlite3.Error as e:
+            print("{}Warning: Can't write the archive {}: {}{}".format(RED, self.file, e, NON))
+            db = None
+        row = self.queue.get()
+        while row is not None:
+            row_list = [row]
+            # Take all of the lines that are already queued
+            while len(row_list) < Archive.BATCH_MAX:
+                try:
+                    row = self.queue.get_nowait()
+                except queue.Empty:
+                    row = False
+                    break
+                if row is None:
+                    break
+                row_list.append(row)
+            if not self._insert(db, row_list):
+                self._drop(len(row_list))
+            if row is False or len(row_list) == Archive.BATCH_MAX:
+                row = self.queue.get()
+        if db:
+            db.close()
+
+    def _insert(self, db, row_list):
+        """
+        Inserts lines in one transaction, retrying while it fails
+
+        :param      db:        The writer's connection
+        :type       db:        sqlite3.Connection
+        :param      row_list:  The lines with their columns
+        :type       row_list:  list(tuple)
+
+        :returns:   True if the lines were written
+        :rtype:     boolean
+        """
+        if db is None:
+            return False
+        insert = 'INSERT INTO line({}) VALUES ({})'.format(', '.join(Archive.COLUMN_LIST), ', '.join('?' * len(Archive.COLUMN_LIST)))
+        for retry in range(Archive.RETRY_MAX + 1):
+            try:
+                with db:
+                    db.executemany(insert, row_list)
+                return True
+            except sqlite3.Error as e:
+                error = e
+            if retry < Archive.RETRY_MAX:
+                time.sleep(Archive.RETRY_DELAY * 2 ** retry)
+        print("{}Warning: Can't write the archive {}: {}{}".format(RED, self.file, error, NON))
+        return False
+
+    def _drop(self, cnt):
+        """
+        Counts lines that were not archived
+
+        :param      cnt:  The number of lines
+        :type       cnt:  int
+        """
+        with self.lock:
+            self.drop_cnt += cnt
+
+    def _add(self, key, line_list):
+        """
+        Queues the lines of a pane
+
+        :param      key:        The session, sequence, window and pane
+        :type       key:        tuple
+        :param      line_list:  The lines
+        :type       line_list:  list(str)
+        """
+        now = time.time()
+        for line in line_list:
+            line = PaneLogger.ANSI.sub('', line)
+            if line.strip():
+                # NOTE: The pane readers mustn't wait for a stuck writer
+                try:
+                    self.queue.put_nowait((self.run_id, now) + key + (line,))
+                except queue.Full:
+                    self._drop(1)
+
+    def write(self, pane_str, key, data):
+        """
+        Adds a chunk of a pane's streamed output, keeping any incomplete line
+        for the next chunk
+
+        :param      pane_str:  The target pane string
+        :type       pane_str:  str
+        :param      key:       The session, sequence, window and pane
+        :type       key:       tuple
+        :param      data:      The pane output
+        :type       data:      bytes
+        """
+        with self.lock:
+            decoder, partial, _ = self.partial_dict.get(pane_str) or (codecs.getincrementaldecoder('utf-8')('replace'), '', key)
+            line_list = (partial + decoder.decode(data)).split('\n')
+            partial = line_list.pop()
+            if len(partial) > PaneLogger.LINE_MAX:
+                line_list.append(partial)
+                partial = ''
+            self.partial_dict[pane_str] = (decoder, partial, key)
+        self._add(key, line_list)
+
+    def write_file(self, key, fobj):
+        """
+        Adds the lines of a capture, read from its current position
+
+        :param      key:   The session, sequence, window and pane
+        :type       key:   tuple
+        :param      fobj:  The capture
+        :type       fobj:  io.BufferedReader
+        """
+        for line in fobj:
+            self._add(key, [line.decode('utf-8', 'replace').rstrip('\n')])
+
+    def close(self):
+        """
+        Adds the incomplete lines and waits for the queued lines to be written
+        """
+        with self.lock:
+            partial_dict, self.partial_dict = self.partial_dict, {}
+        for decoder, partial, key in partial_dict.values():
+            self._add(key, [partial + decoder.decode(b'', True)])
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.drop_cnt:
+            print("{}Warning: {} lines were not archived{}".format(RED, self.drop_cnt, NON))
+        self.db.close()
+
+    def search(self, query, run=None, session=None, sequence=None, window=None, pane=None, limit=100):
+        """
+        Searches the archived lines with an FTS5 query (e.g. 'segfault',
+        '"out of memory"', 'error NOT warning' or 'kern*'), newest last
+
+        :param      query:     The full text query
+        :type       query:     str
+        :param      run:       Only the lines of the run id
+        :type       run:       int
+        :param      session:   Only the lines of the session
+        :type       session:   str
+        :param      sequence:  Only the lines of the sequence
+        :type       sequence:  str
+        :param      window:    Only the lines of the window
+        :type       window:    str
+        :param      pane:      Only the lines of the pane
+        :type       pane:      str
+        :param      limit:     The most lines returned (the newest ones)
+        :type       limit:     int
+
+        :returns:   The lines with their run, time, session, sequence, window
+                    and pane
+        :rtype:     list(dict)
+        """
+        if self.is_fts:
+            sql = 'SELECT {} FROM line WHERE line MATCH ?'.format(', '.join(Archive.COLUMN_LIST))
+        else:
+            sql = 'SELECT {} FROM line WHERE text LIKE ?'.format(', '.join(Archive.COLUMN_LIST))
+            query = '%{}%'.format(query)
+        arg_list = [query]
+        for column, value in (('run', run), ('session', session), ('sequence', sequence), ('window', window), ('pane', pane)):
+            if value is not None:
+                sql += ' AND {} = ?'.format(column)
+                arg_list.append(value)
+        sql += ' ORDER BY rowid DESC LIMIT ?'
+        arg_list.append(limit)
+        row_list = self.db.execute(sql, arg_list).fetchall()
+        return [ dict(zip(Archive.COLUMN_LIST, row)) for row in reversed(row_list) ]
+
+    def runs(self):
+        """
+        Gets the runs in the archive
+
+        :returns:   The id, start time, configuration file and command line
+                    arguments of each run
+        :rtype:     list(tuple(int, float, str, str))
+        """
+        return self.db.execute('SELECT id, start, config, argv FROM run ORDER BY id').fetchall()
+
+
+class OutputScanner:
+    """
+    This class incrementally matches a regular expression against streamed
+    output.  Until finish() only complete lines are searched, so a match can't
+    be cut short by output that is still arriving.  Only the last lines within
+    max_output characters are kept once searched, so the memory stays flat no
+    matter how much a pane prints, and a match can span the chunks of output as
+    long as it is shorter than max_output.
+    """
+    # The default most output kept [in characters]
+    MAX_OUTPUT = 65536
+
+    def __init__(self, patt, max_output=None):
+        """
+        Constructs a new output scanner
+
+        :param      patt:        The regular expression
+        :type       patt:        str or re.Pattern
+        :param      max_output:  The most output kept [in characters]
+        :type       max_output:  int
+        """
+        self.patt = re.compile(patt) if type(patt) == str else patt
+        self.max_output = int(max_output or OutputScanner.MAX_OUTPUT)
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.text = ''
+        self.end = 0
+
+    def _append(self, data):
+        """
+        Adds output and gets the end of its complete lines.  An incomplete line
+        longer than max_output (e.g. a progress bar) is taken as complete, so it
+        can't grow without bounds.
+
+        :param      data:  The output
+        :type       data:  bytes
+
+        :returns:   The end of the complete lines
+        :rtype:     int
+        """
+        self.text += self.decoder.decode(data)
+        end = self.text.rfind('\n') + 1
+        if len(self.text) - end > self.max_output:
+            end = len(self.text)
+        return end
+
+    def _trim(self):
+        """
+        Drops the searched output, except for the last lines within max_output,
+        which are searched again with the next output
+        """
+        if self.end > self.max_output:
+            # NOTE: Cut at the start of a line, so ^ still matches
+            cut = self.text.find('\n', self.end - self.max_output, self.end) + 1 or self.end
+            self.text = self.text[cut:]
+            self.end -= cut
+
+    def feed(self, data):
+        """
+        Adds output and searches the complete lines
+
+        :param      data:  The output
+        :type       data:  bytes
+
+        :returns:   The match if found
+        :rtype:     re.Match
+        """
+        end = self._append(data)
+        if end > self.end:
+            self.end = end
+            match = self.patt.search(self.text, 0, end)
+            if not match:
+                self._trim()
+            return match
+        return None
+
+    def consume(self, match):
+        """
+        Drops the output up to the end of a match and searches the rest of the
+        complete lines, to find each match in turn
+
+        :param      match:  The last match
+        :type       match:  re.Match
+
+        :returns:   The next match if found
+        :rtype:     re.Match
+        """
+        # NOTE: At least one character is dropped, so an empty match can't repeat
+        cut = min(max(match.end(), 1), len(self.text))
+        self.text = self.text[cut:]
+        self.end = max(self.end - cut, 0)
+        return self.patt.search(self.text, 0, self.end) if self.end else None
+
+    def finish(self):
+        """
+        Searches all of the output including any incomplete line
+
+        :returns:   The match if found
+        :rtype:     re.Match
+        """
+        self.text += self.decoder.decode(b'', True)
+        return self.patt.search(self.text)
+
+
+class PatternScanner(OutputScanner):
+    """
+    This class matches many regular expressions against streamed output in one
+    pass.  The patterns are combined into one regular expression with a named
+    group per pattern, unless they can't be (e.g. back references or the same
+    group name), in which case each pattern is searched by itself.  The groups
+    of the matches are kept rather than the matches, so the searched output
+    can be dropped like in OutputScanner.
+    """
+    MODE_LIST = ['first', 'last', 'all']
+
+    def __init__(self, patt_list, mode='first', until=None, combined=None, max_output=None):
+        """
+        Constructs a new pattern scanner
+
+        :param      patt_list:   The compiled regular expressions
+        :type       patt_list:   list(re.Pattern)
+        :param      mode:        Keep the first, last or all matches of each pattern
+        :type       mode:        str
+        :param      until:       The compiled regular expression that ends the
+                                 output (e.g. the shell prompt), if any
+        :type       until:       re.Pattern
+        :param      combined:    The compiled combine() of the patterns, if any
+        :type       combined:    re.Pattern
+        :param      max_output:  The most output kept [in characters]
+        :type       max_output:  int
+        """
+        OutputScanner.__init__(self, None, max_output)
+        self.patt_list = patt_list
+        self.mode = mode
+        self.until = until
+        self.combined = combined
+        # Groups and named groups of the matches of each pattern
+        self.match_list = [ [] for patt in patt_list ]
+
+    @staticmethod
+    def combine(patt_list):
+        """
+        Builds the regular expression that matches any of the patterns
+
+        :param      patt_list:  The regular expressions
+        :type       patt_list:  list(str)
+
+        :returns:   The combined regular expression or None if the patterns
+                    can't be combined
+        :rtype:     str
+        """
+        for patt in patt_list:
+            # Numbered back references and global flags don't survive combining
+            if re.search(r'\\[1-9]|\(\?[aiLmsux]+\)', patt):
+                return None
+        combined = '|'.join('(?P<_p{}>{})'.format(idx, patt) for idx, patt in enumerate(patt_list))
+        try:
+            re.compile(combined)
+        except re.error:
+            return None
+        return combined
+
+    def _add(self, idx, match):
+        """
+        Keeps the groups of a match of a pattern according to the mode
+
+        :param      idx:    The pattern index
+        :type       idx:    int
+        :param      match:  The match
+        :type       match:  re.Match
+        """
+        groups = (match.groups() or (match.group(0),), match.groupdict())
+        if self.mode == 'all' or not self.match_list[idx]:
+            self.match_list[idx].append(groups)
+        elif self.mode == 'last':
+            self.match_list[idx][0] = groups
+
+    def _scan(self, start, end):
+        """
+        Matches the patterns in the kept text up to end.  The text before start
+        was already matched, so only the matches that end after it are new.
+
+        :param      start:  The end of the text already matched
+        :type       start:  int
+        :param      end:    The end of the text
+        :type       end:    int
+
+        :returns:   True if done (i.e. all of the patterns matched in first mode)
+        :rtype:     boolean
+        """
+        if self.combined:
+            for match in self.combined.finditer(self.text, 0, end):
+                idx = int(match.lastgroup[2:])
+                if match.end() > start:
+                    # Match the pattern by itself, so its groups are numbered as usual
+                    self._add(idx, self.patt_list[idx].match(self.text, match.start(), end))
+                # NOTE: The combined pattern hides the other patterns that match
+                #       from within this match (e.g. error and error: (\d+)),
+                #       so they are searched from each start within it
+                for other, patt in enumerate(self.patt_list):
+                    if other == idx or (self.mode == 'first' and self.match_list[other]):
+                        continue
+                    pos = match.start()
+                    while pos < match.end():
+                        hidden = patt.search(self.text, pos, end)
+                        if not hidden or hidden.start() >= match.end():
+                            break
+                        if hidden.end() > start:
+                            self._add(other, hidden)
+                        pos = max(hidden.end(), hidden.start() + 1)
+        else:
+            for idx, patt in enumerate(self.patt_list):
+                if self.mode == 'first':
+                    if not self.match_list[idx]:
+                        match = patt.search(self.text, 0, end)
+                        if match:
+                            self._add(idx, match)
+                else:
+                    for match in patt.finditer(self.text, 0, end):
+                        if match.end() > start:
+                            self._add(idx, match)
+        return self.mode == 'first' and all(self.match_list)
+
+    def feed(self, data):
+        """
+        Adds output and matches the new complete lines, or the output up to the
+        until pattern, which can match an incomplete line (e.g. the prompt)
+
+        :param      data:  The output
+        :type       data:  bytes
+
+        :returns:   True if done
+        :rtype:     boolean
+        """
+        end = self._append(data)
+        until = self.until.search(self.text, self.end) if self.until else None
+        end = until.start() if until else end
+        if end > self.end:
+            start, self.end = self.end, end
+            if self._scan(start, end):
+                return True
+            self._trim()
+        return until is not None
+
+    def finish(self, is_done=False):
+        """
+        Matches any incomplete line, unless done, and gets the matches
+
+        :param      is_done:  Indicates if the scan is already done
+        :type       is_done:  boolean
+
+        :returns:   The groups and named groups of the matches of each pattern
+        :rtype:     list(list(tuple(tuple, dict)))
+        """
+        if not is_done:
+            self.text += self.decoder.decode(b'', True)
+            until = self.until.search(self.text, self.end) if self.until else None
+            end = until.start() if until else len(self.text)
+            self._scan(self.end, end)
+            self.end = end
+        return self.match_list
+
+
+class Tracer:
+    """
+    This class records the spans of a run (keywords, tmux commands, sleeps and
+    user input) as Chrome trace events, which can be viewed with Perfetto or
+    chrome://tracing, and summarizes where the time went.
+    """
+    # Categories that account for the wall clock time, in report order
+    CAT_DICT = {
+        'tmux'    : 'tmux round-trips',
+        'delay'   : 'DELAY and command delays',
+        'pause'   : 'PAUSE',
+        'extract' : 'EXTRACT waits',
+        'wait_for': 'WAIT_FOR waits',
+        'input'   : 'User input',
+    }
+
+    def __init__(self, file):
+        """
+        Constructs a new tracer
+
+        :param      file:  The trace file
+        :type       file:  str
+        """
+        self.file = file
+        self.event_list = []
+        self.thread_dict = {}
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def span(self, name, cat, **args):
+        """
+        Records the time spent in the with block.  The arguments are yielded so
+        the block can add to them (e.g. the return code).
+
+        :param      name:  The span name
+        :type       name:  str
+        :param      cat:   The category
+        :type       cat:   str
+        :param      args:  The span arguments
+        :type       args:  dict
+        """
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            self.add(name, cat, start, time.perf_counter() - start, args)
+
+    def add(self, name, cat, start, duration, args):
+        """
+        Adds a complete event
+
+        :param      name:      The event name
+        :type       name:      str
+        :param      cat:       The category
+        :type       cat:       str
+        :param      start:     The perf_counter() start time [in S]
+        :type       start:     float
+        :param      duration:  The duration [in S]
+        :type       duration:  float
+        :param      args:      The event arguments
+        :type       args:      dict
+        """
+        tid = threading.get_ident()
+        event = {
+            'name': name,
+            'cat' : cat,
+            'ph'  : 'X',
+            'ts'  : (start - self.start) * 1e6,
+            'dur' : duration * 1e6,
+            'pid' : os.getpid(),
+            'tid' : tid,
+            'args': args,
+        }
+        with self.lock:
+            self.thread_dict.setdefault(tid, threading.current_thread().name)
+            self.event_list.append(event)
+
+    def write(self):
+        """
+        Writes the trace file
+        """
+        meta_list = [ {'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}} for tid, name in self.thread_dict.items() ]
+        with open(self.file, 'w') as f:
+            json.dump({'traceEvents': meta_list + self.event_list, 'displayTimeUnit': 'ms'}, f, default=str)
+
+    def summary(self):
+        """
+        Prints where the wall clock time went by category and by keyword.  The
+        categories can add up to more than the wall clock time when panes or
+        targets run concurrently.
+        """
+        wall = time.perf_counter() - self.start
+        cat_dict = {}
+        key_dict = {}
+        for event in self.event_list:
+            if event['cat'] in self.CAT_DICT:
+                entry_dict, name = cat_dict, event['cat']
+            elif event['cat'] == 'keyword':
+                entry_dict, name = key_dict, event['name']
+            else:
+                continue
+            count, total = entry_dict.get(name, (0, 0))
+            entry_dict[name] = (count + 1, total + event['dur'] / 1e6)
+        print("\n{:<26}  {:>6}  {:>9}  {:>6}".format('TIME SPENT IN', 'COUNT', 'TOTAL', '%'))
+        other = wall
+        for cat, desc in self.CAT_DICT.items():
+            count, total = cat_dict.get(cat, (0, 0))
+            other -= total
+            print("{:<26}  {:>6}  {:>8.3f}s  {:>5.1f}%".format(desc, count, total, 100 * total / wall))
+        other = max(other, 0)
+        print("{:<26}  {:>6}  {:>8.3f}s  {:>5.1f}%".format('Other (petmux, shell)', '', other, 100 * other / wall))
+        print("{:<26}  {:>6}  {:>8.3f}s".format('Wall clock', '', wall))
+        print("\n{:<26}  {:>6}  {:>9}".format('KEYWORD', 'COUNT', 'TOTAL'))
+        for key, (count, total) in sorted(key_dict.items(), key=lambda item: -item[1][1]):
+            print("{:<26}  {:>6}  {:>8.3f}s".format(key, count, total))
+        print("Trace written to {}".format(self.file))
+
+
+class Timings:
+    """
+    This class keeps how long the EXTRACT, WAIT_FOR and PAUSE of each sequence,
+    pane and command actually took as histograms in a history file, and learns
+    the EXTRACT and PAUSE waits from them.  The histogram buckets grow geometrically, so a few
+    dozen buckets cover milliseconds to hours at a fixed relative precision.
+    """
+    VERSION = 1
+    # The first bucket's upper bound [in S] and the ratio between buckets
+    BUCKET_MIN = 0.01
+    BUCKET_RATIO = 1.25
+    # The learned wait is the percentile times the margin plus the padding [in S]
+    PERCENTILE = 0.95
+    MARGIN = 1.5
+    PADDING = 0.1
+    # Samples needed before a wait is learned
+    SAMPLE_MIN = 3
+    # Counts are halved past this many samples, so the history follows changes
+    SAMPLE_MAX = 200
+
+    def __init__(self, file, is_record=False, is_adaptive=False):
+        """
+        Constructs a new timings history
+
+        :param      file:         The history file
+        :type       file:         str
+        :param      is_record:    Indicates if the timings are recorded
+        :type       is_record:    boolean
+        :param      is_adaptive:  Indicates if the learned waits are used
+        :type       is_adaptive:  boolean
+        """
+        self.file = file
+        self.is_record = is_record
+        self.is_adaptive = is_adaptive
+        self.hist_dict = Timings._load(file)
+        # Counts recorded by this run, merged into the file by save()
+        self.new_dict = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def default_file(config_file):
+        """
+        Gets the history file of a configuration file in the cache directory
+
+        :param      config_file:  The configuration file
+        :type       config_file:  str
+
+        :returns:   The history file
+        :rtype:     str
+        """
+        digest = hashlib.sha256(os.path.abspath(config_file).encode('utf-8')).hexdigest()
+        return os.path.join(Plan.cache_dir(), 'history-{}.json'.format(digest[:16]))
+
+    @staticmethod
+    def _load(file):
+        """
+        Loads the histograms of a history file
+
+        :param      file:  The history file
+        :type       file:  str
+
+        :returns:   The bucket counts by key
+        :rtype:     dict
+        """
+        try:
+            with open(file) as f:
+                history = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if history.get('version') != Timings.VERSION:
+            return {}
+        return { key: { int(bucket): count for bucket, count in hist.items() } for key, hist in history.get('timings', {}).items() }
+
+    @staticmethod
+    def _bucket(elapsed):
+        """
+        Gets the bucket of a time
+
+        :param      elapsed:  The time [in S]
+        :type       elapsed:  float
+
+        :returns:   The bucket index
+        :rtype:     int
+        """
+        if elapsed <= Timings.BUCKET_MIN:
+            return 0
+        return int(math.ceil(math.log(elapsed / Timings.BUCKET_MIN, Timings.BUCKET_RATIO)))
+
+    def record(self, key, elapsed):
+        """
+        Records how long a command took, if recording
+
+        :param      key:      The sequence, pane, keyword and command
+        :type       key:      str
+        :param      elapsed:  The time [in S]
+        :type       elapsed:  float
+        """
+        if not self.is_record:
+            return
+        bucket = Timings._bucket(elapsed)
+        with self.lock:
+            for hist_dict in (self.hist_dict, self.new_dict):
+                hist = hist_dict.setdefault(key, {})
+                hist[bucket] = hist.get(bucket, 0) + 1
+
+    def wait(self, key, delay):
+        """
+        Gets the learned wait of a command in adaptive mode, otherwise or
+        without enough history the configured delay
+
+        :param      key:    The sequence, pane, keyword and command
+        :type       key:    str
+        :param      delay:  The configured delay [in S]
+        :type       delay:  number
+
+        :returns:   The wait [in S]
+        :rtype:     number
+        """
+        if not self.is_adaptive:
+            return delay
+        with self.lock:
+            hist = dict(self.hist_dict.get(key, {}))
+        total = sum(hist.values())
+        if total < Timings.SAMPLE_MIN:
+            return delay
+        count = 0
+        for bucket in sorted(hist):
+            count += hist[bucket]
+            if count >= Timings.PERCENTILE * total:
+                break
+        return Timings.BUCKET_MIN * Timings.BUCKET_RATIO ** bucket * Timings.MARGIN + Timings.PADDING
+
+    def save(self):
+        """
+        Adds the recorded counts to the history file, which may have been
+        updated by another run since it was loaded
+        """
+        if not self.new_dict:
+            return
+        hist_dict = Timings._load(self.file)
+        for key, new in self.new_dict.items():
+            hist = hist_dict.setdefault(key, {})
+            for bucket, count in new.items():
+                hist[bucket] = hist.get(bucket, 0) + count
+            if sum(hist.values()) > Timings.SAMPLE_MAX:
+                hist_dict[key] = { bucket: (count + 1) // 2 for bucket, count in hist.items() }
+        history = {'version': Timings.VERSION, 'timings': hist_dict}
+        try:
+            os.makedirs(os.path.dirname(self.file) or '.', exist_ok=True)
+            with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(self.file) or '.', delete=False) as f:
+                json.dump(history, f, indent=1, sort_keys=True)
+            os.replace(f.name, self.file)
+        except OSError as e:
+            print("{}Couldn't save the timings history: {}{}".format(RED, e, NON))
+        self.new_dict = {}
+
+
+class FileWatcher:
+    """
+    This class waits for a file to change, with inotify on Linux and otherwise
+    by polling its modification time
+    """
+    # The polling period without inotify [in S]
+    POLL = 0.5
+    # The time without events before a save is complete [in S]
+    SETTLE = 0.1
+    # inotify events: IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM,
+    # IN_MOVED_TO, IN_CREATE and IN_DELETE
+    IN_MASK = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+
+    def __init__(self, file):
+        """
+        Starts watching the file
+
+        :param      file:  The file
+        :type       file:  str
+        """
+        self.file = os.path.abspath(file)
+        self.stamp = self._stamp()
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+            # NOTE: The directory is watched, since editors save by replacing the file
+            if fd >= 0 and libc.inotify_add_watch(fd, os.path.dirname(self.file).encode('utf-8'), FileWatcher.IN_MASK) >= 0:
+                self.fd = fd
+            elif fd >= 0:
+                os.close(fd)
+        except (OSError, AttributeError):
+            pass
+
+    def _stamp(self):
+        """
+        Gets the inode, modification time and size of the file
+
+        :returns:   The stamp or None if the file doesn't exist
+        :rtype:     tuple(int, int, int)
+        """
+        try:
+            st = os.stat(self.file)
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def wait(self):
+        """
+        Waits until the file changes, and the editor is done saving it
+        """
+        while True:
+            if self.fd is not None:
+                select.select([self.fd], [], [])
+                while select.select([self.fd], [], [], FileWatcher.SETTLE)[0]:
+                    os.read(self.fd, 65536)
+            else:
+                time.sleep(FileWatcher.POLL)
+            stamp = self._stamp()
+            if stamp != self.stamp:
+                self.stamp = stamp
+                if stamp:
+                    return
+
+    def close(self):
+        """
+        Stops watching the file
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
 class Tmux:
     """
-    This class wraps the tmux command line interface for petmux
+    This class wraps the tmux command line interface for petmux
+    """
+    # NOTE: Shared, so the buffers and channels of the instances in a process
+    #       (e.g. of many PetMux.run_async) don't collide
+    wait_cnt = itertools.count(1)
+
+    class Cancelled(Exception):
+        """
+        Exception for signaling that the run was cancelled (see cancel())
+        """
+
+    def __init__(self, is_debug=False, is_dryrun=False, is_control=False, is_batch=False, socket=None, is_detached=False, tracer=None, timings=None, archive=None):
+        """
+        Constructs a new tmux instance.
+
+        :param      is_debug:    Indicates if debug
+        :type       is_debug:    boolean
+        :param      is_dryrun:   Indicates if dryrun
+        :type       is_dryrun:   boolean
+        :param      is_control:  Indicates if commands are sent over a
+                                 persistent tmux control mode connection
+        :type       is_control:  boolean
+        :param      is_batch:    Indicates if commands that don't need results
+                                 are queued and sent as one batch
+        :type       is_batch:    boolean
+        :param      socket:      The tmux server socket name (-L) or path (-S)
+        :type       socket:      str
+        :param      is_detached: Indicates if there is no tmux client to switch,
+                                 so sessions are created without prompting
+        :type       is_detached: boolean
+        :param      tracer:      The tracer that records the run, if any
+        :type       tracer:      Tracer
+        :param      timings:     The timings history, if any
+        :type       timings:     Timings
+        :param      archive:     The archive of the pane output, if any
+        :type       archive:     Archive
+        """
+        self.cmd_delay = 0
+        self.is_debug = is_debug
+        self.is_dryrun = is_dryrun
+        self.window_dict = {}
+        self.pane_last = 1
+        self.window_last = None
+        self.session_last = None
+        self.var_dict = {}
+        self.var_version = {}
+        self.capture_dict = {}
+        self.archived_dict = {}
+        self.monitor = PaneMonitor(self)
+        self.logger_dict = {}
+        self.patt_dict = {}
+        # The most output kept in memory by EXTRACT and CAPTURE [in characters]
+        self.max_output = OutputScanner.MAX_OUTPUT
+        self.is_control = is_control
+        self.control = None
+        self.is_batch = is_batch
+        self.batch_max = 64
+        # NOTE: tmux rejects a command line longer than its message size (16K)
+        self.batch_size = 8192
+        self.cmd_queue = []
+        self.queue_lock = threading.Lock()
+        self.is_detached = is_detached
+        # The user's tmux client, once found by _user_client()
+        self.client_name = None
+        # The working directory, environment and streams of the petmux client,
+        # None for the process' own (see set_client())
+        self.cwd = None
+        self.env = None
+        self.stdin = None
+        self.stdout = None
+        self.tmux_args = ['tmux']
+        if socket:
+            self.tmux_args += ['-S' if '/' in socket else '-L', socket]
+        self.tmux_str = ' '.join(shlex.quote(arg) for arg in self.tmux_args)
+        self.tracer = tracer
+        self.timings = timings
+        self.archive_db = archive
+        self.archive_dict = {}
+        self.sequence_last = None
+        # The last shell command, which a PAUSE waits on
+        self.shell_last = None
+        # The live sessions, windows and panes once read by snapshot()
+        self.state_dict = None
+        # The callback that answers the prompts instead of stdin, if any
+        self.on_input = None
+        # The event loop of PetMux.run_async, if running
+        self.loop = None
+        # Set by cancel(), which also calls the wakers of the waits in progress
+        self.cancel_event = threading.Event()
+        self.waker_set = set()
+        # Set by interrupt(), which ends the EXTRACT and WAIT_FOR in progress
+        self.interrupt_event = threading.Event()
+
+    def _cmd(self, cmd, delay=0, check_output=False, defer=False):
+        """
+        Sends a tmux command
+
+        :param      cmd:           The tmux command line
+        :type       cmd:           str
+        :param      delay:         The delay [in S] before sending the command
+        :type       delay:         number
+        :param      check_output:  Indicates if the output is returned
+        :type       check_output:  boolean
+        :param      defer:         Indicates if the command can be queued in
+                                   batch mode (i.e. its result is not needed)
+        :type       defer:         boolean
+
+        :returns:   The return code or the output if check_output
+        :rtype:     int or bytes
+        """
+        self.check()
+        delay = delay if delay else self.cmd_delay
+        if self.is_debug:
+            print("    tmux{}> {}".format( "(dly:{})".format(delay) if delay else "", cmd), file=self.stdout)
+        if defer and self.is_batch:
+            if delay:
+                # Commands queued before the delay must run before it
+                self.flush()
+                self.sleep(delay)
+            return self._queue(cmd)
+        # The result is needed, so send any queued commands first
+        self.flush()
+        if delay:
+            self.sleep(delay)
+        # Send the tmux command
+        with self.trace(cmd.split(' ', 1)[0], 'tmux', cmd=cmd) as trace_args:
+            try:
+                result = self._send(cmd, check_output)
+            except subprocess.CalledProcessError as e:
+                trace_args['rc'] = e.returncode
+                raise
+            trace_args['rc'] = 0 if check_output else result
+        return result
+
+    def _send(self, cmd, check_output=False):
+        """
+        Sends a tmux command over the control mode connection or with a tmux
+        process
+
+        :param      cmd:           The tmux command line
+        :type       cmd:           str
+        :param      check_output:  Indicates if the output is returned
+        :type       check_output:  boolean
+
+        :returns:   The return code or the output if check_output
+        :rtype:     int or bytes
+        """
+        if self.is_control:
+            reply = self._control_cmd([cmd])
+            reply = reply[0] if reply else None
+            if reply is not None:
+                is_error, lines = reply
+                if check_output:
+                    output = b''.join(line + b'\n' for line in lines)
+                    if is_error:
+                        raise subprocess.CalledProcessError(1, cmd, output)
+                    return output
+                if is_error and lines:
+                    print(b'\n'.join(lines).decode('utf-8', 'replace'), file=self.stdout)
+                return 1 if is_error else 0
+        if check_output:
+            return subprocess.check_output(self.tmux_args + shlex.split(cmd), cwd=self.cwd, env=self.env)
+        elif self.stdout is None:
+            return subprocess.call('{} {}'.format(self.tmux_str, cmd), shell=True, cwd=self.cwd, env=self.env)
+        else:
+            proc = subprocess.run('{} {}'.format(self.tmux_str, cmd), shell=True, cwd=self.cwd, env=self.env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            print(proc.stdout.decode('utf-8', 'replace'), end='', file=self.stdout)
+            return proc.returncode
+
+    def _queue(self, cmd):
+        """
+        Queues a command to be sent by the next flush
+
+        :param      cmd:  The tmux command line
+        :type       cmd:  str
+
+        :returns:   The return code
+        :rtype:     int
+        """
+        with self.queue_lock:
+            self.cmd_queue.append(cmd)
+            is_full = len(self.cmd_queue) >= self.batch_max or sum(len(cmd) for cmd in self.cmd_queue) >= self.batch_size
+        if is_full:
+            return self.flush()
+        return 0
+
+    def _control_open(self):
+        """
+        Starts the control mode connection if it isn't started yet
+
+        :returns:   True if the connection is usable
+        :rtype:     boolean
+        """
+        if self.is_control and self.control is None:
+            try:
+                self.control = TmuxControl(self.session_last, self.tmux_args, self.cwd, self.env)
+            except OSError as e:
+                print("{}Warning: {}, using a tmux process per command{}".format(RED, e, NON), file=self.stdout)
+                self.is_control = False
+        return self.control is not None
+
+    def _control_cmd(self, cmd_list):
+        """
+        Sends the commands over the control mode connection, starting it on
+        first use.  Falls back to a tmux process per command on failure.
+
+        :param      cmd_list:  The tmux command lines
+        :type       cmd_list:  list(str)
+
+        :returns:   The control mode replies or None if unavailable
+        :rtype:     list(tuple(boolean, list(bytes)))
+        """
+        if not self._control_open():
+            return None
+        reply_list = self.control.pipeline(cmd_list)
+        if None in reply_list:
+            print("{}Warning: tmux control mode connection lost{}".format(RED, NON), file=self.stdout)
+            self.control.close()
+            self.control = None
+            self.is_control = False
+        return reply_list
+
+    def flush(self):
+        """
+        Sends the queued commands.  Over control mode each command is pipelined
+        as its own line, otherwise the commands are chained with ';' into one
+        tmux invocation (see _send_chain).
+
+        :returns:   The return code
+        :rtype:     int
+        """
+        with self.queue_lock:
+            cmd_list = self.cmd_queue[:]
+            del self.cmd_queue[:]
+        if not cmd_list:
+            return 0
+        with self.trace('flush', 'tmux', cmd=cmd_list) as trace_args:
+            trace_args['rc'] = self._send_batch(cmd_list)
+        return trace_args['rc']
+
+    def _send_batch(self, cmd_list):
+        """
+        Sends the commands as one batch
+
+        :param      cmd_list:  The tmux command lines
+        :type       cmd_list:  list(str)
+
+        :returns:   The return code
+        :rtype:     int
+        """
+        if self.is_control:
+            reply_list = self._control_cmd(cmd_list)
+            if reply_list is not None:
+                result = 0
+                for cmd, reply in zip(cmd_list, reply_list):
+                    if reply is not None and reply[0]:
+                        print("{}: {}".format(cmd, b'\n'.join(reply[1]).decode('utf-8', 'replace')), file=self.stdout)
+                        result = 1
+                # The commands without a reply were lost with the connection,
+                # so they are sent again with a tmux process
+                cmd_list = [ cmd for cmd, reply in zip(cmd_list, reply_list) if reply is None ]
+                if not cmd_list:
+                    return result
+                return self._send_chain(cmd_list) or result
+        return self._send_chain(cmd_list)
+
+    def _send_chain(self, cmd_list):
+        """
+        Sends the commands chained with ';' in one tmux process.  tmux skips
+        the rest of a chain after a command fails, so each command is followed
+        by a marker and the commands after the one that failed are sent again.
+
+        :param      cmd_list:  The tmux command lines
+        :type       cmd_list:  list(str)
+
+        :returns:   The return code
+        :rtype:     int
+        """
+        mark = 'petmux-chain-{}-'.format(os.getpid())
+        result = 0
+        while cmd_list:
+            chain = ' \\; '.join('{} \\; display-message -p {}{}'.format(cmd, mark, idx) for idx, cmd in enumerate(cmd_list))
+            proc = subprocess.run('{} {}'.format(self.tmux_str, chain), shell=True, cwd=self.cwd, env=self.env,
+                                  stdout=subprocess.PIPE, stderr=None if self.stdout is None else subprocess.STDOUT)
+            done = 0
+            for line in proc.stdout.decode('utf-8', 'replace').splitlines(True):
+                if line.startswith(mark):
+                    done = int(line[len(mark):]) + 1
+                else:
+                    print(line, end='', file=self.stdout)
+            if not proc.returncode:
+                return result
+            result = proc.returncode
+            # Skip the command that failed
+            cmd_list = cmd_list[done + 1:]
+        return result
+
+    def trace(self, name, cat, **args):
+        """
+        Records a span with the sequence and pane if tracing
+
+        :param      name:  The span name
+        :type       name:  str
+        :param      cat:   The category
+        :type       cat:   str
+        :param      args:  The span arguments
+        :type       args:  dict
+
+        :returns:   The span context manager, which yields the arguments
+        :rtype:     context manager
+        """
+        if not self.tracer:
+            return contextlib.nullcontext(args)
+        args['sequence'] = self.sequence_last
+        args['pane'] = '{}:{}.{}'.format(self.session_last or '', self.window_last or '', self.pane_last)
+        return self.tracer.span(name, cat, **args)
+
+    def sleep(self, delay, cat='delay'):
+        """
+        Sleeps, recording the span if tracing
+
+        :param      delay:  The delay [in S]
+        :type       delay:  number
+        :param      cat:    The category (e.g. delay or pause)
+        :type       cat:    str
+        """
+        with self.trace('sleep', cat, delay=delay):
+            self._wait(delay)
+
+    def _wait(self, delay):
+        """
+        Waits for the delay, unless the run is cancelled
+
+        :param      delay:  The delay [in S]
+        :type       delay:  number
+        """
+        if self.cancel_event.wait(max(delay, 0)):
+            raise Tmux.Cancelled()
+
+    def check(self):
+        """
+        Raises Tmux.Cancelled if the run was cancelled
+        """
+        if self.cancel_event.is_set():
+            raise Tmux.Cancelled()
+
+    def cancel(self):
+        """
+        Cancels the run, from any thread.  The waits in progress end at once
+        and the next tmux command raises Tmux.Cancelled.
+        """
+        self.cancel_event.set()
+        for waker in list(self.waker_set):
+            waker()
+
+    def interrupt(self):
+        """
+        Ends the EXTRACT or WAIT_FOR of this instance in progress, from any
+        thread (e.g. when a trigger switches the sequence).  It stays set until
+        cleared by the caller, which then runs the next step.
+        """
+        self.interrupt_event.set()
+        for waker in list(self.waker_set):
+            waker()
+
+    def is_woken(self):
+        """
+        Indicates if the wait in progress was ended by cancel() or interrupt()
+
+        :returns:   True if the wait is to end
+        :rtype:     boolean
+        """
+        return self.cancel_event.is_set() or self.interrupt_event.is_set()
+
+    def input(self, prompt):
+        """
+        Reads the user's input, recording the span if tracing.  The on_input
+        callback answers instead of stdin, if set, and can be a coroutine
+        function, which is run on the loop of PetMux.run_async.
+
+        :param      prompt:  The prompt
+        :type       prompt:  str
+
+        :returns:   The user's response
+        :rtype:     str
+        """
+        with self.trace('input', 'input', prompt=prompt):
+            if not self.on_input:
+                if self.stdin is None:
+                    return input(prompt)
+                print(prompt, end='', file=self.stdout, flush=True)
+                return self.stdin.readline().rstrip('\n')
+            resp = self.on_input(PaneLogger.ANSI.sub('', prompt))
+            if inspect.isawaitable(resp):
+                if self.loop:
+                    resp = asyncio.run_coroutine_threadsafe(resp, self.loop).result()
+                else:
+                    resp = asyncio.run(resp)
+            return resp
+
+    def _timing_key(self, keyword, cmd):
+        """
+        Builds the timings history key of a command
+
+        :param      keyword:  The keyword (e.g. EXTRACT)
+        :type       keyword:  str
+        :param      cmd:      The command
+        :type       cmd:      str
+
+        :returns:   The sequence, pane, keyword and command
+        :rtype:     str
+        """
+        return '{}|{}.{}|{}|{}'.format(self.sequence_last, self.window_last, self.pane_last, keyword, cmd)
+
+    def wait_time(self, keyword, cmd, delay):
+        """
+        Gets how long to wait for a command, which is learned from the timings
+        history in adaptive mode
+
+        :param      keyword:  The keyword (e.g. EXTRACT)
+        :type       keyword:  str
+        :param      cmd:      The command
+        :type       cmd:      str
+        :param      delay:    The configured delay [in S]
+        :type       delay:    number
+
+        :returns:   The wait [in S]
+        :rtype:     number
+        """
+        if not self.timings:
+            return delay
+        wait = self.timings.wait(self._timing_key(keyword, cmd), delay)
+        if self.is_debug and wait != delay:
+            print("    {}(learned)> {:.3f}s instead of {}s".format(keyword.lower(), wait, delay), file=self.stdout)
+        return wait
+
+    def record_time(self, keyword, cmd, elapsed):
+        """
+        Records how long a command took in the timings history.  Only the
+        commands that completed or matched within their wait, learned or not,
+        are recorded, since a wait that timed out or was cut short would skew
+        the history.
+
+        :param      keyword:  The keyword (e.g. EXTRACT)
+        :type       keyword:  str
+        :param      cmd:      The command
+        :type       cmd:      str
+        :param      elapsed:  The time taken [in S]
+        :type       elapsed:  float
+        """
+        if self.timings:
+            self.timings.record(self._timing_key(keyword, cmd), elapsed)
+
+    def settle(self, delay):
+        """
+        Waits for the delay while watching the output of the last pane
+
+        :param      delay:  The delay [in S]
+        :type       delay:  number
+
+        :returns:   When the last output arrived [in S], 0 if none did
+        :rtype:     float
+        """
+        stream = PaneStream(self, self._get_pane_str(self.pane_last))
+        stream.open()
+        start = last = time.time()
+        try:
+            with self.trace('sleep', 'pause', delay=delay):
+                while time.time() - start < delay:
+                    if stream.read(delay - (time.time() - start)):
+                        last = time.time()
+                    self.check()
+        finally:
+            stream.close()
+        return last - start
+
+    def _batch(self, cmd_list):
+        """
+        Sends the commands in as few tmux invocations as possible, even when
+        not in batch mode
+
+        :param      cmd_list:  The tmux command lines
+        :type       cmd_list:  list(str)
+
+        :returns:   The return code
+        :rtype:     int
+        """
+        for cmd in cmd_list:
+            if self.is_debug:
+                print("    tmux> {}".format(cmd), file=self.stdout)
+            self._queue(cmd)
+        return self.flush()
+
+    def set_client(self, cwd=None, env=None, stdin=None, stdout=None):
+        """
+        Sets the working directory, environment and streams of the petmux
+        client that the commands are run for (e.g. a request of the daemon),
+        which are used instead of the process' own
+
+        :param      cwd:     The working directory of the relative file names
+        :type       cwd:     str
+        :param      env:     The environment of tmux (e.g. TMUX)
+        :type       env:     dict
+        :param      stdin:   The user's input
+        :type       stdin:   file
+        :param      stdout:  The output
+        :type       stdout:  file
+        """
+        self.cwd = cwd
+        self.env = env
+        self.stdin = stdin
+        self.stdout = stdout
+        # The client may be another tmux client
+        self.client_name = None
+
+    def _path(self, file):
+        """
+        Gets the path of a file name relative to the client's directory
+
+        :param      file:  The file name
+        :type       file:  str
+
+        :returns:   The path
+        :rtype:     str
+        """
+        if not file or not self.cwd:
+            return file
+        return os.path.join(self.cwd, os.path.expanduser(file))
+
+    def fork(self, is_queue=False):
+        """
+        Creates a tmux instance with its own pane selection and command delay,
+        that shares the connection, command queue and variables with this one.
+
+        :param      is_queue:  Indicates if it has its own command queue, so a
+                               flush doesn't send the commands of the others
+        :type       is_queue:  boolean
+
+        :returns:   The forked tmux instance
+        :rtype:     Tmux
+        """
+        self._control_open()
+        tmux = copy.copy(self)
+        tmux.interrupt_event = threading.Event()
+        if is_queue:
+            tmux.cmd_queue = []
+            tmux.queue_lock = threading.Lock()
+        return tmux
+
+    def close(self):
+        """
+        Stops logging, sends any queued commands and closes the control mode
+        connection if any
+        """
+        for handle, logger in self.logger_dict.values():
+            self.monitor.unwatch(handle)
+            logger.close()
+        self.logger_dict.clear()
+        for handle in self.archive_dict.values():
+            self.monitor.unwatch(handle)
+        self.archive_dict.clear()
+        self.monitor.close()
+        self.flush()
+        if self.control:
+            self.control.close()
+            self.control = None
+
+    def _get_window_str(self, window):
+        """
+        Builds the target string from the session and window.
+
+        :param      window:  The window name
+        :type       window:  str
+
+        :returns:   The window string.
+        :rtype:     str
+        """
+        return '{}:{}'.format(self.session_last, window) if self.session_last else window
+
+    def _get_pane_str(self, pane):
+        """
+        Builds the target string from the session, window and pane.
+
+        :param      pane:  The pane name
+        :type       pane:  string or int
+
+        :returns:   The pane string.
+        :rtype:     str
+        """
+        pane_str = '{}:'.format(self.session_last) if self.session_last else ''
+        pane_str += '{}.'.format(self.window_last) if self.window_last else ''
+        pane = self.window_dict[self.window_last][pane] if pane in self.window_dict[self.window_last] else pane
+        pane_str += '{}'.format(pane) if pane else ''
+        return pane_str
+
+    def name_pane(self, window, name, idx):
+        """
+        Associates the name with pane index into the window dictionary
+
+        :param      window:  The window name
+        :type       window:  str
+        :param      name:    The pane name
+        :type       name:    int
+        :param      idx:     The pane index
+        :type       idx:     int
+        """
+        if window in self.window_dict:
+            self.window_dict[window][name] = idx
+        else:
+            self.window_dict[window] = { name : idx }
+
+    def delay(self, delay):
+        """
+        Sets the per command delay for the group of SHELL commands (via
+        self.shell(...))
+
+        :param      delay:  The delay [in S]
+        :type       delay:  int
+        """
+        self.cmd_delay = delay
+
+    def set_env(self, key, value):
+        """
+        Sets the tmux environment variable and dictionary.  Templates that
+        depend on the variable are rendered again on their next use.
+
+        :param      key:    The new value
+        :type       key:    str
+        :param      value:  The value
+        :type       value:  str
+        """
+        self.set_var(key, value)
+        target = '-t {} '.format(self.session_last) if self.session_last else ''
+        cmd = "set-environment {}{} {}".format(target, key, shlex.quote(str(value)))
+        # NOTE: Only new panes see the tmux environment, so in batch mode it is
+        #       sent along with the next tmux command instead of by itself
+        self._cmd(cmd, defer=True)
+
+    def set_var(self, key, value):
+        """
+        Sets the variable for expanding the commands only, without the tmux
+        environment, so it is safe on the pane monitor's reader
+
+        :param      key:    The new value
+        :type       key:    str
+        :param      value:  The value
+        :type       value:  str
+        """
+        self.var_dict[key] = value
+        self.var_version[key] = self.var_version.get(key, 0) + 1
+
+    def get_env(self):
+        """
+        Gets the environment variable dictionary
+
+        :returns:   The environment.
+        :rtype:     dict
+        """
+        return self.var_dict
+
+    def expand(self, text):
+        """
+        Expands the variable by replacing any '${var}' with matching self.var_dict
+        (see Template)
+
+        :param      text:  The text
+        :type       text:  str
+
+        :returns:   expanded text
+        :rtype:     str
+        """
+        if text and type(text) is str:
+            text = Template.compile(text).render(self.var_dict, self.var_version)
+        return text
+
+
+    def kill(self, window):
+        """
+        Kill the window in the session
+
+        :param      window:  The window name
+        :type       window:  str
+        """
+        self._cmd('kill-window -t %s' % self._get_window_str(window))
+
+    def _user_client(self):
+        """
+        Finds the user's tmux client, so client commands (e.g. switch-client)
+        name it rather than act on the control mode client.  It is the client
+        of the session petmux runs in ($TMUX), else the last active one.
+
+        :returns:   The client name or None if no client is attached
+        :rtype:     str
+        """
+        if self.client_name is None:
+            fmt = '#{client_control_mode} #{client_activity} #{session_id} #{client_name}'
+            try:
+                output = self._cmd("list-clients -F '{}'".format(fmt), check_output=True)
+            except subprocess.CalledProcessError:
+                output = b''
+            field_list = [line.split(' ', 3) for line in output.decode('utf-8', 'replace').splitlines()]
+            field_list = [fields for fields in field_list if len(fields) == 4 and fields[0] == '0']
+            tmux_list = (self.env or os.environ).get('TMUX', '').split(',')
+            session_id = '$' + tmux_list[-1] if len(tmux_list) == 3 else None
+            field_list.sort(key=lambda fields: (fields[2] == session_id, int(fields[1]) if fields[1].isdigit() else 0))
+            if field_list:
+                self.client_name = field_list[-1][3]
+        return self.client_name
+
+    def session(self, session):
+        """
+        Selects a session.  If the session doesn't exist, then it will prompt to create a session
+
+        :param      session:  The session name
+        :type       session:  str
+        """
+        if session and self.is_detached:
+            # There is no client to switch, so just make sure the session exists
+            if self._cmd('has-session -t %s' % session):
+                print("Creating Session: {}".format(session), file=self.stdout)
+                self._cmd('new-session -d -s %s' % session)
+        elif session:
+            result = self._cmd('has-session -t %s' % session)
+            # If session failed to be selected, then create it
+            if result:
+                resp = self.input("Session {} doesn't exist, Create[Y/n]? ")
+                if resp == 'Y' or resp == '':
+                    print("Creating Session: {}".format(session), file=self.stdout)
+                    self._cmd('new-session -t %s' % session)
+            # select the session
+            client = self._user_client()
+            if client:
+                self._cmd('switch-client -c {} -t {}'.format(shlex.quote(client), session))
+        self.session_last = session
+
+    def window(self, window):
+        """
+        Selects a window.  If the window doesn't exist, then it shall create one
+
+        :param      window:  The window name
+        :type       window:  str
+        """
+        if self.is_debug:
+            print("{}[ window: {} ]{}".format(BLU, window, NON), file=self.stdout)
+        if self.state_dict is not None and self.session_last:
+            # The snapshot tells if the window exists, so it isn't probed
+            result = window not in self.state_dict.get(self.session_last, {})
+            if not result:
+                self._cmd('select-window -t %s' % self._get_window_str(window), defer=True)
+        else:
+            result = self._cmd('select-window -t %s' % self._get_window_str(window))
+        # If window failed to be selected, then create it
+        if result:
+            print("Creating window: {}".format(window), file=self.stdout)
+            if self.session_last:
+                self._cmd('new-window -t %s: -n %s' % (self.session_last, window), defer=True)
+                if self.state_dict is not None:
+                    self.state_dict.setdefault(self.session_last, {})[window] = [1]
+            else:
+                # NOTE: Named as it is created, so sequences run concurrently
+                #       don't rename each other's windows
+                self._cmd('new-window -n %s' % window, defer=True)
+        self.window_last = window
+
+    def pane(self, pane):
+        """
+        Selects the tmux pane to be used by shell, capture and extract
+
+        :param      pane:  The pane name or number
+        :type       pane:  str or int
+        """
+        if self.is_debug:
+            print("{}[ {} ]{}".format(CYN, pane, NON), file=self.stdout)
+        pane = self.window_dict[self.window_last][pane] if pane in self.window_dict[self.window_last] else pane
+        self.pane_last = pane
+
+    def focus(self, pane):
+        """
+        Selects the tmux pane for user input focus
+
+        :param      pane:  The pane name or number
+        :type       pane:  str or int
+        """
+        self.pane(pane)
+        if type(self.pane_last) == int:
+            self._cmd('select-pane -t %s' % self._get_pane_str(self.pane_last), defer=True)
+        else:
+            print("Error: Unknown pane {}".format(self.pane_last), file=self.stdout)
+
+    def split(self, options):
+        """
+        Splits a tmux window
+
+        :param      options:  The tmux split options
+        :type       options:  str
+        """
+        target = '-t {} '.format(self._get_window_str(self.window_last)) if self.window_last else ''
+        self._cmd('split-window %s%s' % (target, options if options else ""), defer=True)
+
+    def layout(self, layout, pane_list):
+        """
+        Creates all of the panes of the last window in one batch of tmux
+        commands and then arranges them with a single select-layout.  A pane
+        with EXEC is started with its command instead of a shell.
+
+        :param      layout:     The tmux layout name (e.g. tiled, even-vertical)
+                                or a layout string from #{window_layout}
+        :type       layout:     str
+        :param      pane_list:  The keywords of each pane
+        :type       pane_list:  list(dict)
+        """
+        window_str = self._get_window_str(self.window_last)
+        return self._batch(self._pane_cmds(window_str, pane_list, 0, layout))
+
+    def _pane_cmds(self, window_str, pane_list, pane_cnt, layout=None):
+        """
+        Builds the commands that add the panes after the existing ones, by
+        splitting the last pane so each new pane gets the next index.  A pane
+        with EXEC is started with its command instead of a shell.
+
+        :param      window_str:  The window target string
+        :type       window_str:  str
+        :param      pane_list:   The keywords of each pane
+        :type       pane_list:   list(dict)
+        :param      pane_cnt:    The number of panes that already exist, where
+                                 0 is a new window (i.e. only its first pane)
+        :type       pane_cnt:    int
+        :param      layout:      The tmux layout name or layout string, if any
+        :type       layout:      str
+
+        :returns:   The tmux command lines
+        :rtype:     list(str)
+        """
+        cmd_list = []
+        for idx, cmd_dict in enumerate(pane_list[pane_cnt:], pane_cnt + 1):
+            exec_cmd = cmd_dict.get('EXEC')
+            exec_str = shlex.quote(self.expand(exec_cmd)) if exec_cmd and not self.is_dryrun else ''
+            if idx == 1:
+                if exec_str:
+                    cmd_list.append('respawn-pane -k -t {}.{} {}'.format(window_str, idx, exec_str))
+                continue
+            split_list = ['split-window -d -t {}.{}'.format(window_str, idx - 1), cmd_dict.get('SPLIT'), exec_str]
+            cmd_list.append(' '.join(arg for arg in split_list if arg))
+            if layout:
+                # NOTE: Spread the panes out on the server, so the next split has room
+                cmd_list.append('select-layout -t {} tiled'.format(window_str))
+        if layout:
+            cmd_list.append('select-layout -t {} {}'.format(window_str, layout))
+        if self.is_dryrun:
+            for idx, cmd_dict in enumerate(pane_list[pane_cnt:], pane_cnt + 1):
+                if cmd_dict.get('EXEC'):
+                    cmd_str = shlex.quote('echo ' + shlex.quote(self.expand(cmd_dict['EXEC'])))
+                    cmd_list.append('send-keys -t {}.{} {} C-m'.format(window_str, idx, cmd_str))
+        return cmd_list
+
+    def snapshot(self):
+        """
+        Reads the live sessions, windows and panes of the tmux server with a
+        single list-panes command
+
+        :returns:   The pane indices by window name by session name
+        :rtype:     dict(str, dict(str, list(int)))
+        """
+        fmt = '#{session_id}\t#{session_name}\t#{session_last_attached}\t#{window_index}\t#{window_name}\t#{pane_index}'
+        try:
+            output = self._cmd("list-panes -a -F '{}'".format(fmt), check_output=True).decode('utf-8', 'replace')
+        except subprocess.CalledProcessError:
+            # No server running
+            output = ''
+        self.state_dict = {}
+        self.session_id_dict = {}
+        self.attached_dict = {}
+        window_idx_dict = {}
+        for line in output.splitlines():
+            field_list = line.split('\t')
+            if len(field_list) != 6:
+                continue
+            session_id, session, attached, window_idx, window, pane_idx = field_list
+            self.session_id_dict[session_id] = session
+            self.attached_dict[session] = int(attached or 0)
+            # NOTE: Only the first of the windows with the same name is used
+            if window_idx_dict.setdefault((session, window), window_idx) == window_idx:
+                self.state_dict.setdefault(session, {}).setdefault(window, []).append(int(pane_idx))
+        return self.state_dict
+
+    def _find_session(self, session=None):
+        """
+        Finds the session to reconcile from the snapshot.  Without a session
+        name, it is the session of this tmux client or the last attached one.
+
+        :param      session:  The session name
+        :type       session:  str
+
+        :returns:   The session name
+        :rtype:     str
+        """
+        if self.state_dict is None:
+            self.snapshot()
+        session = session or self.session_last
+        if not session:
+            session_id = '${}'.format((self.env or os.environ).get('TMUX', '').rpartition(',')[2])
+            session = self.session_id_dict.get(session_id)
+        if not session and self.attached_dict:
+            session = max(self.attached_dict, key=self.attached_dict.get)
+        return session or 'petmux'
+
+    def reconcile(self, session, window, pane_list, layout=None, restart_list=()):
+        """
+        Converges the window to the panes with one batch of tmux commands.  The
+        live state is taken from the snapshot, so only the missing session,
+        window and panes are created, the extra panes are killed and the
+        existing panes of the restart list are restarted.
+
+        :param      session:    The session name, None for the current one
+        :type       session:    str
+        :param      window:     The window name
+        :type       window:     str
+        :param      pane_list:  The keywords of each pane
+        :type       pane_list:  list(dict)
+        :param      layout:     The tmux layout name or layout string, if any
+        :type       layout:     str
+        :param      restart_list:  The numbers of the panes to restart with a
+                                   new shell or their EXEC
+        :type       restart_list:  list(int)
+
+        :returns:   The number of panes that already existed
+        :rtype:     int
+        """
+        session = self._find_session(session)
+        self.session_last = session
+        self.window_last = window
+        window_str = self._get_window_str(window)
+        cmd_list = []
+        if session not in self.state_dict:
+            print("Creating Session: {}".format(session), file=self.stdout)
+            cmd_list.append('new-session -d -s {} -n {}'.format(session, window))
+        elif window not in self.state_dict[session]:
+            print("Creating window: {}".format(window), file=self.stdout)
+            cmd_list.append('new-window -d -t {}: -n {}'.format(session, window))
+        pane_idx_list = sorted(self.state_dict.get(session, {}).get(window, []))
+        # Kill the extra panes from the last, so the indices don't shift
+        for pane_idx in reversed(pane_idx_list[len(pane_list):]):
+            cmd_list.append('kill-pane -t {}.{}'.format(window_str, pane_idx))
+        pane_cnt = min(len(pane_idx_list), len(pane_list))
+        for idx in restart_list:
+            if idx <= pane_cnt:
+                exec_cmd = pane_list[idx - 1].get('EXEC')
+                exec_str = ' ' + shlex.quote(self.expand(exec_cmd)) if exec_cmd and not self.is_dryrun else ''
+                cmd_list.append('respawn-pane -k -t {}.{}{}'.format(window_str, idx, exec_str))
+        cmd_list += self._pane_cmds(window_str, pane_list, pane_cnt, layout)
+        cmd_list.append('select-window -t {}'.format(window_str))
+        client = None if self.is_detached else self._user_client()
+        if client:
+            cmd_list.append('switch-client -c {} -t {}'.format(shlex.quote(client), session))
+        if self.is_debug:
+            print("{}[ reconcile: {} has {} of {} panes ]{}".format(BLU, window_str, pane_cnt, len(pane_list), NON), file=self.stdout)
+        self._batch(cmd_list)
+        self.state_dict.setdefault(session, {})[window] = list(range(1, len(pane_list) + 1))
+        return pane_cnt
+
+    def kill_windows(self, session, window_list):
+        """
+        Kills the windows that exist in the snapshot with one batch of tmux
+        commands
+
+        :param      session:      The session name, None for the current one
+        :type       session:      str
+        :param      window_list:  The window names
+        :type       window_list:  list(str)
+        """
+        session = self._find_session(session)
+        window_dict = self.state_dict.get(session, {})
+        cmd_list = []
+        for window in window_list:
+            if window in window_dict:
+                cmd_list.append('kill-window -t {}:{}'.format(session, window))
+                del window_dict[window]
+        if not window_dict:
+            # tmux destroys the session with its last window
+            self.state_dict.pop(session, None)
+        if cmd_list:
+            self._batch(cmd_list)
+
+    def respawn(self, cmd, pane=None):
+        """
+        Restarts the last pane with the command running in place of the shell
+
+        :param      cmd:   The command string
+        :type       cmd:   str
+        :param      pane:  target pane
+        :type       pane:  str
+        """
+        if pane:
+            self.pane(pane)
+        pane_str = self._get_pane_str(self.pane_last)
+        cmd = self.expand(cmd)
+        if self.is_dryrun:
+            self._cmd('send-keys -t {} {} C-m'.format(pane_str, shlex.quote('echo ' + shlex.quote(cmd))), defer=True)
+        else:
+            self._cmd('respawn-pane -k -t {} {}'.format(pane_str, shlex.quote(cmd)), defer=True)
+        # Clear the command delay set by self.delay()
+        self.cmd_delay = 0
+
+    def shell(self, cmd, pane=None):
+        """
+        Sends a shell command or list of shell commands to the last pane
+
+        :param      cmd:   The command string
+        :type       cmd:   str
+        :param      pane:  target pane
+        :type       pane:  str
+        """
+        if pane:
+            self.pane(pane)
+        cmd_list = cmd if type(cmd) == list else [cmd]
+        if cmd_list:
+            self.shell_last = cmd_list[-1]
+        for cmd in cmd_list:
+            pane_str = self._get_pane_str(self.pane_last)
+            # Expand any '${variables}' in the cmd string
+            cmd = self.expand(cmd)
+            # NOTE: triple quote required to prevent globbing of environment variables
+            if self.is_dryrun:
+                self._cmd("""send-keys "echo -t {} \'{}\'" C-m""".format(pane_str, cmd), defer=True)
+            else:
+                self._cmd("""send-keys -t {} '{}' C-m""".format(pane_str, cmd), defer=True)
+        # Clear the command delay set by self.delay()
+        self.cmd_delay = 0
+
+    def paste(self, text, pane=None):
+        """
+        Pastes text into the last pane as is, so it needs no quoting (e.g. a
+        heredoc or a snippet for a REPL).  The text is a string, a list of lines
+        or a dictionary with TEXT and BRACKETED (use bracketed paste if the
+        application asked for it).
+
+        :param      text:  The text or paste options
+        :type       text:  str or list(str) or dict
+        :param      pane:  target pane
+        :type       pane:  str
+        """
+        if pane:
+            self.pane(pane)
+        option_dict = text if type(text) is dict else {'TEXT': text}
+        text = option_dict.get('TEXT') or ''
+        if type(text) is list:
+            text = ''.join('{}\n'.format(line) for line in text)
+        text = self.expand('{}'.format(text))
+        if self.is_dryrun:
+            self.shell(text.splitlines())
+            return
+        self._paste(self._get_pane_str(self.pane_last), text, None, option_dict.get('BRACKETED', False))
+        # Clear the command delay set by self.delay()
+        self.cmd_delay = 0
+
+    def script(self, file, pane=None):
+        """
+        Pastes the contents of a file into the last pane as is.  The file is
+        loaded into the tmux buffer directly, so it isn't read by petmux.  The
+        file can also be a dictionary with FILE and BRACKETED.
+
+        :param      file:  The file name or script options
+        :type       file:  str or dict
+        :param      pane:  target pane
+        :type       pane:  str
+        """
+        if pane:
+            self.pane(pane)
+        option_dict = file if type(file) is dict else {'FILE': file}
+        file = self._path(self.expand(option_dict.get('FILE') or ''))
+        if not os.path.isfile(file):
+            print("{}No script file {}{}".format(RED, file, NON), file=self.stdout)
+            return
+        if self.is_dryrun:
+            with open(file) as fobj:
+                self.shell(fobj.read().splitlines())
+            return
+        self._paste(self._get_pane_str(self.pane_last), None, file, option_dict.get('BRACKETED', False))
+        # Clear the command delay set by self.delay()
+        self.cmd_delay = 0
+
+    def _paste(self, pane_str, text=None, file=None, bracketed=False):
+        """
+        Loads text or a file into a tmux buffer and pastes it into a pane in
+        one round-trip.  Text is streamed to load-buffer on stdin, except over
+        control mode, where it goes through a temporary file.
+
+        :param      pane_str:   The target pane string
+        :type       pane_str:   str
+        :param      text:       The text, if not a file
+        :type       text:       str
+        :param      file:       The file name, if not text
+        :type       file:       str
+        :param      bracketed:  Indicates if bracketed paste is used
+        :type       bracketed:  boolean
+
+        :returns:   The return code
+        :rtype:     int
+        """
+        buffer = 'petmux_paste_{}_{}'.format(os.getpid(), next(self.wait_cnt))
+        load_cmd = 'load-buffer -b {} {}'.format(buffer, shlex.quote(os.path.abspath(file)) if file else '-')
+        paste_cmd = 'paste-buffer -d{} -b {} -t {}'.format('p' if bracketed else '', buffer, pane_str)
+        if self.is_debug:
+            print("    tmux> {}{}".format(load_cmd, '' if file else ' ({} bytes)'.format(len(text))), file=self.stdout)
+            print("    tmux> {}".format(paste_cmd), file=self.stdout)
+        # The buffer is loaded outside of the queue, so send the queued commands first
+        self.flush()
+        if self.cmd_delay:
+            self.sleep(self.cmd_delay)
+        with self.trace('paste-buffer', 'tmux', cmd=load_cmd) as trace_args:
+            if file is None and not self.is_control:
+                args = self.tmux_args + shlex.split(load_cmd) + [';'] + shlex.split(paste_cmd)
+                result = subprocess.run(args, input=text.encode('utf-8'), cwd=self.cwd, env=self.env).returncode
+            else:
+                with contextlib.ExitStack() as stack:
+                    if file is None:
+                        # NOTE: The control mode client's stdin is its command channel
+                        fobj = stack.enter_context(tempfile.NamedTemporaryFile(prefix='petmux-paste-'))
+                        fobj.write(text.encode('utf-8'))
+                        fobj.flush()
+                        load_cmd = 'load-buffer -b {} {}'.format(buffer, shlex.quote(fobj.name))
+                    result = self._send_batch([load_cmd, paste_cmd])
+            trace_args['rc'] = result
+        return result
+
+    def wait_for(self, cmd_var_timeout):
+        """
+        Sends a shell command to the last pane and waits for it to complete.
+        The command line signals a tmux wait-for channel when it is done and
+        hands back its exit status through a tmux buffer.
+
+        :param      cmd_var_timeout:  The command, optional variable for the exit
+                                      status and optional timeout [in S]
+        :type       cmd_var_timeout:  str or list(str, str, number)
+        """
+        cmd_list = cmd_var_timeout if type(cmd_var_timeout) == list else [cmd_var_timeout]
+        wait = self._wait_send(cmd_list)
+        if wait is None:
+            return
+        channel, timeout, start = wait
+        waker = self._wait_waker(channel)
+        self.waker_set.add(waker)
+        try:
+            with self.trace('wait-for', 'wait_for', cmd=cmd_list[0], timeout=timeout):
+                subprocess.run(self.tmux_args + ['wait-for', channel], timeout=timeout, cwd=self.cwd, env=self.env)
+        except subprocess.TimeoutExpired:
+            self._wait_timeout(cmd_list, channel)
+            return
+        finally:
+            self.waker_set.discard(waker)
+        if self.is_woken():
+            self._wait_cleanup(channel)
+            self.check()
+            return
+        self._wait_status(cmd_list, channel, start)
+
+    def _wait_waker(self, channel):
+        """
+        Builds the waker of a WAIT_FOR, which signals its channel to end the
+        wait when this instance is cancelled or interrupted.  The signal is
+        sent from a process that isn't waited for, so the waker doesn't block.
+
+        :param      channel:  The wait-for channel
+        :type       channel:  str
+
+        :returns:   The waker
+        :rtype:     callable
+        """
+        return lambda: self.is_woken() and subprocess.Popen(self.tmux_args + ['wait-for', '-S', channel], cwd=self.cwd, env=self.env)
+
+    def _wait_send(self, cmd_list):
+        """
+        Sends the shell command of a WAIT_FOR to the last pane (see wait_for)
+
+        :param      cmd_list:  The command, optional variable for the exit
+                               status and optional timeout [in S]
+        :type       cmd_list:  list
+
+        :returns:   The wait-for channel, timeout and start time or None in a
+                    dry run
+        :rtype:     tuple(str, float, float)
+        """
+        # NOTE: The timeout isn't learned, since the wait ends as soon as the
+        #       command completes, so a shorter one would only add timeouts
+        timeout = float(cmd_list[2]) if len(cmd_list) > 2 else 60
+        channel = 'petmux_{}_{}'.format(os.getpid(), next(self.wait_cnt))
+        cmd = '{}; tmux set-buffer -b {} "$?"; tmux wait-for -S {}'.format(cmd_list[0], channel, channel)
+        if self.is_dryrun:
+            pane_str = self._get_pane_str(self.pane_last)
+            self._cmd('send-keys -t {} {} C-m'.format(pane_str, shlex.quote('echo ' + shlex.quote(self.expand(cmd)))), defer=True)
+            return None
+        start = time.time()
+        self.shell(cmd)
+        self.flush()
+        if self.is_debug:
+            print("    tmux(timeout:{})> wait-for {}".format(timeout, channel), file=self.stdout)
+        return channel, timeout, start
+
+    def _wait_timeout(self, cmd_list, channel):
+        """
+        Reports a WAIT_FOR timeout and sets its variable to TIMEOUT
+
+        :param      cmd_list:  The command, optional variable and timeout
+        :type       cmd_list:  list
+        :param      channel:   The wait-for channel
+        :type       channel:   str
+        """
+        print("{}Timeout waiting for: {}{}".format(RED, cmd_list[0], NON), file=self.stdout)
+        self._wait_cleanup(channel)
+        if len(cmd_list) > 1:
+            self.set_env(cmd_list[1], 'TIMEOUT')
+
+    def _wait_status(self, cmd_list, channel, start):
+        """
+        Records the time of a completed WAIT_FOR and sets its variable to the
+        exit status of the command
+
+        :param      cmd_list:  The command, optional variable and timeout
+        :type       cmd_list:  list
+        :param      channel:   The wait-for channel
+        :type       channel:   str
+        :param      start:     The time the command was sent
+        :type       start:     float
+        """
+        self.record_time('WAIT_FOR', cmd_list[0], time.time() - start)
+        try:
+            status = self._cmd('show-buffer -b {}'.format(channel), check_output=True).decode('utf-8').strip()
+            self._cmd('delete-buffer -b {}'.format(channel), defer=True)
+        except subprocess.CalledProcessError:
+            status = ''
+        if len(cmd_list) > 1:
+            self.set_env(cmd_list[1], status)
+
+    def _wait_cleanup(self, channel):
+        """
+        Deletes the exit status buffer of a WAIT_FOR command that is still
+        running, once it completes, with a tmux background job
+
+        :param      channel:  The wait-for channel and buffer name
+        :type       channel:  str
+        """
+        script = '{0} wait-for {1}; {0} delete-buffer -b {1}'.format(self.tmux_str, channel)
+        # NOTE: Sent directly, since the run may have been cancelled
+        self._send('run-shell -b {}'.format(shlex.quote(script)))
+
+    def capture(self, file=None):
+        """
+        Captures the last pane to a file or screen.  The file can also be a
+        dictionary with FILE, INCREMENTAL (only capture the lines added since
+        the last capture of the pane) and COMPRESS (gzip or zstd, by default
+        from the .gz or .zst file extension).  The pane is captured to a spool
+        file by the tmux server and copied from there in chunks, so a large
+        history isn't held in memory.
+
+        :param      file:  The name of capture file to save or capture options
+        :type       file:  str or dict
+
+        :returns:   The end of the pane contents, up to max_output bytes
+        :rtype:     bytes
+        """
+        pane_str = self._get_pane_str(self.pane_last)
+        option_dict = file if type(file) is dict else {'FILE': file}
+        file = self._path(self.expand(option_dict.get('FILE')))
+        compress = option_dict.get('COMPRESS')
+        if file and compress is None:
+            compress = 'gzip' if file.endswith('.gz') else 'zstd' if file.endswith('.zst') else None
+        is_archived = False
+        if option_dict.get('INCREMENTAL'):
+            # NOTE: While the archive is at the same position as the captures,
+            #       it takes the same lines
+            is_archived = bool(self.archive_db) and self.archived_dict.get(pane_str) == self.capture_dict.get(pane_str)
+            spool, start = self._capture_delta(pane_str)
+            if is_archived:
+                self.archived_dict[pane_str] = self.capture_dict.get(pane_str)
+        elif file and not compress and not self.archive_db:
+            # Capture pane contents, preserve line feeds
+            self._cmd('capture-pane -J -t {} -b {}'.format(pane_str, self.pane_last))
+            # Append to the save buffer
+            self._cmd('save-buffer -a -b {} {}'.format(self.pane_last, file), defer=True)
+            return None
+        else:
+            spool, start = self._capture_spool(pane_str), 0
+        if self.archive_db and not is_archived:
+            self._archive_delta(pane_str)
+        if not spool:
+            return None if file else b''
+        try:
+            with open(spool, 'rb') as fobj:
+                if is_archived:
+                    fobj.seek(start)
+                    self._archive_file(fobj)
+                fobj.seek(start)
+                if file:
+                    Tmux._write_segment(file, fobj, compress)
+                    return None
+                if self.is_debug:
+                    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+                    for chunk in iter(lambda: fobj.read(65536), b''):
+                        print(decoder.decode(chunk), end='', file=self.stdout)
+                    print(decoder.decode(b'', True), file=self.stdout)
+                # Only the end of the capture is kept in memory
+                fobj.seek(max(start, os.fstat(fobj.fileno()).st_size - self.max_output))
+                return fobj.read()
+        finally:
+            os.unlink(spool)
+
+    def _capture_spool(self, pane_str, option=''):
+        """
+        Captures a pane to a spool file, which is written by the tmux server
+        through a paste buffer rather than passed through petmux
+
+        :param      pane_str:  The target pane string
+        :type       pane_str:  str
+        :param      option:    The capture-pane options (e.g. -S and -E)
+        :type       option:    str
+
+        :returns:   The spool file name, which the caller removes
+        :rtype:     str
+        """
+        fd, spool = tempfile.mkstemp(prefix='petmux-capture-')
+        os.close(fd)
+        buffer = 'petmux-capture-{}-{}'.format(os.getpid(), next(self.wait_cnt))
+        try:
+            self._cmd('capture-pane -J -t {} {}-b {}'.format(pane_str, option + ' ' if option else '', buffer), defer=True)
+            self._cmd('save-buffer -b {} {}'.format(buffer, spool))
+            self._cmd('delete-buffer -b {}'.format(buffer), defer=True)
+        except Exception:
+            os.unlink(spool)
+            raise
+        return spool
+
+    def _archive_delta(self, pane_str):
+        """
+        Archives the lines of a pane that were added since it was last
+        archived, so a capture doesn't archive the same lines again
+
+        :param      pane_str:  The target pane string
+        :type       pane_str:  str
+        """
+        spool, start = self._capture_delta(pane_str, self.archived_dict)
+        if not spool:
+            return
+        try:
+            with open(spool, 'rb') as fobj:
+                fobj.seek(start)
+                self._archive_file(fobj)
+        finally:
+            os.unlink(spool)
+
+    def _archive_file(self, fobj):
+        """
+        Archives the lines of a capture of the last pane, read from its
+        current position
+
+        :param      fobj:  The capture
+        :type       fobj:  io.BufferedReader
+        """
+        session, window, pane = self._archive_key(self.pane_last)
+        self.archive_db.write_file((session, self.sequence_last or '', window, pane), fobj)
+
+    def _capture_delta(self, pane_str, position_dict=None):
+        """
+        Captures the lines of a pane that were added since its last capture.
+        The position is tracked as the line number of the cursor from the top
+        of the history.  Once the history is full, lines drop off the top, so
+        the new lines are found after the last lines of the previous capture.
+
+        :param      pane_str:       The target pane string
+        :type       pane_str:       str
+        :param      position_dict:  The positions of the panes, by default the
+                                    ones of the INCREMENTAL captures
+        :type       position_dict:  dict
+
+        :returns:   The spool file (None if no lines were added) and the offset
+                    of the added lines in it
+        :rtype:     tuple(str, int)
+        """
+        info = self._cmd("display-message -p -t {} '#{{history_size}} #{{history_limit}} #{{cursor_y}}'".format(pane_str), check_output=True).split()
+        if len(info) != 3:
+            return None, 0
+        history_size, history_limit, cursor_y = [ int(value) for value in info ]
+        line_end = history_size + cursor_y
+        position_dict = self.capture_dict if position_dict is None else position_dict
+        line_last, tail_list = position_dict.get(pane_str, (0, None))
+        is_full = history_size >= history_limit
+        if is_full or line_last <= 0:
+            start = '-'
+        elif line_end < line_last:
+            # The screen was cleared, so start from the top of the screen
+            start = 0
+        else:
+            start = line_last - history_size
+        # NOTE: The cursor line is left for the next capture, since it may be incomplete
+        if start != '-' and start > cursor_y - 1:
+            position_dict[pane_str] = (line_end, tail_list)
+            return None, 0
+        spool = self._capture_spool(pane_str, '-S {} -E {}'.format(start, cursor_y - 1))
+        # Find where the previous capture ended (i.e. after the last match of
+        # its last lines) and the last lines of this capture, a line at a time
+        offset = 0
+        window = collections.deque(maxlen=len(tail_list) if is_full and tail_list else 1)
+        last_list = collections.deque(maxlen=3)
+        pos = 0
+        with open(spool, 'rb') as fobj:
+            for line in fobj:
+                pos += len(line)
+                window.append(line)
+                last_list.append((pos, line))
+                if is_full and tail_list and list(window) == tail_list:
+                    offset = pos
+        line_list = [ line for end, line in last_list if end - len(line) >= offset ]
+        if line_list or start == '-':
+            position_dict[pane_str] = (line_end, (line_list if line_list else tail_list))
+        return spool, offset
+
+    @staticmethod
+    def _write_segment(file, fobj, compress=None):
+        """
+        Appends a segment to the capture file, copying it in chunks.
+        Compressed segments are appended as separate gzip members or zstd
+        frames, which decompress as one stream.
+
+        :param      file:      The file name
+        :type       file:      str
+        :param      fobj:      The segment, read from its current position
+        :type       fobj:      io.BufferedReader
+        :param      compress:  None, gzip or zstd
+        :type       compress:  str
+        """
+        if not fobj.peek(1):
+            return
+        if compress == 'zstd':
+            try:
+                import zstandard
+                with open(file, 'ab') as out:
+                    zstandard.ZstdCompressor().copy_stream(fobj, out)
+                return
+            except ImportError:
+                # NOTE: gzip data is never written to a .zst file, which zstd
+                #       couldn't read, so the file name is changed to .gz
+                file = (file[:-len('.zst')] if file.endswith('.zst') else file) + '.gz'
+                print("{}Warning: zstandard is not installed, capturing to {} with gzip{}".format(RED, file, NON))
+                compress = 'gzip'
+        with (gzip.open(file, 'ab') if compress == 'gzip' else open(file, 'ab')) as out:
+            shutil.copyfileobj(fobj, out)
+
+    def log(self, option):
+        """
+        Starts or stops logging the output of panes.  The option is a file name
+        for the last pane, OFF to stop all logging or a dictionary with PANES
+        (the panes to log, default is the last pane), FILE (may use ${PANE}),
+        MAX_SIZE [in bytes], ROTATE [in S], KEEP, COMPRESS (gzip or none),
+        TIMESTAMP, STRIP (ANSI escape sequences) and STOP.
+
+        :param      option:  The log option
+        :type       option:  str or dict
+        """
+        option_dict = option if type(option) is dict else {'FILE': option}
+        pane_list = option_dict.get('PANES', [self.pane_last])
+        pane_list = pane_list if type(pane_list) is list else [pane_list]
+        if option_dict.get('STOP') or option_dict.get('FILE') in ('OFF', False):
+            pane_list = list(self.logger_dict.keys()) if 'PANES' not in option_dict else [ self._get_pane_str(pane) for pane in pane_list ]
+            for pane_str in pane_list:
+                if pane_str in self.logger_dict:
+                    handle, logger = self.logger_dict.pop(pane_str)
+                    self.monitor.unwatch(handle)
+                    logger.close()
+            return
+        for pane in pane_list:
+            pane_str = self._get_pane_str(pane)
+            if pane_str in self.logger_dict:
+                continue
+            file = self._path(Template.compile(option_dict.get('FILE') or '${PANE}.log').render(dict(self.var_dict, PANE='{}'.format(pane))))
+            if self.is_debug:
+                print("    log> {} to {}".format(pane_str, file), file=self.stdout)
+            logger = PaneLogger(file, int(option_dict.get('MAX_SIZE', 0)), float(option_dict.get('ROTATE', 0)),
+                                int(option_dict.get('KEEP', 5)), option_dict.get('COMPRESS', 'gzip'),
+                                option_dict.get('TIMESTAMP', True), option_dict.get('STRIP', True))
+            handle = self.monitor.watch(pane_str, logger.write)
+            if handle:
+                self.logger_dict[pane_str] = (handle, logger)
+            else:
+                logger.close()
+        if self.archive_db:
+            self.archive({'PANES': pane_list})
+        self.flush()
+
+    def archive(self, option):
+        """
+        Starts or stops adding the output of panes to the archive (see
+        --archive) as it arrives.  The option is ON for the last pane, OFF to
+        stop all of the panes or a dictionary with PANES (default is the last
+        pane) and STOP.
+
+        :param      option:  The archive option
+        :type       option:  str or boolean or dict
+        """
+        if not self.archive_db:
+            if self.is_debug:
+                print("{}ARCHIVE is ignored without --archive{}".format(YEL, NON), file=self.stdout)
+            return
+        option_dict = option if type(option) is dict else {}
+        pane_list = option_dict.get('PANES', [self.pane_last])
+        pane_list = pane_list if type(pane_list) is list else [pane_list]
+        if option_dict.get('STOP') or option in ('OFF', False):
+            pane_list = list(self.archive_dict.keys()) if 'PANES' not in option_dict else [ self._get_pane_str(pane) for pane in pane_list ]
+            for pane_str in pane_list:
+                if pane_str in self.archive_dict:
+                    self.monitor.unwatch(self.archive_dict.pop(pane_str))
+            return
+        for pane in pane_list:
+            pane_str = self._get_pane_str(pane)
+            if pane_str in self.archive_dict:
+                continue
+            if self.is_debug:
+                print("    archive> {}".format(pane_str), file=self.stdout)
+            # NOTE: The sequence is taken when the output arrives
+            session, window, pane = self._archive_key(pane)
+            handle = self.monitor.watch(pane_str, lambda data, pane_str=pane_str, session=session, window=window, pane=pane: self.archive_db.write(pane_str, (session, self.sequence_last or '', window, pane), data))
+            if handle:
+                self.archive_dict[pane_str] = handle
+        self.flush()
+
+    def _archive_key(self, pane):
+        """
+        Gets the session, window and pane name of a pane in the last window
+
+        :param      pane:  The pane name or number
+        :type       pane:  str or int
+
+        :returns:   The session, window and pane name (or number if unnamed)
+        :rtype:     tuple(str, str, str)
+        """
+        pane_dict = self.window_dict.get(self.window_last, {})
+        if pane not in pane_dict:
+            pane = ([ name for name, idx in pane_dict.items() if idx == pane ] or [pane])[0]
+        return self.session_last or '', self.window_last or '', '{}'.format(pane)
+
+    def extract(self, cmd_patt_var, delay=1):
+        """
+        Extracts the command contents from a regular expression to a variable list.
+        The pane output is matched as it arrives, so this returns as soon as the
+        regular expression matches.
+
+        :param      cmd_patt_var:  The command pattern
+        :type       cmd_patt_var:  command and regular expression
+        :param      delay:         The timeout for the regular expression to match
+        :type       delay:         number
+        """
+        scan = self._extract_scanner(cmd_patt_var, delay)
+        if scan:
+            result, elapsed = self._scan(*scan)
+            self._extract_bind(cmd_patt_var, scan[1], result, elapsed)
+
+    def _extract_scanner(self, cmd_patt_var, delay=1):
+        """
+        Builds the scanner of an EXTRACT.  A dictionary extracts many variables
+        from one run of a command.  It has the CMD, the PATTERNS mapping each
+        regular expression to a variable or list of variables for its groups
+        (named groups are always bound to the variable of the same name), the
+        MODE (first, last or all matches, where all matches are joined by SEP),
+        an optional UNTIL regular expression that ends the output, an optional
+        TIMEOUT and an optional MAX_OUTPUT [in characters] to keep for matches
+        that span many lines.
+
+        :param      cmd_patt_var:  The command pattern or extract dictionary
+        :type       cmd_patt_var:  list or dict
+        :param      delay:         The default timeout
+        :type       delay:         number
+
+        :returns:   The command, scanner and timeout or None if invalid
+        :rtype:     tuple(str, OutputScanner or PatternScanner, float)
+        """
+        if type(cmd_patt_var) is not dict:
+            scanner = OutputScanner(self._compile(cmd_patt_var[1]), self.max_output)
+            return cmd_patt_var[0], scanner, self.wait_time('EXTRACT', cmd_patt_var[0], delay)
+        patt_var_dict = cmd_patt_var.get('PATTERNS') or {}
+        mode = cmd_patt_var.get('MODE', 'first')
+        if mode not in PatternScanner.MODE_LIST:
+            print("{}Unknown EXTRACT MODE {}{}".format(RED, mode, NON), file=self.stdout)
+            return None
+        until = cmd_patt_var.get('UNTIL')
+        combined = PatternScanner.combine(list(patt_var_dict))
+        scanner = PatternScanner([ self._compile(patt) for patt in patt_var_dict ], mode,
+                                 self._compile(until) if until else None, self._compile(combined) if combined else None,
+                                 cmd_patt_var.get('MAX_OUTPUT', self.max_output))
+        timeout = float(cmd_patt_var.get('TIMEOUT', delay))
+        return cmd_patt_var['CMD'], scanner, self.wait_time('EXTRACT', cmd_patt_var['CMD'], timeout)
+
+    def _extract_bind(self, cmd_patt_var, scanner, result, elapsed):
+        """
+        Records the time of an EXTRACT that matched and binds the groups of the
+        matches to the variables
+
+        :param      cmd_patt_var:  The command pattern or extract dictionary
+        :type       cmd_patt_var:  list or dict
+        :param      scanner:       The scanner
+        :type       scanner:       OutputScanner or PatternScanner
+        :param      result:        The last result of the scanner's feed()
+        :type       result:        any
+        :param      elapsed:       The time taken [in S]
+        :type       elapsed:       float
+        """
+        if type(cmd_patt_var) is not dict:
+            if result:
+                self.record_time('EXTRACT', cmd_patt_var[0], elapsed)
+            match = result or scanner.finish()
+            if self.is_debug:
+                print("    extract({:.3f}s)> {}".format(elapsed, match.group(0) if match else None), file=self.stdout)
+            if match:
+                for key, val in zip(cmd_patt_var[2:], match.groups()):
+                    self.set_env(key, '{}'.format(val))
+            return
+        if result:
+            self.record_time('EXTRACT', cmd_patt_var['CMD'], elapsed)
+        match_list = scanner.finish(bool(result))
+        # Bind the groups of the matches to the variables
+        val_dict = {}
+        for (patt, var), matches in zip((cmd_patt_var.get('PATTERNS') or {}).items(), match_list):
+            var_list = var if type(var) is list else [var] if var else []
+            for group_list, group_dict in matches:
+                for key, val in list(zip(var_list, group_list)) + list(group_dict.items()):
+                    if val is not None:
+                        val_dict.setdefault(key, []).append('{}'.format(val))
+        if self.is_debug:
+            print("    extract({:.3f}s)> {}".format(elapsed, val_dict), file=self.stdout)
+        mode = cmd_patt_var.get('MODE', 'first')
+        for key, val_list in val_dict.items():
+            self.set_env(key, cmd_patt_var.get('SEP', ' ').join(val_list) if mode == 'all' else val_list[0])
+
+    def _compile(self, patt):
+        """
+        Compiles a regular expression, reusing the ones compiled by the plan
+
+        :param      patt:  The regular expression
+        :type       patt:  str
+
+        :returns:   The compiled regular expression
+        :rtype:     re.Pattern
+        """
+        return self.patt_dict.get(patt) or self.patt_dict.setdefault(patt, re.compile(patt))
+
+    def _scan(self, cmd, scanner, delay):
+        """
+        Sends a shell command to the last pane and feeds its output to the
+        scanner as it arrives, until the scanner is done or the timeout
+
+        :param      cmd:      The command
+        :type       cmd:      str
+        :param      scanner:  The scanner
+        :type       scanner:  OutputScanner or PatternScanner
+        :param      delay:    The timeout
+        :type       delay:    number
+
+        :returns:   The last result of the scanner's feed() and the time taken
+        :rtype:     tuple(any, float)
+        """
+        stream = PaneStream(self, self._get_pane_str(self.pane_last))
+        stream.open()
+        try:
+            # Send the command
+            start = time.time()
+            self.shell(cmd)
+            self.flush()
+            # Examine results as they arrive, until the timeout
+            result = None
+            with self.trace('extract', 'extract', cmd=cmd, timeout=delay) as trace_args:
+                while not result and time.time() - start < delay and not self.interrupt_event.is_set():
+                    data = stream.read(delay - (time.time() - start))
+                    self.check()
+                    if data:
+                        result = scanner.feed(data)
+                trace_args['match'] = bool(result)
+        finally:
+            # Close the stream
+            stream.close()
+        return result, time.time() - start
+
+
+class SimTmux(Tmux):
+    """
+    This class simulates the tmux server for petmux.  The sessions, windows,
+    panes, buffers and environment are modeled in memory and the delays advance
+    a virtual clock, so a whole plan runs instantly without a tmux server.  The
+    targets that don't exist are reported as issues.  The panes don't run
+    anything, so EXTRACT never matches and WAIT_FOR commands are assumed to
+    succeed, and their timeouts are only added up as the worst case.
     """
-    def __init__(self, is_debug=False, is_dryrun=False):
+    # NOTE: Roughly the time of a tmux round-trip with a tmux process and over
+    #       control mode [in S]
+    CMD_TIME = 0.005
+    CONTROL_CMD_TIME = 0.0005
+    LAYOUT_LIST = ['even-horizontal', 'even-vertical', 'main-horizontal', 'main-vertical', 'tiled']
+    # The tmux options that take a value, by command
+    VALUE_OPT = 'bcCeEFlnsStxy'
+    VALUE_OPT_DICT = {'split-window': 'p'}
+
+    class Monitor:
         """
-        Constructs a new tmux instance.
+        Pane monitor of the simulator, where the panes have no output to watch
+        """
+        def __init__(self, tmux):
+            self.tmux = tmux
+
+        def watch(self, pane_str, callback):
+            self.tmux._locate('watch', pane_str, 'pane')
+            return None
 
-        :param      is_debug:   Indicates if debug
-        :type       is_debug:   boolean
-        :param      is_dryrun:  Indicates if dryrun
-        :type       is_dryrun:  boolean
+        def unwatch(self, handle):
+            pass
+
+        def close(self):
+            pass
+
+
+    def __init__(self, is_debug=False, is_control=False, is_batch=False):
         """
-        self.cmd_delay = 0
-        self.is_debug = is_debug
-        self.is_dryrun = is_dryrun
-        self.window_dict = {}
-        self.pane_last = 1
-        self.window_last = None
-        self.session_last = None
-        self.pattVAR = re.compile(r'\$\{(.*?)\}')
-        self.var_dict = {}
+        Constructs a new simulated tmux instance, with a session like the one
+        petmux is usually started from
 
-    def _cmd(self, cmd, delay=0, check_output=False):
-        delay = delay if delay else self.cmd_delay
+        :param      is_debug:    Indicates if debug
+        :type       is_debug:    boolean
+        :param      is_control:  Indicates if the round-trips are timed as
+                                 over control mode
+        :type       is_control:  boolean
+        :param      is_batch:    Indicates if commands that don't need results
+                                 are queued and sent as one batch
+        :type       is_batch:    boolean
+        """
+        Tmux.__init__(self, is_debug, False, False, is_batch)
+        self.monitor = SimTmux.Monitor(self)
+        self.cmd_time = SimTmux.CONTROL_CMD_TIME if is_control else SimTmux.CMD_TIME
+        # The virtual clock and the worst case of the EXTRACT and WAIT_FOR timeouts [in S]
+        self.clock = 0
+        self.wait_max = 0
+        self.cmd_cnt = 0
+        self.issue_list = []
+        # The pane ids by window name by session name
+        self.server_dict = {}
+        self.session_id_dict = {}
+        self.active_dict = {}
+        self.current = None
+        self.env_dict = {}
+        self.buffer_dict = {}
+        self.id_cnt = itertools.count()
+        self._new_session('0', os.path.basename(os.environ.get('SHELL') or 'sh'))
+        self.current = '0'
+
+    def _new_session(self, session, window):
+        self.server_dict[session] = {}
+        self.session_id_dict[session] = '${}'.format(next(self.id_cnt))
+        self._new_window(session, window)
+
+    def _new_window(self, session, window):
+        # NOTE: Only the first of the windows with the same name is used
+        self.server_dict[session].setdefault(window, ['%{}'.format(next(self.id_cnt))])
+        self.active_dict[session] = window
+
+    def _issue(self, text):
+        """
+        Records an issue found by the simulation
+
+        :param      text:  The issue
+        :type       text:  str
+        """
+        issue = '{}: {}'.format(self.sequence_last or '-', text)
+        if issue not in self.issue_list:
+            self.issue_list.append(issue)
         if self.is_debug:
-            print("    tmux{}> {}".format( "(dly:{})".format(delay) if delay else "", cmd))
-        if delay:
-            time.sleep(delay)
-        # Send the tmux command
-        if check_output:
-            return subprocess.check_output('tmux {}'.format(cmd).split())
+            print("{}    sim> {}{}".format(RED, text, NON), file=self.stdout)
+
+    def _locate(self, name, target, kind, is_probe=False):
+        """
+        Finds the session, window and pane of a tmux target
+
+        :param      name:      The tmux command name
+        :type       name:      str
+        :param      target:    The target (e.g. session:window.pane)
+        :type       target:    str
+        :param      kind:      The kind of target (session, window or pane)
+        :type       kind:      str
+        :param      is_probe:  Indicates if a missing target is expected
+                               (e.g. has-session), so it isn't an issue
+        :type       is_probe:  boolean
+
+        :returns:   The session, window and pane index or None if not found
+        :rtype:     tuple(str, str, int)
+        """
+        target = target or ''
+        session, sep, rest = target.partition(':')
+        if not sep:
+            session, rest = (target, '') if kind == 'session' else (None, target)
+        if kind == 'pane' and '.' in rest:
+            window, _, pane = rest.rpartition('.')
+        elif kind == 'pane' and not sep and rest.isdigit():
+            # A pane of the current window
+            window, pane = '', rest
         else:
-            return os.system('tmux {}'.format(cmd))
+            window, pane = rest, ''
+        session = session or self.current
+        window_dict = self.server_dict.get(session)
+        if window_dict is not None and kind != 'session':
+            window = window or self.active_dict.get(session)
+            if window not in window_dict and window.isdigit() and 0 < int(window) <= len(window_dict):
+                window = list(window_dict)[int(window) - 1]
+            pane_list = window_dict.get(window)
+            if pane_list is None:
+                window_dict = None
+            elif kind == 'pane':
+                pane = int(pane) if pane.isdigit() else 1 if not pane else 0
+                if not 0 < pane <= len(pane_list):
+                    window_dict = None
+        if window_dict is None:
+            if not is_probe:
+                self._issue("{} can't find {} {}".format(name, kind, target))
+            return None
+        return session, window, pane
 
-    def _get_pane_str(self, pane):
+    def _format(self, fmt, session, window, pane):
         """
-        Builds the target string from the session, window and pane.
-
-        :param      pane:  The pane name
-        :type       pane:  string or int
-
-        :returns:   The pane string.
-        :rtype:     str
+        Expands the #{...} variables of a tmux format for a pane
         """
-        pane_str = '{}:'.format(self.session_last) if self.session_last else ''
-        pane_str += '{}.'.format(self.window_last) if self.window_last else ''
-        pane = self.window_dict[self.window_last][pane] if pane in self.window_dict[self.window_last] else pane
-        pane_str += '{}'.format(pane) if pane else ''
-        return pane_str
+        window_dict = self.server_dict[session]
+        value_dict = {
+            'session_name': session,
+            'session_id': self.session_id_dict[session],
+            'session_last_attached': '1' if session == self.current else '0',
+            'window_name': window,
+            'window_index': '{}'.format(list(window_dict).index(window) + 1),
+            'pane_index': '{}'.format(pane),
+            'pane_id': window_dict[window][pane - 1],
+            'history_size': '0',
+            'history_limit': '2000',
+            'cursor_y': '0',
+            'client_name': 'sim',
+            'client_control_mode': '0',
+            'client_activity': '0',
+        }
+        return re.sub(r'#\{(\w+)\}', lambda match: value_dict.get(match.group(1), ''), fmt)
 
-    def name_pane(self, window, name, idx):
+    def _apply(self, cmd):
         """
-        Associates the name with pane index into the window dictionary
+        Runs a tmux command against the model
 
-        :param      window:  The window name
-        :type       window:  str
-        :param      name:    The pane name
-        :type       name:    int
-        :param      idx:     The pane index
-        :type       idx:     int
+        :param      cmd:  The tmux command line
+        :type       cmd:  str
+
+        :returns:   The return code and output
+        :rtype:     tuple(int, bytes)
         """
-        if window in self.window_dict:
-            self.window_dict[window][name] = idx
-        else:
-            self.window_dict[window] = { name : idx }
+        arg_list = shlex.split(cmd)
+        name = arg_list.pop(0) if arg_list else ''
+        # Parse the options
+        value_opt = SimTmux.VALUE_OPT + SimTmux.VALUE_OPT_DICT.get(name, '')
+        opt_dict = {}
+        while arg_list and arg_list[0].startswith('-') and len(arg_list[0]) > 1:
+            arg = arg_list.pop(0)
+            for idx, opt in enumerate(arg[1:], 2):
+                if opt in value_opt:
+                    opt_dict[opt] = arg[idx:] or (arg_list.pop(0) if arg_list else '')
+                    break
+                opt_dict[opt] = True
+        self.cmd_cnt += 1
+        target = opt_dict.get('t')
+        output = ''
+        if name == 'has-session':
+            return (0 if self._locate(name, target, 'session', True) else 1), b''
+        elif name == 'new-session':
+            session = opt_dict.get('s') or opt_dict.get('t') or '{}'.format(len(self.server_dict))
+            if session in self.server_dict:
+                self._issue("{} duplicate session {}".format(name, session))
+                return 1, b''
+            self._new_session(session, opt_dict.get('n') or 'sh')
+            if not opt_dict.get('d'):
+                self.current = session
+        elif name == 'switch-client':
+            location = self._locate(name, target, 'session')
+            if not location:
+                return 1, b''
+            self.current = location[0]
+        elif name == 'select-window':
+            location = self._locate(name, target, 'window', True)
+            if not location:
+                return 1, b''
+            self.active_dict[location[0]] = location[1]
+        elif name == 'new-window':
+            location = self._locate(name, (target or '').partition(':')[0], 'session')
+            if not location:
+                return 1, b''
+            window = opt_dict.get('n') or 'sh'
+            self._new_window(location[0], window)
+            if opt_dict.get('d'):
+                self.active_dict[location[0]] = location[1] if location[1] in self.server_dict[location[0]] else window
+        elif name == 'rename-window':
+            location = self._locate(name, target, 'window')
+            if not location or not arg_list:
+                return 1, b''
+            session, window, _ = location
+            self.server_dict[session] = { (arg_list[0] if key == window else key): val for key, val in self.server_dict[session].items() }
+            self.active_dict[session] = arg_list[0]
+        elif name in ('kill-session', 'kill-window', 'kill-pane'):
+            # NOTE: Killing what doesn't exist is only an error (e.g. -k)
+            location = self._locate(name, target, name[5:], name != 'kill-pane')
+            if not location:
+                return 1, b''
+            session, window, pane = location
+            if name == 'kill-pane':
+                del self.server_dict[session][window][pane - 1]
+            if name == 'kill-window' or not self.server_dict[session].get(window, True):
+                del self.server_dict[session][window]
+            if name == 'kill-session' or not self.server_dict[session]:
+                del self.server_dict[session]
+                self.current = next(iter(self.server_dict), None) if session == self.current else self.current
+            elif self.active_dict[session] not in self.server_dict[session]:
+                self.active_dict[session] = next(iter(self.server_dict[session]))
+        elif name == 'split-window':
+            location = self._locate(name, target, 'pane')
+            if not location:
+                return 1, b''
+            self.server_dict[location[0]][location[1]].append('%{}'.format(next(self.id_cnt)))
+        elif name == 'select-layout':
+            if not self._locate(name, target, 'window'):
+                return 1, b''
+            layout = arg_list[0] if arg_list else 'tiled'
+            if layout not in SimTmux.LAYOUT_LIST and not re.match(r'^[0-9a-f]{4},', layout):
+                self._issue("{} unknown layout {}".format(name, layout))
+                return 1, b''
+        elif name in ('select-pane', 'send-keys', 'respawn-pane', 'pipe-pane', 'capture-pane', 'paste-buffer'):
+            if not self._locate(name, target, 'pane'):
+                return 1, b''
+            buffer = opt_dict.get('b')
+            if name == 'capture-pane' and buffer:
+                self.buffer_dict[buffer] = ''
+            elif name == 'paste-buffer' and buffer:
+                if buffer not in self.buffer_dict:
+                    self._issue("{} no buffer {}".format(name, buffer))
+                    return 1, b''
+                if opt_dict.get('d'):
+                    del self.buffer_dict[buffer]
+        elif name in ('set-environment', 'show-environment'):
+            if target and not self._locate(name, target, 'session'):
+                return 1, b''
+            env_dict = self.env_dict.setdefault(target or '', {})
+            if name == 'set-environment' and len(arg_list) > 1:
+                env_dict[arg_list[0]] = arg_list[1]
+            else:
+                output = ''.join('{}={}\n'.format(key, val) for key, val in env_dict.items() if not arg_list or key == arg_list[0])
+        elif name == 'display-message':
+            location = self._locate(name, target, 'pane')
+            if not location:
+                return 1, b''
+            output = self._format(arg_list[0] if arg_list else '', *location) + '\n'
+        elif name == 'list-panes':
+            fmt = opt_dict.get('F') or '#{pane_index}: #{pane_id}'
+            located = None if opt_dict.get('a') else self._locate(name, target, 'window')
+            if not opt_dict.get('a') and not located:
+                return 1, b''
+            for session, window_dict in self.server_dict.items():
+                for window, pane_list in window_dict.items():
+                    if opt_dict.get('a') or (session, window) == located[:2]:
+                        output += ''.join(self._format(fmt, session, window, pane) + '\n' for pane in range(1, len(pane_list) + 1))
+        elif name == 'list-clients':
+            # The user's client, attached to the current session
+            if self.current in self.server_dict:
+                output = self._format(opt_dict.get('F') or '#{client_name}', self.current, next(iter(self.server_dict[self.current])), 1) + '\n'
+        elif name in ('set-buffer', 'load-buffer'):
+            buffer = opt_dict.get('b') or 'buffer'
+            if name == 'load-buffer' and arg_list and arg_list[0] != '-':
+                if not os.path.isfile(arg_list[0]):
+                    self._issue("{} no file {}".format(name, arg_list[0]))
+                    return 1, b''
+            self.buffer_dict[buffer] = arg_list[0] if name == 'set-buffer' and arg_list else ''
+        elif name in ('show-buffer', 'save-buffer', 'delete-buffer'):
+            buffer = opt_dict.get('b') or 'buffer'
+            if buffer not in self.buffer_dict:
+                return 1, b''
+            output = self.buffer_dict[buffer] if name == 'show-buffer' else ''
+            if name == 'delete-buffer':
+                del self.buffer_dict[buffer]
+        elif name != 'wait-for':
+            self._issue("unknown tmux command {}".format(name))
+            return 1, b''
+        return 0, output.encode('utf-8')
 
-    def delay(self, delay):
+    def _send(self, cmd, check_output=False):
+        self.clock += self.cmd_time
+        result, output = self._apply(cmd)
+        if check_output:
+            if result:
+                raise subprocess.CalledProcessError(result, cmd, output)
+            return output
+        return result
+
+    def _send_batch(self, cmd_list):
+        self.clock += self.cmd_time
+        result = 0
+        for cmd in cmd_list:
+            result = self._apply(cmd)[0] or result
+        return result
+
+    def _control_open(self):
+        return False
+
+    def sleep(self, delay, cat='delay'):
+        self.clock += delay
+
+    def input(self, prompt):
+        # NOTE: The default answer (e.g. create the session) is always taken
+        if self.is_debug:
+            print(prompt, file=self.stdout)
+        return ''
+
+    def wait_for(self, cmd_var_timeout):
         """
-        Sets the per command delay for the group of SHELL commands (via
-        self.shell(...))
+        Sends the shell command and assumes it succeeds, up to the timeout
 
-        :param      delay:  The delay [in S]
-        :type       delay:  int
+        :param      cmd_var_timeout:  The command, optional variable for the exit
+                                      status and optional timeout [in S]
+        :type       cmd_var_timeout:  str or list(str, str, number)
         """
-        self.cmd_delay = delay
+        cmd_list = cmd_var_timeout if type(cmd_var_timeout) == list else [cmd_var_timeout]
+        self.shell(cmd_list[0])
+        self.flush()
+        self.wait_max += float(cmd_list[2]) if len(cmd_list) > 2 else 60
+        if len(cmd_list) > 1:
+            self.set_env(cmd_list[1], '0')
 
-    def set_env(self, key, value):
+    def script(self, file, pane=None):
+        option_dict = file if type(file) is dict else {'FILE': file}
+        if not os.path.isfile(self.expand(option_dict.get('FILE') or '')):
+            self._issue("SCRIPT no file {}".format(option_dict.get('FILE')))
+        Tmux.script(self, file, pane)
+
+    def _paste(self, pane_str, text=None, file=None, bracketed=False):
+        buffer = 'petmux_paste_{}'.format(next(self.wait_cnt))
+        self.buffer_dict[buffer] = text or ''
+        return self._cmd('paste-buffer -d{} -b {} -t {}'.format('p' if bracketed else '', buffer, pane_str))
+
+    def capture(self, file=None):
+        self._cmd('capture-pane -J -t {}'.format(self._get_pane_str(self.pane_last)))
+        return None if file else b''
+
+    def log(self, option):
+        option_dict = option if type(option) is dict else {'FILE': option}
+        if option_dict.get('STOP') or option_dict.get('FILE') in ('OFF', False):
+            return
+        pane_list = option_dict.get('PANES', [self.pane_last])
+        for pane in pane_list if type(pane_list) is list else [pane_list]:
+            self._locate('LOG', self._get_pane_str(pane), 'pane')
+
+    def _scan(self, cmd, scanner, delay):
+        self.shell(cmd)
+        self.flush()
+        self.wait_max += delay
+        return None, 0
+
+
+class Plan:
+    """
+    This class describes a compiled configuration.  Compiling resolves the pane
+    names to indices, expands the DEFINES, precompiles the EXTRACT regular
+    expressions and reports problems once, so the plan can be cached on disk
+    and reused while the configuration file is unchanged.
+    """
+    # Configuration keys that are not sequences
+    CFGKEY_LIST = [
+        "DEFINES",
+        "TITLE",
+        "DESC",
+        "SESSION",
+        "NEW_WINDOW",
+        "NEW_PANES",
+        "CMDS",
+    ]
+    # Sequence keys that are not keywords
+    SEQKEY_LIST = [
+        "TITLE",
+        "DESC",
+        "SESSION",
+        "WINDOW",
+        "NEW_WINDOW",
+        "NEW_PANES",
+        "LAYOUT",
+        "CMDS",
+        "DEPENDS",
+        "PROVIDES",
+    ]
+
+    def __init__(self, config):
         """
-        Sets the tmux environment variable and dictionary
+        Compiles the configuration
 
-        :param      key:    The new value
-        :type       key:    str
-        :param      value:  The value
-        :type       value:  str
+        :param      config:  The configuration
+        :type       config:  dict
         """
-        self.var_dict[key] = value
-        self._cmd("""set-environment %s '%s'""" % (key, value))
+        self.config = config
+        self.define_dict = {}
+        self.window_dict = {}
+        self.panes_dict = {}
+        self.patt_dict = {}
+        self.warning_list = []
+        # Expand the user defines in order
+        for key, value in (config.get("DEFINES") or {}).items():
+            value = '{}'.format(value) if value is not None else ''
+            self.define_dict[key] = Template.compile(value).render(self.define_dict)
+        # Get sequence list (i.e. entries that are not keywords)
+        self.sequence_list = list(set(config.keys()) - set(Plan.CFGKEY_LIST))
+        for seq in self.sequence_list:
+            sequence = config[seq]
+            if type(sequence) is not dict:
+                self.warning_list.append('Sequence "{}" is not a dictionary'.format(seq))
+                continue
+            # Search for sequence that contains "NEW_WINDOW" which configures a window
+            if "NEW_WINDOW" in sequence:
+                window_name = sequence['NEW_WINDOW']
+                self.panes_dict[window_name] = sequence.get('NEW_PANES') or []
+                # Associate the pane_name to pane index
+                pane_dict = self.window_dict.setdefault(window_name, {})
+                for pane_num, pane in enumerate(self.panes_dict[window_name], 1):
+                    pane_dict[list(pane.keys())[0]] = pane_num
+            for cmd_dict in self._cmd_dicts(sequence.get('CMDS') or []):
+                extract = cmd_dict.get('EXTRACT')
+                if type(extract) is list and len(extract) > 1:
+                    patt_list = [ extract[1] ]
+                elif type(extract) is dict:
+                    patt_list = list(extract.get('PATTERNS') or {})
+                    combined = PatternScanner.combine(patt_list)
+                    patt_list += [ patt for patt in (extract.get('UNTIL'), combined) if patt ]
+                else:
+                    patt_list = []
+                for patt in patt_list:
+                    try:
+                        self.patt_dict[patt] = re.compile(patt)
+                    except re.error as e:
+                        self.warning_list.append('Bad EXTRACT pattern "{}" in sequence "{}": {}'.format(patt, seq, e))
+                for rule in self._trigger_rules(cmd_dict.get('TRIGGER')):
+                    try:
+                        self.patt_dict[rule['MATCH']] = re.compile(rule['MATCH'])
+                    except re.error as e:
+                        self.warning_list.append('Bad TRIGGER pattern "{}" in sequence "{}": {}'.format(rule['MATCH'], seq, e))
 
-    def get_env(self):
+    def _cmd_dicts(self, cmds_list):
         """
-        Gets the environment variable dictionary
+        Walks the CMDS entries including the ones nested in DECIDE
 
-        :returns:   The environment.
-        :rtype:     dict
+        :param      cmds_list:  The CMDS list
+        :type       cmds_list:  list(dict)
+
+        :returns:   The CMDS entries
+        :rtype:     generator(dict)
         """
-        return self.var_dict
+        for cmd_dict in cmds_list:
+            if type(cmd_dict) is not dict:
+                continue
+            yield cmd_dict
+            if type(cmd_dict.get('DECIDE')) is dict:
+                for key, cmd in cmd_dict['DECIDE'].items():
+                    cmd_list = cmd if type(cmd) is list else [cmd]
+                    yield from self._cmd_dicts(cmd_list)
+            for rule in self._trigger_rules(cmd_dict.get('TRIGGER')):
+                if type(rule.get('RUN')) is list:
+                    yield from self._cmd_dicts(rule['RUN'])
 
-    def expand(self, text):
+    def _jumps(self, cmds_list, is_cond=False):
         """
-        Expands the variable by replacing any '${var}' with matching self.var_dict
+        Walks the SEQUENCE switches of the CMDS entries, including the ones in
+        DECIDE and TRIGGER
 
-        :param      text:  The text
-        :type       text:  str
+        :param      cmds_list:  The CMDS list
+        :type       cmds_list:  list(dict)
+        :param      is_cond:    Indicates if the entries only run on a condition
+        :type       is_cond:    boolean
 
-        :returns:   expanded text
-        :rtype:     str
+        :returns:   The sequence and if the switch is conditional
+        :rtype:     generator(tuple(str, boolean))
         """
-        if text:
-            match = self.pattVAR.findall(text)
-            for var in match:
-                if var in self.var_dict:
-                    text = text.replace("${%s}" % var, self.var_dict[var])
-        return text
+        for cmd_dict in cmds_list:
+            if type(cmd_dict) is not dict:
+                continue
+            if cmd_dict.get('SEQUENCE'):
+                yield cmd_dict['SEQUENCE'], is_cond
+            if type(cmd_dict.get('DECIDE')) is dict:
+                for key, cmd in cmd_dict['DECIDE'].items():
+                    if key != 'KEY':
+                        yield from self._jumps(cmd if type(cmd) is list else [cmd], True)
+            for rule in self._trigger_rules(cmd_dict.get('TRIGGER')):
+                if rule.get('SEQUENCE'):
+                    yield rule['SEQUENCE'], True
+                if type(rule.get('RUN')) is list:
+                    yield from self._jumps(rule['RUN'], True)
 
+    def _ordered(self):
+        """
+        Gets the sequences in the order of the configuration
 
-    def kill(self, window):
+        :returns:   The sequence names
+        :rtype:     list(str)
         """
-        Kill the window in the session
+        return [ seq for seq in self.config if seq in self.sequence_list and type(self.config[seq]) is dict ]
 
-        :param      window:  The window name
-        :type       window:  str
+    def _provider_dict(self):
         """
-        self._cmd('kill-window -t %s' % window)
+        Gets the sequences that provide each sequence, window and variable.  A
+        sequence provides itself, its NEW_WINDOW and its PROVIDES.
 
-    def session(self, session):
+        :returns:   The sequences by what they provide
+        :rtype:     dict(str, list(str))
         """
-        Selects a session.  If the session doesn't exist, then it will prompt to create a session
+        provider_dict = {}
+        for seq in self._ordered():
+            sequence = self.config[seq]
+            provides = sequence.get('PROVIDES') or []
+            for name in [seq, sequence.get('NEW_WINDOW')] + (provides if type(provides) is list else [provides]):
+                if name and seq not in provider_dict.setdefault(name, []):
+                    provider_dict[name].append(seq)
+        return provider_dict
 
-        :param      session:  The session name
-        :type       session:  str
+    def dag(self, run_list):
         """
-        if session:
-            result = self._cmd('has-session -t %s' % session)
-            # If session failed to be selected, then create it
-            if result:
-                resp = input("Session {} doesn't exist, Create[Y/n]? ")
-                if resp == 'Y' or resp == '':
-                    print("Creating Session: {}".format(session))
-                    self._cmd('new-session -t %s' % session)
-            # select the session
-            self._cmd('switch-client -t %s' % session)
-        self.session_last = session
+        Builds the dependency graph of the sequences to run.  Each DEPENDS entry
+        is a sequence, or a window or variable that another sequence provides,
+        where the providers that are run are preferred and otherwise the first
+        one is added to the run.  A sequence with a WINDOW also depends on the
+        run's sequence with that NEW_WINDOW.
 
-    def window(self, window):
+        :param      run_list:  The sequences to run
+        :type       run_list:  list(str)
+
+        :returns:   The dependencies of each sequence, ordered so each one
+                    comes after its dependencies, and the errors
+        :rtype:     tuple(dict(str, list(str)), list(str))
         """
-        Selects a window.  If the window doesn't exist, then it shall create one
+        provider_dict = self._provider_dict()
+        dep_dict = {}
+        error_list = []
+        todo_list = list(run_list)
+        while todo_list:
+            seq = todo_list.pop(0)
+            if seq in dep_dict:
+                continue
+            if seq not in self._ordered():
+                error_list.append('No sequence "{}"'.format(seq))
+                continue
+            sequence = self.config[seq]
+            depends = sequence.get('DEPENDS') or []
+            dep_list = []
+            for name in depends if type(depends) is list else [depends]:
+                provider_list = [ provider for provider in provider_dict.get(name, []) if provider != seq ]
+                if not provider_list:
+                    error_list.append('Nothing provides "{}" for sequence "{}"'.format(name, seq))
+                dep_list += [ provider for provider in provider_list if provider in run_list ] or provider_list[:1]
+            window = sequence.get('WINDOW')
+            if window and 'NEW_WINDOW' not in sequence:
+                dep_list += [ other for other in run_list if other != seq and type(self.config.get(other)) is dict and self.config[other].get('NEW_WINDOW') == window ]
+            dep_dict[seq] = list(dict.fromkeys(dep_list))
+            todo_list += dep_dict[seq]
+        # Order the sequences after their dependencies
+        order_list = []
+        remaining_list = list(dep_dict)
+        while remaining_list:
+            ready_list = [ seq for seq in remaining_list if all(dep in order_list for dep in dep_dict[seq]) ]
+            if not ready_list:
+                error_list.append('DEPENDS cycle in {}'.format(', '.join(remaining_list)))
+                break
+            order_list += ready_list
+            remaining_list = [ seq for seq in remaining_list if seq not in ready_list ]
+        return { seq: dep_dict[seq] for seq in order_list }, error_list
 
-        :param      window:  The window name
-        :type       window:  str
+    def changes(self, old, run_list):
         """
-        if self.is_debug:
-            print("{}[ window: {} ]{}".format(BLU, window, NON))
-        result = self._cmd('select-window -t %s' % window)
-        # If window failed to be selected, then create it
-        if result:
-            print("Creating window: {}".format(window))
-            self._cmd('new-window')
-            self._cmd('rename-window %s' % window)
-        self.window_last = window
+        Compares the plan with the plan of the previous configuration, for the
+        sequences that are run.  A window is changed when its NEW_PANES, LAYOUT
+        or SESSION change, a pane when its keywords change and a sequence of
+        CMDS when anything in it changes.  They are also changed when they use
+        a DEFINES value that changed.
 
-    def pane(self, pane):
+        :param      old:       The plan of the previous configuration
+        :type       old:       Plan
+        :param      run_list:  The sequences that are run
+        :type       run_list:  list(str)
+
+        :returns:   The session and name of the windows to kill, the numbers of
+                    the changed panes by the sequence of each changed window and
+                    the changed sequences of CMDS
+        :rtype:     tuple(list(tuple(str, str)), dict(str, list(int)), list(str))
         """
-        Selects the tmux pane to be used by shell, capture and extract
+        define_list = [ key for key in set(old.define_dict) | set(self.define_dict) if old.define_dict.get(key) != self.define_dict.get(key) ]
+        define_patt = re.compile(r'\$\{{?({})\b'.format('|'.join(re.escape(key) for key in define_list))) if define_list else None
 
-        :param      pane:  The pane name or number
-        :type       pane:  str or int
+        def is_changed(old_value, value):
+            return old_value != value or bool(define_patt and define_patt.search(json.dumps(value, default=str)))
+
+        kill_list = []
+        window_dict = {}
+        seq_list = []
+        window_key_list = ['NEW_WINDOW', 'SESSION', 'LAYOUT', 'NEW_PANES']
+        for seq in run_list:
+            old_seq = old.config.get(seq) if type(old.config.get(seq)) is dict else {}
+            new_seq = self.config.get(seq) if type(self.config.get(seq)) is dict else {}
+            old_window = old_seq.get('NEW_WINDOW')
+            window = new_seq.get('NEW_WINDOW')
+            if old_window and (old_window != window or old_seq.get('SESSION') != new_seq.get('SESSION')):
+                # Removed, renamed or moved, so the window is created again
+                kill_list.append((old_seq.get('SESSION'), old_window))
+                old_seq = {}
+            if window:
+                old_pane_list = old_seq.get('NEW_PANES') or []
+                pane_list = new_seq.get('NEW_PANES') or []
+                if is_changed([ old_seq.get(key) for key in window_key_list ], [ new_seq.get(key) for key in window_key_list ]):
+                    window_dict[seq] = [ idx for idx, pane in enumerate(pane_list, 1) if idx > len(old_pane_list) or is_changed(old_pane_list[idx - 1], pane) ]
+            elif new_seq and is_changed(old_seq, new_seq):
+                seq_list.append(seq)
+        return kill_list, window_dict, seq_list
+
+    def validate(self):
         """
-        if self.is_debug:
-            print("{}[ {} ]{}".format(CYN, pane, NON))
-        pane = self.window_dict[self.window_last][pane] if pane in self.window_dict[self.window_last] else pane
-        self.pane_last = pane
+        Reports the SEQUENCE switches to unknown sequences, the DEPENDS that
+        nothing provides and the DECIDE keys that no DEFINES, EXTRACT, PROMPT,
+        WAIT_FOR or TRIGGER sets
 
-    def focus(self, pane):
+        :returns:   The warnings
+        :rtype:     list(str)
         """
-        Selects the tmux pane for user input focus
+        warning_list = []
+        var_set = set(self.define_dict)
+        cmd_list = []
+        provider_dict = self._provider_dict()
+        for seq in self._ordered():
+            sequence = self.config[seq]
+            depends = sequence.get('DEPENDS') or []
+            for name in depends if type(depends) is list else [depends]:
+                if not [ provider for provider in provider_dict.get(name, []) if provider != seq ]:
+                    warning_list.append('Nothing provides "{}" for sequence "{}"'.format(name, seq))
+            cmds_list = list(sequence.get('CMDS') or [])
+            for pane in sequence.get('NEW_PANES') or []:
+                cmds_list += [ cmd_dict for cmd_dict in pane.values() if cmd_dict ]
+            for cmd_dict in self._cmd_dicts(cmds_list):
+                cmd_list.append((seq, cmd_dict))
+                extract = cmd_dict.get('EXTRACT')
+                patt_var_list = []
+                if type(extract) is list and len(extract) > 1:
+                    patt_var_list = [ (extract[1], extract[2:]) ]
+                elif type(extract) is dict:
+                    patt_var_list = list((extract.get('PATTERNS') or {}).items())
+                patt_var_list += [ (rule['MATCH'], rule.get('SET')) for rule in self._trigger_rules(cmd_dict.get('TRIGGER')) ]
+                for patt, var in patt_var_list:
+                    var_set |= set(var if type(var) is list else [var] if var else [])
+                    if patt in self.patt_dict:
+                        var_set |= set(self.patt_dict[patt].groupindex)
+                for key in ('PROMPT', 'WAIT_FOR'):
+                    if type(cmd_dict.get(key)) is list and len(cmd_dict[key]) > 1:
+                        var_set.add(cmd_dict[key][1])
+            for target, is_cond in self._jumps(sequence.get('CMDS') or []):
+                if target not in self.sequence_list:
+                    warning_list.append('Unknown SEQUENCE "{}" in sequence "{}"'.format(target, seq))
+        for seq, cmd_dict in cmd_list:
+            decide = cmd_dict.get('DECIDE')
+            if type(decide) is dict and decide.get('KEY') not in var_set:
+                warning_list.append('DECIDE KEY "{}" in sequence "{}" is never set'.format(decide.get('KEY'), seq))
+        return warning_list
 
-        :param      pane:  The pane name or number
-        :type       pane:  str or int
+    def cycles(self):
         """
-        self.pane(pane)
-        if type(self.pane_last) == int:
-            self._cmd('select-pane -t %d' % self.pane_last)
-        else:
-            print("Error: Unknown pane {}".format(self.pane_last))
+        Finds the groups of sequences that can switch back to themselves with
+        SEQUENCE.  A cycle never ends if each of its sequences always switches
+        to the next one (i.e. not only in a DECIDE or TRIGGER).
 
-    def split(self, options):
+        :returns:   The sequences of each cycle and if it never ends
+        :rtype:     list(tuple(list(str), boolean))
         """
-        Splits a tmux window
+        graph_dict = {}
+        next_dict = {}
+        for seq in self._ordered():
+            jump_list = [ jump for jump in self._jumps(self.config[seq].get('CMDS') or []) if jump[0] in self.sequence_list ]
+            graph_dict[seq] = [ target for target, is_cond in jump_list ]
+            # The first unconditional switch always ends the sequence
+            target_list = [ target for target, is_cond in jump_list if not is_cond ]
+            if target_list:
+                next_dict[seq] = target_list[0]
+        # Find the strongly connected sequences (Tarjan)
+        index_dict = {}
+        low_dict = {}
+        stack = []
+        cycle_list = []
 
-        :param      options:  The tmux split options
-        :type       options:  str
+        def visit(seq):
+            index_dict[seq] = low_dict[seq] = len(index_dict)
+            stack.append(seq)
+            for target in graph_dict.get(seq, []):
+                if target not in index_dict:
+                    visit(target)
+                    low_dict[seq] = min(low_dict[seq], low_dict[target])
+                elif target in stack:
+                    low_dict[seq] = min(low_dict[seq], index_dict[target])
+            if low_dict[seq] == index_dict[seq]:
+                idx = stack.index(seq)
+                group = stack[idx:]
+                del stack[idx:]
+                if len(group) > 1 or seq in graph_dict.get(seq, []):
+                    cycle_list.append(group)
+
+        for seq in graph_dict:
+            if seq not in index_dict:
+                visit(seq)
+        result_list = []
+        for group in cycle_list:
+            # Follow the unconditional switches from the first sequence
+            seq_list = [ seq for seq in graph_dict if seq in group ]
+            path = [ seq_list[0] ]
+            while next_dict.get(path[-1]) in group and next_dict[path[-1]] not in path:
+                path.append(next_dict[path[-1]])
+            is_endless = next_dict.get(path[-1]) == path[0] and len(path) == len(group)
+            result_list.append((path + [path[0]] if is_endless else seq_list, is_endless))
+        return result_list
+
+    @staticmethod
+    def _trigger_rules(trigger):
         """
-        self._cmd('split-window %s' % (options if options else ""))
+        Gets the rules of a TRIGGER that have a MATCH
 
-    def shell(self, cmd, pane=None):
+        :param      trigger:  The TRIGGER value
+        :type       trigger:  dict or list(dict)
+
+        :returns:   The rules
+        :rtype:     list(dict)
         """
-        Sends a shell command or list of shell commands to the last pane
+        rule_list = trigger if type(trigger) is list else [trigger]
+        return [ rule for rule in rule_list if type(rule) is dict and rule.get('MATCH') ]
 
-        :param      cmd:   The command string
-        :type       cmd:   str
-        :param      pane:  target pane
-        :type       pane:  str
+    def check(self, key_list):
         """
-        if pane:
-            self.pane(pane)
-        cmd_list = cmd if type(cmd) == list else [cmd]
-        for cmd in cmd_list:
-            pane_str = self._get_pane_str(self.pane_last)
-            # Expand any '${variables}' in the cmd string
-            cmd = self.expand(cmd)
-            # NOTE: triple quote required to prevent globbing of environment variables
-            if self.is_dryrun:
-                self._cmd("""send-keys "echo -t {} \'{}\'" C-m""".format(pane_str, cmd))
-            else:
-                self._cmd("""send-keys -t {} '{}' C-m""".format(pane_str, cmd))
-        # Clear the command delay set by self.delay()
-        self.cmd_delay = 0
+        Reports the unknown keywords in the sequences
 
-    def capture(self, file=None):
+        :param      key_list:  The known keywords
+        :type       key_list:  list(str)
+
+        :returns:   The warnings
+        :rtype:     list(str)
         """
-        Captures the last pane to a file or screen
+        warning_list = list(self.warning_list)
+        for seq in self.sequence_list:
+            sequence = self.config[seq]
+            if type(sequence) is not dict:
+                continue
+            unknown_keys = set(sequence) - set(Plan.SEQKEY_LIST) - set(key_list)
+            for cmd_dict in self._cmd_dicts(sequence.get('CMDS') or []):
+                unknown_keys |= set(cmd_dict) - set(key_list)
+            for pane in sequence.get('NEW_PANES') or []:
+                for cmd_dict in pane.values():
+                    unknown_keys |= set(cmd_dict or {}) - set(key_list)
+            if unknown_keys:
+                warning_list.append('Unknown commands {} in sequence "{}"'.format(sorted(unknown_keys), seq))
+        return warning_list
 
-        :param      file:  The name of capture file to save
-        :type       file:  str
+    @staticmethod
+    def cache_dir():
+        """
+        Gets the directory of the cached plans
 
-        :returns:   pane contents
+        :returns:   The cache directory
         :rtype:     str
         """
-        pane_str = self._get_pane_str(self.pane_last)
-        # Capture pane contents, preserve line feeds
-        self._cmd('capture-pane -J -t {} -b {}'.format(pane_str, self.pane_last))
-        if file:
-            # Append to the save buffer
-            self._cmd('save-buffer -a -b {} {}'.format(self.pane_last, file))
-        else:
-            result = self._cmd('show-buffer -b {}'.format(self.pane_last), check_output=True)
-            self._cmd('delete-buffer -b {}'.format(self.pane_last))
-            if self.is_debug:
-                print(result.decode('utf-8'))
-            return result
+        cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        return os.path.join(cache_home, 'petmux')
 
-    def extract(self, cmd_patt_var, delay=1):
+    @staticmethod
+    def load(file_name, use_cache=True):
         """
-        Extracts the command contents from a regular expression to a variable list
+        Loads the plan of a configuration file, from the cache if the file is
+        unchanged since it was last compiled
 
-        :param      cmd_patt_var:  The command pattern
-        :type       cmd_patt_var:  command and regular expression
-        :param      delay:         The delay before ending the pipe capture
-        :type       delay:         number
+        :param      file_name:  The configuration <.yaml|.json> file
+        :type       file_name:  str
+        :param      use_cache:  Indicates if the plan cache is used
+        :type       use_cache:  boolean
+
+        :returns:   The plan or None if the configuration is empty
+        :rtype:     Plan
         """
-        pane_str = self._get_pane_str(self.pane_last)
-        with tempfile.NamedTemporaryFile() as fobj:
-            # Setup the pipe-pane to buffer
-            self._cmd("""pipe-pane -t {} -o 'cat > {}' """.format(pane_str, fobj.name))
-            # Send the command
-            self.shell(cmd_patt_var[0])
-            # Wait a bit before closing
-            if delay:
-                time.sleep(delay)
-            # Close the pipe-pane
-            self._cmd("""pipe-pane -t {}""".format(pane_str))
-            # Examine results
-            data = fobj.read()
-            if data:
-                match = re.search(cmd_patt_var[1], data.decode('utf-8'))
-                if match:
-                    for key, val in zip(cmd_patt_var[2:], match.groups()):
-                        self.set_env(key, '{}'.format(val))
+        with open(file_name, 'rb') as file:
+            data = file.read()
+        # NOTE: The petmux source is part of the key, so a changed Plan class
+        #       never unpickles a plan cached by an older petmux
+        with open(__file__, 'rb') as file:
+            digest = hashlib.sha256(data + file.read()).hexdigest()
+        cache_file = os.path.join(Plan.cache_dir(), digest + '.pickle')
+        if use_cache:
+            try:
+                with open(cache_file, 'rb') as file:
+                    plan = pickle.load(file)
+                if isinstance(plan, Plan):
+                    return plan
+            except Exception:
+                # Any unreadable plan is a cache miss, so it is compiled again
+                pass
+        ext = os.path.splitext(file_name)[1]
+        if ext == '.json':
+            config = json.loads(data.decode('utf-8'))
+        else:
+            # NOTE: yaml is imported here, since it adds ~15 ms to the ~75 ms
+            #       import of petmux, which JSON configurations and the daemon's
+            #       clients don't need
+            import yaml
+            # Prefer the C accelerated loader if libyaml is available
+            config = yaml.load(data, Loader=getattr(yaml, 'CFullLoader', yaml.FullLoader))
+        plan = Plan(config) if config else None
+        if plan and use_cache:
+            try:
+                os.makedirs(Plan.cache_dir(), exist_ok=True)
+                with tempfile.NamedTemporaryFile(dir=Plan.cache_dir(), delete=False) as file:
+                    pickle.dump(plan, file)
+                os.replace(file.name, cache_file)
+            except (OSError, pickle.PicklingError):
+                pass
+        return plan
 
 
 class PetMux:
@@ -328,13 +4196,22 @@ class PetMux:
         def __init__(self, sequence):
             self.sequence = sequence
 
+    class AbortException(Exception):
+        """
+        Exception for signaling ABORT when petmux is embedded (i.e. with an
+        on_abort callback or in run_async), instead of exiting
+        """
+        def __init__(self, return_code):
+            super().__init__('ABORT {}'.format(return_code))
+            self.return_code = return_code
 
-    def __init__(self, config, session=None, is_debug=True, is_dryrun=False, is_interactive=False):
+
+    def __init__(self, config, session=None, is_debug=True, is_dryrun=False, is_interactive=False, is_control=False, is_batch=False, is_parallel=False, socket=None, is_detached=False, tracer=None, is_reconcile=False, timings=None, is_simulated=False, archive=None, on_prompt=None, on_abort=None, cwd=None, env=None, stdin=None, stdout=None):
         """
         Constructs a new instance.
 
-        :param      config:          The configuration <.yaml|.json> file
-        :type       config:          str
+        :param      config:          The configuration or its compiled plan
+        :type       config:          dict or Plan
         :param      session:         The tmux session name
         :type       session:         str
         :param      is_debug:        Indicates if debug
@@ -343,26 +4220,172 @@ class PetMux:
         :type       is_dryrun:       boolean
         :param      is_interactive:  Indicates if interactive (i.e. single step mode)
         :type       is_interactive:  boolean
+        :param      is_control:      Indicates if tmux control mode is used
+        :type       is_control:      boolean
+        :param      is_batch:        Indicates if tmux commands are batched
+        :type       is_batch:        boolean
+        :param      is_parallel:     Indicates if each pane's CMDS run concurrently
+        :type       is_parallel:     boolean
+        :param      socket:          The tmux server socket name or path
+        :type       socket:          str
+        :param      is_detached:     Indicates if the session is driven without
+                                     a tmux client (i.e. all commands target
+                                     the session)
+        :type       is_detached:     boolean
+        :param      tracer:          The tracer that records the run, if any
+        :type       tracer:          Tracer
+        :param      is_reconcile:    Indicates if windows are converged to the
+                                     configuration from a snapshot of the
+                                     live state, instead of always created
+        :type       is_reconcile:    boolean
+        :param      timings:         The timings history that is recorded or
+                                     used for adaptive waits, if any
+        :type       timings:         Timings
+        :param      is_simulated:    Indicates if the tmux server is simulated
+                                     in memory (see SimTmux)
+        :type       is_simulated:    boolean
+        :param      archive:         The archive of the pane output, if any
+        :type       archive:         Archive
+        :param      on_prompt:       Answers the prompts instead of stdin, with
+                                     the prompt text (a function or coroutine
+                                     function that returns the response)
+        :type       on_prompt:       callable
+        :param      on_abort:        Called with the return code of ABORT,
+                                     which then raises AbortException instead
+                                     of exiting
+        :type       on_abort:        callable
+        :param      cwd:             The working directory of the relative
+                                     file names, None for the current one
+        :type       cwd:             str
+        :param      env:             The environment of tmux, None for the
+                                     process' own
+        :type       env:             dict
+        :param      stdin:           The user's input, None for sys.stdin
+        :type       stdin:           file
+        :param      stdout:          The output, None for sys.stdout
+        :type       stdout:          file
         """
-        self.config = config
+        self.plan = config if isinstance(config, Plan) else Plan(config)
+        self.config = self.plan.config
         self.session = session
         self.is_debug = is_debug
         self.is_interactive = is_interactive
+        self.is_parallel = is_parallel
+        self.is_reconcile = is_reconcile
+        # Indicates if this instance runs the commands of one pane in parallel mode
+        self.is_lane = False
+        # Trigger rules by name and the matches waiting for their actions
+        self.trigger_dict = {}
+        self.trigger_queue = queue.Queue()
         # Create a tmux object
-        self.tmux = Tmux(self.is_debug, is_dryrun)
+        if is_simulated:
+            self.tmux = SimTmux(self.is_debug, is_control, is_batch)
+        else:
+            self.tmux = Tmux(self.is_debug, is_dryrun, is_control, is_batch, socket=socket, is_detached=is_detached,
+                             tracer=tracer, timings=timings, archive=archive)
+        self.tmux.set_client(cwd, env, stdin, stdout)
+        self.tmux.on_input = on_prompt
+        self.on_abort = on_abort
+        if is_detached:
+            self.tmux.session(session)
         # Populate keyword dictionary
-        self.cfgkey_list = [
-            "DEFINES",
-            "TITLE",
-            "DESC",
+        self.cfgkey_list = Plan.CFGKEY_LIST
+        self.key_func_dict = self._key_func_dict()
+        self.async_func_dict = self._async_func_dict()
+        # Keywords that are run by themselves with all panes joined in parallel mode
+        self.serial_key_list = [
             "SESSION",
-            "NEW_WINDOW",
-            "NEW_PANES",
-            "CMDS",
+            "WINDOW",
+            "SPLIT",
+            "SEQUENCE",
+            "PROMPT",
+            "DECIDE",
+            "ABORT",
+            "BARRIER",
+            "TRIGGER",
         ]
+        if self.is_debug:
+            for warning in self.plan.check(self.key_func_dict.keys()):
+                print("Warning: {}".format(warning), file=self.tmux.stdout)
+        # Populate user defines into environment
+        if self.plan.define_dict:
+            if self.is_debug:
+                print("Loading environment", file=self.tmux.stdout)
+            for key, value in self.plan.define_dict.items():
+                self.tmux.set_env(key, value)
+        self._use_plan()
+
+    def _use_plan(self):
+        """
+        Uses the sequences, panes and patterns of the plan
+        """
+        # Get sequence list (i.e. entries that are not keywords)
+        self.sequence_list = self.plan.sequence_list
+        # Populate panes index
+        self.panes_dict = self.plan.panes_dict
+        self.tmux.window_dict = self.plan.window_dict
+        self.tmux.patt_dict = self.plan.patt_dict
+
+    def update(self, plan, run_list):
+        """
+        Applies the changes of the configuration to the sequences that were
+        run (see Plan.changes), leaving the rest alone.  The removed windows are
+        killed, the windows are converged to their panes from a snapshot of the
+        live state, the changed panes are restarted and set up again and the
+        changed sequences of CMDS are run again.
+
+        :param      plan:      The plan of the changed configuration
+        :type       plan:      Plan
+        :param      run_list:  The sequences that were run
+        :type       run_list:  list(str)
+
+        :returns:   The number of windows, panes and sequences updated
+        :rtype:     int
+        """
+        kill_list, window_dict, seq_list = plan.changes(self.plan, run_list)
+        for key, value in plan.define_dict.items():
+            if self.plan.define_dict.get(key) != value:
+                self.tmux.set_env(key, value)
+        self.plan = plan
+        self.config = plan.config
+        self._use_plan()
+        # The panes may have been changed by hand since the last update
+        self.tmux.state_dict = None
+        for session, window in kill_list:
+            print("{}Killing window {}{}".format(MAG, window, NON), file=self.tmux.stdout)
+            self.tmux.kill_windows(session or self.session, [window])
+        update_cnt = len(kill_list)
+        for seq in run_list:
+            if seq in window_dict:
+                sequence = self.config[seq]
+                window = sequence['NEW_WINDOW']
+                idx_list = window_dict[seq]
+                print("{}Updating window {}{}{}".format(MAG, window, ' panes {}'.format(idx_list) if idx_list else '', NON), file=self.tmux.stdout)
+                pane_list = [ [ v for v in pane.values() ][0] or {} for pane in self.panes_dict[window] ]
+                pane_skip = self.tmux.reconcile(sequence.get('SESSION') or self.session, window, pane_list, sequence.get('LAYOUT'), idx_list)
+                for pane_cnt, pane in enumerate(self.panes_dict[window], 1):
+                    if pane_cnt in idx_list or pane_cnt > pane_skip:
+                        self._setup_pane(pane, pane_cnt, True)
+                update_cnt += max(len(idx_list), 1)
+            elif seq in seq_list:
+                print("{}Running sequence {} again{}".format(MAG, seq, NON), file=self.tmux.stdout)
+                sequence = seq
+                while sequence:
+                    sequence = self.run(sequence)
+                update_cnt += 1
+        self.tmux.flush()
+        return update_cnt
+
+    def _key_func_dict(self):
+        """
+        Builds the keyword dictionary bound to this instance
+
+        :returns:   The keyword to function dictionary
+        :rtype:     dict
+        """
         # NOTE: This is an ordered dictionary that controls the sequence
         #       for the executing keywords
-        self.key_func_dict = {
+        return {
             "SESSION" : self.tmux.session,
             "WINDOW"  : self.tmux.window,
             "PANE"    : self.tmux.pane,
@@ -371,40 +4394,45 @@ class PetMux:
             "DELAY"   : self.tmux.delay,
             "ECHO"    : self.echo,
             "SEQUENCE": self.sequence,
+            "TRIGGER" : self.trigger,
+            "EXEC"    : self.tmux.respawn,
             "SHELL"   : self.tmux.shell,
+            "PASTE"   : self.tmux.paste,
+            "SCRIPT"  : self.tmux.script,
+            "WAIT_FOR": self.tmux.wait_for,
             "EXTRACT" : self.tmux.extract,
             "CAPTURE" : self.tmux.capture,
+            "LOG"     : self.tmux.log,
+            "ARCHIVE" : self.tmux.archive,
             "PROMPT"  : self.prompt,
             "DECIDE"  : self.decide,
             "PAUSE"   : self.pause,
+            "BARRIER" : self.barrier,
             "ABORT"   : self.abort,
         }
-        # Populate user defines into environment
-        if "DEFINES" in self.config.keys():
-            if self.is_debug:
-                print("Loading environment")
-            for key, value in self.config["DEFINES"].items():
-                # Expand any discovered variable
-                value = self.tmux.expand(value)
-                self.tmux.set_env(key, value)
-        # Get sequence list (i.e. entries that are not keywords)
-        self.sequence_list = list(set(self.config.keys()) - set(self.cfgkey_list))
-        # Populate panes index
-        # Search for sequence that contains "NEW_WINDOW" which configures a window
-        self.panes_dict = {}
-        for seq in self.sequence_list:
-            sequence = self.config[seq]
-            if "NEW_WINDOW" in sequence.keys():
-                # Found "NEW_PANES", so save the list
-                window_name = sequence['NEW_WINDOW']
-                self.panes_dict[window_name] = sequence['NEW_PANES']
-                pane_num = 1
-                for pane in self.panes_dict[window_name]:
-                    # Workaround to get key and values for a pane
-                    pane_name = [ k for k in pane.keys() ][0]
-                    # Associate the pane_name to pane index
-                    self.tmux.name_pane(window_name, pane_name, pane_num)
-                    pane_num += 1
+
+    def _async_func_dict(self):
+        """
+        Builds the dictionary of the keywords that run_async runs on the event
+        loop instead of a thread, bound to this instance
+
+        :returns:   The keyword to coroutine function dictionary
+        :rtype:     dict
+        """
+        async_func_dict = {
+            "DELAY"   : self._call_async(self.tmux.delay),
+            "ECHO"    : self._call_async(self.echo),
+            "SEQUENCE": self._call_async(self.sequence),
+            "PROMPT"  : self._prompt_async,
+            "PAUSE"   : self._pause_async,
+            "ABORT"   : self._abort_async,
+        }
+        # NOTE: The simulation doesn't wait, so it runs its own EXTRACT and
+        #       WAIT_FOR on a thread
+        if not isinstance(self.tmux, SimTmux):
+            async_func_dict["EXTRACT"] = self._extract_async
+            async_func_dict["WAIT_FOR"] = self._wait_for_async
+        return async_func_dict
 
     def kill(self, window=None):
         """
@@ -413,41 +4441,262 @@ class PetMux:
         :param      window:  Window name, if None then all windows listed
         :type       window:  str
         """
-        if self.is_debug:
-            print("Killing windows")
-        if self.session:
-            self.tmux.session(self.session)
-        window = window if window else self.panes_dict.keys()
-        for win in window:
-            self.tmux.kill(win)
+        if self.is_debug:
+            print("Killing windows", file=self.tmux.stdout)
+        window = window if window else self.panes_dict.keys()
+        if self.is_reconcile:
+            # Only kill the windows that exist
+            self.tmux.kill_windows(self.session, window)
+            return
+        if self.session:
+            self.tmux.session(self.session)
+        for win in window:
+            self.tmux.kill(win)
+
+    def list(self, sequence=None):
+        """
+        Print the list of available sequences or sequence contents
+
+        :param      sequence:  None - List available sequence, otherwise the
+                               content of sequence
+        """
+        if sequence in self.sequence_list:
+            # print(json.dumps(self.config[sequence], indent=2))
+            import yaml
+            print(yaml.dump(self.config[sequence]), file=self.tmux.stdout)
+        else:
+            print(self.sequence_list, file=self.tmux.stdout)
+
+    def pause(self, delay=1):
+        """
+        Wait for delay, or the time learned from how long the output of the
+        last shell command took to settle in adaptive mode
+
+        :param      delay:  The delay
+        :type       delay:  number
+        """
+        wait = self.tmux.wait_time('PAUSE', self.tmux.shell_last, delay)
+        if self.is_debug:
+            print("Waiting({:.3g})...".format(wait), file=self.tmux.stdout)
+        self.tmux.flush()
+        if self.tmux.timings and self.tmux.timings.is_record:
+            elapsed = self.tmux.settle(wait)
+            # NOTE: Output still arriving at the end of a learned wait may have
+            #       been cut short, so it isn't recorded
+            if wait == delay or elapsed + Timings.PADDING < wait:
+                self.tmux.record_time('PAUSE', self.tmux.shell_last, elapsed)
+        elif any(entry['handle_list'] for entry in self.trigger_dict.values()) and not self.is_lane:
+            # Run the trigger actions as they arrive
+            with self.tmux.trace('sleep', 'pause', delay=wait):
+                self.fire(wait)
+        else:
+            self.tmux.sleep(wait, 'pause')
+
+    def trigger(self, option):
+        """
+        Adds rules that react to pane output whenever it shows up (e.g. a crash
+        backtrace or a login prompt).  A rule is a dictionary with MATCH (the
+        regular expression), PANES (default is the last pane), SET (a variable
+        or list of variables for the groups, named groups are always bound),
+        RUN (keywords to run in the matching pane), SEQUENCE (switch to the
+        sequence), ONCE, PARTIAL (also match the incomplete last line, e.g. a
+        prompt) and NAME (replaces the rule of the same name, default is
+        MATCH).  The output of all of the panes is matched by the reader of the
+        pane monitor and the actions are run between the commands of the
+        sequence and during PAUSE.  SET is set as soon as the output matches
+        and SEQUENCE also ends the EXTRACT or WAIT_FOR in progress.  OFF
+        removes all of the rules and STOP removes the rule of the NAME.
+
+        :param      option:  The rule, list of rules or OFF
+        :type       option:  dict or list(dict) or str
+        """
+        if option in ('OFF', False):
+            for name in list(self.trigger_dict):
+                self._trigger_stop(name)
+            return
+        for rule in option if type(option) is list else [option]:
+            if type(rule) is not dict or not (rule.get('MATCH') or rule.get('STOP')):
+                print("{}TRIGGER needs a MATCH: {}{}".format(RED, rule, NON), file=self.tmux.stdout)
+                continue
+            name = '{}'.format(rule.get('NAME') or rule.get('MATCH'))
+            self._trigger_stop(name)
+            if rule.get('STOP'):
+                continue
+            patt = self.tmux._compile(rule['MATCH'])
+            pane_list = rule.get('PANES', [self.tmux.pane_last])
+            pane_list = pane_list if type(pane_list) is list else [pane_list]
+            entry = {'name': name, 'rule': rule, 'handle_list': [], 'is_done': False}
+            for pane in pane_list:
+                pane_str = self.tmux._get_pane_str(pane)
+                scanner = OutputScanner(patt, self.tmux.max_output)
+                target = (self.tmux.window_last, pane, pane_str)
+                if self.is_debug:
+                    print("    trigger> {} on {}".format(name, pane_str), file=self.tmux.stdout)
+                handle = self.tmux.monitor.watch(pane_str, lambda data, entry=entry, target=target, scanner=scanner: self._trigger_feed(entry, target, scanner, data))
+                if handle:
+                    entry['handle_list'].append(handle)
+            self.trigger_dict[name] = entry
+        self.tmux.flush()
+
+    def _trigger_stop(self, name):
+        """
+        Removes a trigger rule
+
+        :param      name:  The rule name
+        :type       name:  str
+        """
+        entry = self.trigger_dict.pop(name, None)
+        if entry:
+            entry['is_done'] = True
+            for handle in entry['handle_list']:
+                self.tmux.monitor.unwatch(handle)
+
+    def _trigger_feed(self, entry, target, scanner, data):
+        """
+        Matches the output of a pane against a trigger rule and queues each
+        match for the main loop.  This runs on the pane monitor's reader, which
+        sets the variables at once and, for a rule that switches the sequence,
+        ends the EXTRACT or WAIT_FOR in progress.
+
+        :param      entry:    The trigger rule entry
+        :type       entry:    dict
+        :param      target:   The window, pane and target pane string
+        :type       target:   tuple
+        :param      scanner:  The pane's scanner
+        :type       scanner:  OutputScanner
+        :param      data:     The output
+        :type       data:     bytes
+        """
+        match = scanner.feed(data)
+        while not entry['is_done']:
+            if not match and entry['rule'].get('PARTIAL'):
+                # Also match the incomplete line (e.g. a login prompt)
+                match = scanner.patt.search(scanner.text)
+            if not match:
+                break
+            group_list = match.groups() or (match.group(0),)
+            for key, val in self._trigger_vars(entry['rule'], group_list, match.groupdict()):
+                self.tmux.set_var(key, val)
+            self.trigger_queue.put((entry, target, group_list, match.groupdict(), match.group(0)))
+            if entry['rule'].get('SEQUENCE'):
+                self.tmux.interrupt()
+            if entry['rule'].get('ONCE'):
+                entry['is_done'] = True
+                break
+            match = scanner.consume(match)
+
+    @staticmethod
+    def _trigger_vars(rule, group_list, group_dict):
+        """
+        Binds the groups of a trigger match to the variables of its SET
+
+        :param      rule:        The trigger rule
+        :type       rule:        dict
+        :param      group_list:  The groups of the match
+        :type       group_list:  tuple
+        :param      group_dict:  The named groups of the match
+        :type       group_dict:  dict
+
+        :returns:   The variables and their values
+        :rtype:     list(tuple(str, str))
+        """
+        var = rule.get('SET')
+        var_list = var if type(var) is list else [var] if var else []
+        return [ (key, '{}'.format(val)) for key, val in list(zip(var_list, group_list)) + list(group_dict.items()) if val is not None ]
+
+    def fire(self, timeout=0):
+        """
+        Runs the actions of the queued trigger matches, waiting up to the
+        timeout for more.  Only the main loop runs the actions, not the pane
+        lanes of parallel mode.
+
+        :param      timeout:  The time to wait for matches [in S]
+        :type       timeout:  number
+        """
+        end = time.time() + timeout
+        self.tmux.interrupt_event.clear()
+        waker = lambda: self.trigger_queue.put(None)
+        self.tmux.waker_set.add(waker)
+        try:
+            while not self.is_lane:
+                try:
+                    remaining = end - time.time()
+                    event = self.trigger_queue.get(timeout=remaining) if remaining > 0 else self.trigger_queue.get_nowait()
+                except queue.Empty:
+                    return
+                self.tmux.check()
+                if event:
+                    self._trigger_run(*event)
+        finally:
+            self.tmux.waker_set.discard(waker)
+        self.tmux._wait(end - time.time())
 
-    def list(self, sequence=None):
+    def _trigger_run(self, entry, target, group_list, group_dict, text):
         """
-        Print the list of available sequences or sequence contents
+        Runs the actions of a trigger match: sets the variables, runs the
+        keywords in the matching pane and switches the sequence
 
-        :param      sequence:  None - List available sequence, otherwise the
-                               content of sequence
+        :param      entry:       The trigger rule entry
+        :type       entry:       dict
+        :param      target:      The window, pane and target pane string
+        :type       target:      tuple
+        :param      group_list:  The groups of the match
+        :type       group_list:  tuple
+        :param      group_dict:  The named groups of the match
+        :type       group_dict:  dict
+        :param      text:        The matched text
+        :type       text:        str
         """
-        if sequence in self.sequence_list:
-            # print(json.dumps(self.config[sequence], indent=2))
-            print(yaml.dump(self.config[sequence]))
-        else:
-            print(self.sequence_list)
+        rule = entry['rule']
+        if rule.get('ONCE') and self.trigger_dict.get(entry['name']) is entry:
+            self._trigger_stop(entry['name'])
+        print("{}Trigger {} in {}: {}{}".format(MAG, entry['name'], target[2], text.strip(), NON), file=self.tmux.stdout)
+        # NOTE: The reader already set the variables, this sets them in the
+        #       tmux environment
+        for key, val in self._trigger_vars(rule, group_list, group_dict):
+            self.tmux.set_env(key, val)
+        run_list = rule.get('RUN') or []
+        window_last, pane_last = self.tmux.window_last, self.tmux.pane_last
+        self.tmux.window_last, self.tmux.pane_last = target[0], target[1]
+        try:
+            with self.tmux.trace('TRIGGER', 'keyword', value=entry['name']):
+                for cmd in run_list if type(run_list) is list else [run_list]:
+                    if type(cmd) is dict:
+                        for key in self.key_func_dict.keys():
+                            if key in cmd:
+                                self.key_func_dict[key](cmd[key])
+                    else:
+                        self.tmux.shell(cmd)
+        finally:
+            self.tmux.window_last, self.tmux.pane_last = window_last, pane_last
+        if rule.get('SEQUENCE'):
+            self.sequence(rule['SEQUENCE'])
 
-    def pause(self, delay=1):
+    def barrier(self, value):
         """
-        Wait for delay
+        Join point for the panes running in parallel mode.  The panes are
+        joined before this is called, so there is nothing left to do.
 
-        :param      delay:  The delay
-        :type       delay:  number
+        :param      value:  Unused
+        :type       value:  any
         """
-        if self.is_debug:
-            print("Waiting(%d)..." % delay)
-        time.sleep(delay)
+        self.tmux.flush()
 
     def abort(self, return_code):
+        """
+        Stops the run with the return code.  When embedded, the on_abort
+        callback is called and AbortException is raised instead of exiting.
+
+        :param      return_code:  The return code
+        :type       return_code:  int
+        """
         if self.is_debug:
-            print("Aborting with {}".format(return_code))
+            print("Aborting with {}".format(return_code), file=self.tmux.stdout)
+        self.tmux.flush()
+        if self.on_abort:
+            self.on_abort(return_code)
+        if self.on_abort or self.tmux.loop:
+            raise PetMux.AbortException(return_code)
         sys.exit(return_code)
 
     def echo(self, message):
@@ -457,7 +4706,7 @@ class PetMux:
         :param      message:  The message
         :type       message:  str
         """
-        print(message)
+        print(message, file=self.tmux.stdout)
 
     def prompt(self, banner_key):
         """
@@ -468,7 +4717,8 @@ class PetMux:
         """
         banner = banner_key[0] if type(banner_key) is list else banner_key
         key = banner_key[1] if type(banner_key) is list else None
-        resp = input(YEL + banner + NON)
+        self.tmux.flush()
+        resp = self.tmux.input(YEL + banner + NON)
         if key:
             self.tmux.set_env(key, resp)
 
@@ -486,10 +4736,10 @@ class PetMux:
             value = self.tmux.get_env()[key]
             if value in self.config:
                 #TODO: Select the next sequence to run
-                print("{}Selected Sequence {}{}".format(MAG, value, NON))
+                print("{}Selected Sequence {}{}".format(MAG, value, NON), file=self.tmux.stdout)
             elif value in decide_dict:
                 # Invoke the command
-                print("{}Matched {}{}".format(MAG, value, NON))
+                print("{}Matched {}{}".format(MAG, value, NON), file=self.tmux.stdout)
                 cmd = decide_dict[value]
                 cmd_list = cmd if type(cmd) is list else [cmd]
                 for cmd in cmd_list:
@@ -499,13 +4749,13 @@ class PetMux:
                     else:
                         self.tmux.shell(cmd)
         except KeyError as e:
-            print("{}Couldn't resolve {}{}".format(RED, e, NON))
+            print("{}Couldn't resolve {}{}".format(RED, e, NON), file=self.tmux.stdout)
 
     def sequence(self, sequence):
         if sequence in self.config:
             raise PetMux.SequenceException(sequence)
         else:
-            print("{}No Sequence {} found!{}".format(RED, sequence, NON))
+            print("{}No Sequence {} found!{}".format(RED, sequence, NON), file=self.tmux.stdout)
 
     def run(self, sequence):
         """
@@ -517,8 +4767,51 @@ class PetMux:
         :returns:   Next sequence if selected
         :rtype:     str
         """
+        self.tmux.sequence_last = sequence
+        with self.tmux.trace(sequence, 'sequence'):
+            return self._run(self.config[sequence])
+
+    def _run(self, sequence):
+        """
+        Runs the sequence
+
+        :param      sequence:  The sequence dictionary
+        :type       sequence:  dict
+
+        :returns:   Next sequence if selected
+        :rtype:     str
+        """
+        title, is_new_window = self._setup(sequence)
+        # Step 2b: Check if cmds are present to run
+        if 'CMDS' in sequence.keys() and not is_new_window:
+            # Run the commands
+            cmds_list = sequence['CMDS']
+            if self.is_parallel and not self.is_interactive:
+                return asyncio.run(self._run_lanes(cmds_list, title))
+            for cmd_dict in cmds_list:
+                next_sequence = self._run_cmd(cmd_dict, title)
+                if next_sequence:
+                    return next_sequence
+            # Run the actions of the matches during the last command
+            try:
+                self.fire()
+            except PetMux.SequenceException as e:
+                print("{}Switching sequence to {}{}".format(GRN, e.sequence, NON), file=self.tmux.stdout)
+                return e.sequence
+        return None
+
+    def _setup(self, sequence):
+        """
+        Prints the banner of the sequence, selects its session and window and
+        sets up the panes of a new window
+
+        :param      sequence:  The sequence dictionary
+        :type       sequence:  dict
+
+        :returns:   The title and if a new window was set up
+        :rtype:     tuple(str, boolean)
+        """
         # Step 1: Print title and description if any
-        sequence = self.config[sequence]
         if 'NEW_WINDOW' in sequence.keys():
             title = sequence['NEW_WINDOW']
             sequence['WINDOW'] = title
@@ -529,103 +4822,1139 @@ class PetMux:
         desc = sequence['DESC'] if 'DESC' in sequence.keys() else ""
         banner_length = max(len(title), len(desc))
         if title:
-            print('\n' + '=' * banner_length)
-            print(title)
-            print('-' * banner_length)
+            print('\n' + '=' * banner_length, file=self.tmux.stdout)
+            print(title, file=self.tmux.stdout)
+            print('-' * banner_length, file=self.tmux.stdout)
         if desc:
-            print(desc)
-            print('-' * banner_length)
-        # Select or add a window
-        if 'WINDOW' in sequence.keys():
-            self.tmux.window(sequence['WINDOW'])
-        # Step 2a: Check if window's panes are present to setup
-        if 'NEW_PANES' in sequence.keys() and 'NEW_WINDOW' in sequence.keys():
+            print(desc, file=self.tmux.stdout)
+            print('-' * banner_length, file=self.tmux.stdout)
+        is_new_window = 'NEW_PANES' in sequence.keys() and 'NEW_WINDOW' in sequence.keys()
+        is_reconcile = self.is_reconcile and is_new_window
+        # Select the session first, so a new window is created in it
+        if is_new_window and not is_reconcile:
             if 'SESSION' in sequence.keys():
                 self.tmux.session(sequence['SESSION'])
             else:
                 self.tmux.session(self.session)
+        # Select or add a window
+        if 'WINDOW' in sequence.keys() and not is_reconcile:
+            self.tmux.window(sequence['WINDOW'])
+        # Step 2a: Check if window's panes are present to setup
+        if is_new_window:
             window = sequence['NEW_WINDOW']
+            layout = sequence.get('LAYOUT')
+            pane_list = [ [ v for v in pane.values() ][0] or {} for pane in self.panes_dict[window] ]
+            pane_skip = 0
+            if is_reconcile:
+                # Only the missing panes are created and setup
+                pane_skip = self.tmux.reconcile(sequence.get('SESSION') or self.session, window, pane_list, layout)
+            else:
+                # With a LAYOUT, the panes are all created up front in one batch
+                if layout:
+                    self.tmux.layout(layout, pane_list)
             # Each pane is setup by the keyword commands
             pane_cnt = 0
             for pane in self.panes_dict[window]:
-                if self.is_debug:
-                    pane_name = [ k for k in pane.keys() ][0]
-                    print("{}[ {} ]{}".format(CYN, pane_name, NON))
-                # Workaround to get values for a pane
-                cmd_dict = [ v for v in pane.values() ][0]
-                # if SPLIT option is not defined for the pane, then use default split
-                if "SPLIT" not in cmd_dict and pane_cnt > 0:
-                    self.tmux.split(None)
                 pane_cnt += 1
-                # Process the pane commands by the order of key_func_dict.
-                for key in self.key_func_dict.keys():
-                    if key in cmd_dict:
-                        if key == 'SHELL':
-                            if self.is_interactive:
-                                input("{}  >>> 'Enter' to run[{}]: {} <<<{}".format(YEL, key, cmd_dict[key], NON))
-                            self.key_func_dict[key](cmd_dict[key], pane_cnt)
-                        elif key in cmd_dict:
-                            self.key_func_dict[key](cmd_dict[key],)
-        # Step 2b: Check if cmds are present to run
-        elif 'CMDS' in sequence.keys():
-            # Run the commands
-            cmds_list = sequence['CMDS']
+                if pane_cnt <= pane_skip:
+                    continue
+                self._setup_pane(pane, pane_cnt, bool(layout or is_reconcile))
+        return title, is_new_window
+
+    def _setup_pane(self, pane, pane_cnt, is_created=False):
+        """
+        Sets up a pane of a new window by its keyword commands
+
+        :param      pane:        The pane name and keywords
+        :type       pane:        dict
+        :param      pane_cnt:    The pane number
+        :type       pane_cnt:    int
+        :param      is_created:  Indicates if the pane was already created (i.e.
+                                 by the layout or reconcile)
+        :type       is_created:  boolean
+        """
+        # Workaround to get values for a pane
+        cmd_dict = [ v for v in pane.values() ][0] or {}
+        if self.is_debug:
+            pane_name = [ k for k in pane.keys() ][0]
+            print("{}[ {} ]{}".format(CYN, pane_name, NON), file=self.tmux.stdout)
+        # if SPLIT option is not defined for the pane, then use default split
+        if "SPLIT" not in cmd_dict and pane_cnt > 1 and not is_created:
+            self.tmux.split(None)
+        # Process the pane commands by the order of key_func_dict.
+        for key in self.key_func_dict.keys():
+            if key in cmd_dict:
+                if is_created and key in ('SPLIT', 'EXEC'):
+                    # Already done by the layout or reconcile
+                    continue
+                if key in ('SHELL', 'EXEC', 'PASTE', 'SCRIPT'):
+                    if self.is_interactive:
+                        self.tmux.flush()
+                        self.tmux.input("{}  >>> 'Enter' to run[{}]: {} <<<{}".format(YEL, key, cmd_dict[key], NON))
+                    with self.tmux.trace(key, 'keyword', value=cmd_dict[key]):
+                        self.key_func_dict[key](cmd_dict[key], pane_cnt)
+                elif key in cmd_dict:
+                    with self.tmux.trace(key, 'keyword', value=cmd_dict[key]):
+                        self.key_func_dict[key](cmd_dict[key],)
+
+    def _run_cmd(self, cmd_dict, title):
+        """
+        Runs the keywords of a CMDS entry
+
+        :param      cmd_dict:  The CMDS entry
+        :type       cmd_dict:  dict
+        :param      title:     The sequence title
+        :type       title:     str
+
+        :returns:   Next sequence if selected
+        :rtype:     str
+        """
+        # Report unknown commands
+        unknown_cmds = list(set(cmd_dict) - set(self.key_func_dict.keys()))
+        if unknown_cmds:
+            print('Warning: Unknown commands {} in sequence "{}"'.format(unknown_cmds, title), file=self.tmux.stdout)
+        # Run the actions of any trigger matches first
+        try:
+            self.fire()
+        except PetMux.SequenceException as e:
+            print("{}Switching sequence to {}{}".format(GRN, e.sequence, NON), file=self.tmux.stdout)
+            return e.sequence
+        # Process the pane commands by the order of key_func_dict.
+        for key in self.key_func_dict.keys():
+            if key in cmd_dict:
+                if self.is_interactive:
+                    self.tmux.flush()
+                    self.tmux.input("{}  >>> 'Enter' to run[{}]: {} <<<{}".format(YEL, key, cmd_dict[key], NON))
+                try:
+                    with self.tmux.trace(key, 'keyword', value=cmd_dict[key]):
+                        self.key_func_dict[key](cmd_dict[key])
+                    # A trigger that switches the sequence ended the keyword
+                    if self.tmux.interrupt_event.is_set():
+                        self.fire()
+                except PetMux.SequenceException as e:
+                    # A new sequence is request, switch to it.
+                    print("{}Switching sequence to {}{}".format(GRN, e.sequence, NON), file=self.tmux.stdout)
+                    return e.sequence
+        return None
+
+    async def run_async(self, sequence):
+        """
+        Runs the selected sequence on the running event loop, so one loop can
+        drive many PetMux instances (one per session).  DELAY, ECHO, SEQUENCE,
+        PROMPT, PAUSE, EXTRACT, WAIT_FOR and ABORT wait on the loop, and the
+        tmux commands borrow a thread of the loop's executor.  The run is
+        cancellable at any point, which also ends the waits of the keyword in
+        progress, e.g. asyncio.wait_for(pm.run_async('test'), 60).  ABORT
+        raises AbortException.
+
+        :param      sequence:  The sequence name
+        :type       sequence:  str
+
+        :returns:   Next sequence if selected
+        :rtype:     str
+        """
+        self.tmux.loop = asyncio.get_running_loop()
+        self.tmux.cancel_event.clear()
+        self.tmux.sequence_last = sequence
+        try:
+            with self.tmux.trace(sequence, 'sequence'):
+                sequence_dict = self.config[sequence]
+                title, is_new_window = await asyncio.to_thread(self._setup, sequence_dict)
+                if 'CMDS' not in sequence_dict or is_new_window:
+                    return None
+                if self.is_parallel and not self.is_interactive:
+                    return await self._run_lanes(sequence_dict['CMDS'], title)
+                for cmd_dict in sequence_dict['CMDS']:
+                    next_sequence = await self._run_cmd_async(cmd_dict, title)
+                    if next_sequence:
+                        return next_sequence
+                # Run the actions of the matches during the last command
+                try:
+                    if not self.trigger_queue.empty():
+                        await asyncio.to_thread(self.fire)
+                except PetMux.SequenceException as e:
+                    print("{}Switching sequence to {}{}".format(GRN, e.sequence, NON), file=self.tmux.stdout)
+                    return e.sequence
+                return None
+        except asyncio.CancelledError:
+            self.tmux.cancel()
+            raise
+        finally:
+            self.tmux.loop = None
+
+    async def _run_cmd_async(self, cmd_dict, title):
+        """
+        Runs the keywords of a CMDS entry on the event loop (see run_async)
+
+        :param      cmd_dict:  The CMDS entry
+        :type       cmd_dict:  dict
+        :param      title:     The sequence title
+        :type       title:     str
+
+        :returns:   Next sequence if selected
+        :rtype:     str
+        """
+        unknown_cmds = list(set(cmd_dict) - set(self.key_func_dict.keys()))
+        if unknown_cmds:
+            print('Warning: Unknown commands {} in sequence "{}"'.format(unknown_cmds, title), file=self.tmux.stdout)
+        try:
+            # Run the actions of any trigger matches first
+            if not self.trigger_queue.empty():
+                await asyncio.to_thread(self.fire)
+            for key in self.key_func_dict.keys():
+                if key in cmd_dict:
+                    if self.is_interactive:
+                        await self._input_async("{}  >>> 'Enter' to run[{}]: {} <<<{}".format(YEL, key, cmd_dict[key], NON))
+                    with self.tmux.trace(key, 'keyword', value=cmd_dict[key]):
+                        if key in self.async_func_dict:
+                            await self.async_func_dict[key](cmd_dict[key])
+                        else:
+                            await asyncio.to_thread(self.key_func_dict[key], cmd_dict[key])
+                    # A trigger that switches the sequence ended the keyword
+                    if self.tmux.interrupt_event.is_set():
+                        await asyncio.to_thread(self.fire)
+        except PetMux.SequenceException as e:
+            # A new sequence is request, switch to it.
+            print("{}Switching sequence to {}{}".format(GRN, e.sequence, NON), file=self.tmux.stdout)
+            return e.sequence
+        return None
+
+    @staticmethod
+    def _call_async(func):
+        """
+        Wraps a keyword that doesn't wait (e.g. ECHO) to run on the event loop
+
+        :param      func:  The keyword function
+        :type       func:  callable
+
+        :returns:   The coroutine function
+        :rtype:     callable
+        """
+        async def call(value):
+            return func(value)
+        return call
+
+    async def _flush_async(self):
+        """
+        Sends the queued tmux commands, if any, from a thread
+        """
+        if self.tmux.cmd_queue:
+            await asyncio.to_thread(self.tmux.flush)
+
+    async def _input_async(self, prompt):
+        """
+        Gets the response to a prompt from the on_prompt callback on the event
+        loop, or otherwise from stdin on a thread
+
+        :param      prompt:  The prompt
+        :type       prompt:  str
+
+        :returns:   The response
+        :rtype:     str
+        """
+        await self._flush_async()
+        if not self.tmux.on_input:
+            return await asyncio.to_thread(self.tmux.input, prompt)
+        with self.tmux.trace('input', 'input', prompt=prompt):
+            resp = self.tmux.on_input(PaneLogger.ANSI.sub('', prompt))
+            if inspect.isawaitable(resp):
+                resp = await resp
+        return resp
+
+    async def _prompt_async(self, banner_key):
+        """
+        Prompt user for input on the event loop (see prompt)
+
+        :param      banner_key:  The user banner prompt and optional key
+        :type       banner_key:  str or list(str, str)
+        """
+        banner = banner_key[0] if type(banner_key) is list else banner_key
+        key = banner_key[1] if type(banner_key) is list else None
+        resp = await self._input_async(YEL + banner + NON)
+        if key:
+            self.tmux.set_env(key, resp)
+
+    async def _pause_async(self, delay=1):
+        """
+        Wait for delay on the event loop (see pause).  Recording the timings
+        and running the trigger actions watch the output from a thread.
+
+        :param      delay:  The delay
+        :type       delay:  number
+        """
+        if (self.tmux.timings and self.tmux.timings.is_record) or any(entry['handle_list'] for entry in self.trigger_dict.values()):
+            return await asyncio.to_thread(self.pause, delay)
+        wait = self.tmux.wait_time('PAUSE', self.tmux.shell_last, delay)
+        if self.is_debug:
+            print("Waiting({:.3g})...".format(wait), file=self.tmux.stdout)
+        await self._flush_async()
+        with self.tmux.trace('sleep', 'pause', delay=wait):
+            await asyncio.sleep(wait)
+
+    async def _extract_async(self, cmd_patt_var):
+        """
+        Extracts the command contents to variables on the event loop, where the
+        pane output is read as it arrives (see Tmux.extract)
+
+        :param      cmd_patt_var:  The command pattern or extract dictionary
+        :type       cmd_patt_var:  list or dict
+        """
+        tmux = self.tmux
+        scan = tmux._extract_scanner(cmd_patt_var)
+        if not scan:
+            return
+        cmd, scanner, wait = scan
+        stream = AsyncPaneStream(tmux, tmux._get_pane_str(tmux.pane_last), asyncio.get_running_loop())
+        await asyncio.to_thread(stream.open)
+        try:
+            # Send the command
+            start = time.time()
+            await asyncio.to_thread(tmux.shell, cmd)
+            await self._flush_async()
+            # Examine results as they arrive, until the timeout
+            result = None
+            with tmux.trace('extract', 'extract', cmd=cmd, timeout=wait) as trace_args:
+                while not result and time.time() - start < wait and not tmux.interrupt_event.is_set():
+                    data = await stream.read(wait - (time.time() - start))
+                    tmux.check()
+                    if data:
+                        result = scanner.feed(data)
+                trace_args['match'] = bool(result)
+        finally:
+            await asyncio.to_thread(stream.close)
+        tmux._extract_bind(cmd_patt_var, scanner, result, time.time() - start)
+
+    async def _wait_for_async(self, cmd_var_timeout):
+        """
+        Sends a shell command and waits for it to complete on the event loop,
+        with a tmux wait-for process (see Tmux.wait_for)
+
+        :param      cmd_var_timeout:  The command, optional variable for the exit
+                                      status and optional timeout [in S]
+        :type       cmd_var_timeout:  str or list(str, str, number)
+        """
+        tmux = self.tmux
+        cmd_list = cmd_var_timeout if type(cmd_var_timeout) == list else [cmd_var_timeout]
+        wait = await asyncio.to_thread(tmux._wait_send, cmd_list)
+        if wait is None:
+            return
+        channel, timeout, start = wait
+        proc = await asyncio.create_subprocess_exec(*(tmux.tmux_args + ['wait-for', channel]), cwd=tmux.cwd, env=tmux.env)
+        waker = tmux._wait_waker(channel)
+        tmux.waker_set.add(waker)
+        try:
+            with tmux.trace('wait-for', 'wait_for', cmd=cmd_list[0], timeout=timeout):
+                await asyncio.wait_for(proc.wait(), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            await asyncio.to_thread(tmux._wait_timeout, cmd_list, channel)
+            return
+        except asyncio.CancelledError:
+            proc.kill()
+            # NOTE: The cleanup isn't awaited, since the run is cancelled
+            asyncio.get_running_loop().run_in_executor(None, tmux._wait_cleanup, channel)
+            raise
+        finally:
+            tmux.waker_set.discard(waker)
+        if tmux.interrupt_event.is_set():
+            await asyncio.to_thread(tmux._wait_cleanup, channel)
+            return
+        await asyncio.to_thread(tmux._wait_status, cmd_list, channel, start)
+
+    async def _abort_async(self, return_code):
+        """
+        Stops the run with the return code on the event loop (see abort)
+
+        :param      return_code:  The return code
+        :type       return_code:  int
+        """
+        await self._flush_async()
+        self.abort(return_code)
+
+    def _fork(self, pane=None):
+        """
+        Creates a PetMux instance for running the commands of a pane
+        concurrently with the other panes, or without a pane, for running a
+        sequence concurrently with other sequences with its own triggers
+
+        :param      pane:  The pane name or number
+        :type       pane:  str or int
+
+        :returns:   The forked PetMux instance
+        :rtype:     PetMux
+        """
+        pm = copy.copy(self)
+        pm.tmux = self.tmux.fork(pane is None)
+        if pane is None:
+            pm.trigger_dict = {}
+            pm.trigger_queue = queue.Queue()
+        else:
+            pm.is_lane = True
+            pm.tmux.pane(pane)
+        pm.key_func_dict = pm._key_func_dict()
+        pm.async_func_dict = pm._async_func_dict()
+        return pm
+
+    def run_dag(self, sequence_list, jobs=8):
+        """
+        Runs the sequences concurrently in the order of their DEPENDS (see
+        Plan.dag), up to jobs at a time.  The variables are shared, so the
+        variables a sequence PROVIDES are set for the sequences that depend on
+        it.  The sequences that depend on a failed sequence are skipped.  A
+        report of each sequence and the critical path is printed at the end.
+
+        :param      sequence_list:  The sequences to run
+        :type       sequence_list:  list(str)
+        :param      jobs:           The maximum concurrent sequences
+        :type       jobs:           int
+
+        :returns:   The number of sequences that failed or were skipped
+        :rtype:     int
+        """
+        dep_dict, error_list = self.plan.dag(sequence_list)
+        for error in error_list:
+            print("{}Error: {}{}".format(RED, error, NON), file=self.tmux.stdout)
+        if error_list:
+            return len(error_list)
+        if not dep_dict:
+            # Nothing to run, so there is no report or critical path
+            print("{}No sequences to run{}".format(YEL, NON), file=self.tmux.stdout)
+            return 0
+        start = time.time()
+
+        def run_node(seq):
+            node_start = time.time()
+            pm = self._fork()
+            try:
+                result = 0
+                sequence = seq
+                while sequence:
+                    sequence = pm.run(sequence)
+                    # NOTE: A sequence of the DAG only runs as its own node, once
+                    #       its DEPENDS have passed
+                    if sequence in dep_dict:
+                        print("{}{}: SEQUENCE {} is run by the DAG, not switched to{}".format(RED, seq, sequence, NON), file=self.tmux.stdout)
+                        result = 'SEQUENCE {}'.format(sequence)
+                        break
+            except SystemExit as e:
+                result = e.code
+            except Exception as e:
+                print("{}{}: {}{}".format(RED, seq, e, NON), file=self.tmux.stdout)
+                result = e
+            finally:
+                pm.trigger('OFF')
+                pm.tmux.flush()
+            return result, node_start - start, time.time() - node_start
+
+        result_dict = {}
+        pending_list = list(dep_dict)
+        future_dict = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            while pending_list or future_dict:
+                for seq in list(pending_list):
+                    failed_list = [ dep for dep in dep_dict[seq] if dep in result_dict and result_dict[dep][0] ]
+                    if failed_list:
+                        # Skipped, which also skips the sequences that depend on it
+                        pending_list.remove(seq)
+                        result_dict[seq] = ('{} failed'.format(failed_list[0]), None, 0)
+                    elif all(dep in result_dict for dep in dep_dict[seq]):
+                        pending_list.remove(seq)
+                        if self.is_debug:
+                            print("{}Starting {}{}".format(GRN, seq, NON), file=self.tmux.stdout)
+                        future_dict[executor.submit(run_node, seq)] = seq
+                if not future_dict:
+                    continue
+                done_set, _ = concurrent.futures.wait(future_dict, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done_set:
+                    result_dict[future_dict.pop(future)] = future.result()
+        # The critical path is the chain of dependencies that took the longest
+        finish_dict = {}
+        prev_dict = {}
+        for seq, dep_list in dep_dict.items():
+            prev_dict[seq] = max(dep_list, key=finish_dict.get) if dep_list else None
+            finish_dict[seq] = result_dict[seq][2] + (finish_dict[prev_dict[seq]] if prev_dict[seq] else 0)
+        path_list = [ max(finish_dict, key=finish_dict.get) ]
+        while prev_dict[path_list[0]]:
+            path_list.insert(0, prev_dict[path_list[0]])
+        # Report the results per sequence
+        fail_cnt = 0
+        width = max(len(seq) for seq in list(dep_dict) + ['SEQUENCE'])
+        print("\n{:<{}}  {:<6}  {:>8}  {:>8}".format('SEQUENCE', width, 'RESULT', 'START', 'TIME'), file=self.tmux.stdout)
+        for seq in dep_dict:
+            result, node_start, elapsed = result_dict[seq]
+            if node_start is None:
+                fail_cnt += 1
+                print("{:<{}}  {}SKIP{}    {:>8}  {:>8}  ({})".format(seq, width, YEL, NON, '-', '-', result), file=self.tmux.stdout)
+                continue
+            if result:
+                fail_cnt += 1
+                status = "{}FAIL{}  ".format(RED, NON)
+            else:
+                status = "{}PASS{}  ".format(GRN, NON)
+            print("{:<{}}  {}  {:>7.2f}s  {:>7.2f}s{}".format(seq, width, status, node_start, elapsed, "  ({})".format(result) if result else ""), file=self.tmux.stdout)
+        total = sum(elapsed for result, node_start, elapsed in result_dict.values())
+        print("Critical path: {} ({:.2f}s)".format(' -> '.join(path_list), finish_dict[path_list[-1]]), file=self.tmux.stdout)
+        print("{} of {} sequences passed in {:.2f}s ({:.2f}s one at a time)".format(len(dep_dict) - fail_cnt, len(dep_dict), time.time() - start, total), file=self.tmux.stdout)
+        return fail_cnt
+
+    async def _run_lane(self, cmd_queue, title):
+        """
+        Task that runs the commands of one pane in order
+
+        :param      cmd_queue:  The pane's command queue
+        :type       cmd_queue:  asyncio.Queue
+        :param      title:      The sequence title
+        :type       title:      str
+        """
+        while True:
+            cmd_dict = await cmd_queue.get()
+            try:
+                await asyncio.to_thread(self._run_cmd, cmd_dict, title)
+            finally:
+                cmd_queue.task_done()
+
+    async def _run_lanes(self, cmds_list, title):
+        """
+        Runs the commands with a task and command queue per pane.  Commands of
+        a pane run in order, while the panes run concurrently until a BARRIER or
+        a keyword that affects the whole sequence (e.g. DECIDE, SEQUENCE), which
+        is run after all of the panes are joined.
+
+        :param      cmds_list:  The CMDS list
+        :type       cmds_list:  list(dict)
+        :param      title:      The sequence title
+        :type       title:      str
+
+        :returns:   Next sequence if selected
+        :rtype:     str
+        """
+        lane_dict = {}
+        pane = self.tmux.pane_last
+
+        async def join():
+            for cmd_queue, pm, task in lane_dict.values():
+                # Wait for the pane's commands to complete or fail
+                done_task = asyncio.ensure_future(cmd_queue.join())
+                await asyncio.wait([done_task, task], return_when=asyncio.FIRST_COMPLETED)
+                done_task.cancel()
+                if task.done():
+                    task.result()
+            # Continue from the last selected pane, then stop the pane tasks
+            if pane in lane_dict:
+                self.tmux.pane_last = lane_dict[pane][1].tmux.pane_last
+            for cmd_queue, pm, task in lane_dict.values():
+                task.cancel()
+            lane_dict.clear()
+
+        try:
             for cmd_dict in cmds_list:
-                # Report unknown commands
-                unknown_cmds = list(set(cmd_dict) - set(self.key_func_dict.keys()))
-                if unknown_cmds:
-                    print('Warning: Unknown commands {} in sequence "{}"'.format(unknown_cmds, title))
-                # Process the pane commands by the order of key_func_dict.
-                for key in self.key_func_dict.keys():
-                    if key in cmd_dict:
-                        if self.is_interactive:
-                            input("{}  >>> 'Enter' to run[{}]: {} <<<{}".format(YEL, key, cmd_dict[key], NON))
-                        try:
-                            self.key_func_dict[key](cmd_dict[key])
-                        except PetMux.SequenceException as e:
-                            # A new sequence is request, switch to it.
-                            print("{}Switching sequence to {}{}".format(GRN, e.sequence, NON))
-                            return e.sequence
+                if any(key in cmd_dict for key in self.serial_key_list):
+                    await join()
+                    if self.tmux.loop:
+                        # Under run_async, e.g. PROMPT awaits an async on_prompt
+                        next_sequence = await self._run_cmd_async(cmd_dict, title)
+                    else:
+                        # Off the loop, as the lanes' commands are
+                        next_sequence = await asyncio.to_thread(self._run_cmd, cmd_dict, title)
+                    if next_sequence:
+                        return next_sequence
+                    pane = self.tmux.pane_last
+                    continue
+                pane = cmd_dict.get('PANE', pane)
+                if pane not in lane_dict:
+                    pm = self._fork(pane)
+                    cmd_queue = asyncio.Queue()
+                    lane_dict[pane] = (cmd_queue, pm, asyncio.create_task(pm._run_lane(cmd_queue, title)))
+                lane_dict[pane][0].put_nowait(cmd_dict)
+            await join()
+        finally:
+            for lane in lane_dict.values():
+                lane[2].cancel()
         return None
 
 
-def main(args):
-    # Process the command line arguments
+class Daemon:
+    """
+    This class keeps the compiled plans, variables and tmux control mode
+    connections in memory and runs the requests of the petmux client received
+    on a Unix socket.  Each request is a JSON line with the command line
+    arguments, and the output is streamed back as JSON lines.
+    """
+
+    class Stream:
+        """
+        File like object that forwards the output of a request to the client
+        and reads the user's input from the client
+        """
+        def __init__(self, file):
+            """
+            Constructs a new stream
+
+            :param      file:  The client connection file
+            :type       file:  file
+            """
+            self.file = file
+
+        def send(self, msg):
+            """
+            Sends a message to the client
+
+            :param      msg:  The message
+            :type       msg:  dict
+            """
+            self.file.write((json.dumps(msg) + '\n').encode('utf-8'))
+            self.file.flush()
+
+        def write(self, text):
+            self.send({'out': text})
+            return len(text)
+
+        def flush(self):
+            pass
+
+        def readline(self):
+            self.send({'in': True})
+            reply = json.loads(self.file.readline() or '{}')
+            return reply.get('in', '')
+
+
+    def __init__(self, socket_path=None):
+        """
+        Constructs a new daemon
+
+        :param      socket_path:  The Unix socket path
+        :type       socket_path:  str
+        """
+        self.socket_path = socket_path or Daemon.default_path()
+        # Plan and modified time by configuration file
+        self.plan_dict = {}
+        # PetMux instance by configuration file and options
+        self.pm_dict = {}
+
+    @staticmethod
+    def default_path():
+        """
+        Gets the default socket path, in $XDG_RUNTIME_DIR if set
+
+        :returns:   The socket path
+        :rtype:     str
+        """
+        runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+        if runtime_dir:
+            return os.path.join(runtime_dir, 'petmux.sock')
+        return os.path.join(tempfile.gettempdir(), 'petmux-{}.sock'.format(os.getuid()))
+
+    @staticmethod
+    def request(argv, socket_path=None):
+        """
+        Sends the command line arguments to the daemon and prints its output
+        until the request is done
+
+        :param      argv:         The command line arguments
+        :type       argv:         list(str)
+        :param      socket_path:  The Unix socket path
+        :type       socket_path:  str
+
+        :returns:   The exit code or None if there is no daemon
+        :rtype:     int
+        """
+        path = socket_path or Daemon.default_path()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            uid = Daemon._peer_uid(sock, path)
+        except OSError:
+            sock.close()
+            return None
+        # NOTE: The request carries the environment and the user's input, so
+        #       it is only sent to a daemon of the same user
+        if uid != os.getuid():
+            print("{}Warning: Ignoring the petmux daemon on {}, which is run by another user{}".format(RED, path, NON))
+            sock.close()
+            return None
+        with sock, sock.makefile('rwb') as file:
+            stream = Daemon.Stream(file)
+            env_dict = { key: os.environ[key] for key in ('TMUX', 'TMUX_PANE') if key in os.environ }
+            stream.send({'argv': argv, 'cwd': os.getcwd(), 'env': env_dict})
+            for line in file:
+                msg = json.loads(line)
+                if 'out' in msg:
+                    sys.stdout.write(msg['out'])
+                    sys.stdout.flush()
+                elif 'in' in msg:
+                    stream.send({'in': sys.stdin.readline()})
+                elif 'exit' in msg:
+                    return msg['exit']
+        print("{}Lost connection to the petmux daemon{}".format(RED, NON))
+        return 1
+
+    @staticmethod
+    def _peer_uid(sock, path):
+        """
+        Gets the user of the daemon from the credentials of the connection, or
+        from the owner of the socket where they aren't supported
+
+        :param      sock:  The connected socket
+        :type       sock:  socket.socket
+        :param      path:  The Unix socket path
+        :type       path:  str
+
+        :returns:   The user id
+        :rtype:     int
+        """
+        if hasattr(socket, 'SO_PEERCRED'):
+            cred = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+            return struct.unpack('3i', cred)[1]
+        return os.stat(path).st_uid
+
+    def _plan(self, file_name, use_cache, stream):
+        """
+        Gets the plan of a configuration file, which is only reloaded when the
+        file's modified time changes
+
+        :param      file_name:  The configuration file
+        :type       file_name:  str
+        :param      use_cache:  Indicates if the plan cache is used
+        :type       use_cache:  boolean
+        :param      stream:     The client's stream
+        :type       stream:     Daemon.Stream
+
+        :returns:   The plan or None if the configuration is empty
+        :rtype:     Plan
+        """
+        mtime = os.stat(file_name).st_mtime_ns
+        if file_name in self.plan_dict and self.plan_dict[file_name][0] == mtime:
+            return self.plan_dict[file_name][1]
+        print("Loading {}".format(file_name), file=stream)
+        # The configuration changed, so its PetMux instances are stale
+        for key in [ key for key in self.pm_dict if key[0] == file_name ]:
+            self.pm_dict.pop(key).tmux.close()
+        plan = Plan.load(file_name, use_cache)
+        self.plan_dict[file_name] = (mtime, plan)
+        return plan
+
+    def _petmux(self, args, cwd, env, stream):
+        """
+        Gets the PetMux instance for the configuration file and options, which
+        keeps its variables and tmux connection between requests, set up for
+        the client's directory, environment and stream
+
+        :param      args:    The command line arguments
+        :type       args:    argparse.Namespace
+        :param      cwd:     The client's working directory
+        :type       cwd:     str
+        :param      env:     The client's environment
+        :type       env:     dict
+        :param      stream:  The client's stream
+        :type       stream:  Daemon.Stream
+
+        :returns:   The PetMux instance or None if the configuration is empty
+        :rtype:     PetMux
+        """
+        file_name = os.path.join(cwd, args.file)
+        plan = self._plan(file_name, not args.no_cache, stream)
+        if not plan:
+            return None
+        key = (file_name, args.session, args.socket, args.quiet, args.dryrun, args.control, args.batch, args.parallel, args.reconcile)
+        if key in self.pm_dict:
+            self.pm_dict[key].tmux.set_client(cwd, env, stream, stream)
+        else:
+            # NOTE: With -C, the control mode connection stays open between requests
+            self.pm_dict[key] = PetMux(plan, args.session, is_debug=args.quiet == False, is_dryrun=args.dryrun, is_control=args.control, is_batch=args.batch,
+                                       is_parallel=args.parallel, socket=args.socket, is_reconcile=args.reconcile,
+                                       cwd=cwd, env=env, stdin=stream, stdout=stream)
+        return self.pm_dict[key]
+
+    def _run(self, argv, cwd, env, stream):
+        """
+        Runs the request's command line arguments
+
+        :param      argv:    The command line arguments
+        :type       argv:    list(str)
+        :param      cwd:     The client's working directory
+        :type       cwd:     str
+        :param      env:     The client's environment
+        :type       env:     dict
+        :param      stream:  The client's stream
+        :type       stream:  Daemon.Stream
+        """
+        parser = arg_parser()
+        # The usage, help and errors go to the client
+        parser._print_message = lambda message, file=None: stream.write(message or '')
+        args = parser.parse_args(argv)
+        pm = self._petmux(args, cwd, env, stream)
+        if not pm:
+            return
+        try:
+            if args.kill:
+                pm.kill()
+            if args.list:
+                pm.list(args.run)
+            elif args.run and args.dag:
+                if pm.run_dag(args.run.split(), args.jobs):
+                    sys.exit(1)
+            elif args.run:
+                for sequence in args.run.split():
+                    while sequence:
+                        sequence = pm.run(sequence)
+        finally:
+            # Triggers end with the request, as they do with the process
+            pm.trigger('OFF')
+            pm.tmux.flush()
+            pm.tmux.set_client()
+
+    def handle(self, conn):
+        """
+        Handles a client's request
+
+        :param      conn:  The client connection
+        :type       conn:  socket.socket
+        """
+        with conn, conn.makefile('rwb') as file:
+            stream = Daemon.Stream(file)
+            request = json.loads(file.readline() or '{}')
+            result = 0
+            # NOTE: The client's directory and tmux client (TMUX) are passed
+            #       to the PetMux, so the daemon's own are left as they are
+            env = { key: value for key, value in os.environ.items() if key not in ('TMUX', 'TMUX_PANE') }
+            env.update(request.get('env', {}))
+            try:
+                self._run(request.get('argv', []), os.path.abspath(request.get('cwd', '.')), env, stream)
+            except SystemExit as e:
+                result = e.code
+            except Exception as e:
+                stream.send({'out': "{}{}{}\n".format(RED, e, NON)})
+                result = 1
+            stream.send({'exit': result})
+
+    def serve(self):
+        """
+        Runs the requests until terminated
+        """
+        if os.path.exists(self.socket_path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                try:
+                    probe.connect(self.socket_path)
+                    print("{}petmux daemon already running on {}{}".format(RED, self.socket_path, NON))
+                    return 1
+                except OSError:
+                    # Left behind by a daemon that didn't exit cleanly
+                    os.unlink(self.socket_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            sock.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        sock.listen()
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        print("petmux daemon listening on {}".format(self.socket_path))
+        try:
+            while True:
+                conn, _ = sock.accept()
+                try:
+                    self.handle(conn)
+                except (OSError, ValueError) as e:
+                    print("{}Request failed: {}{}".format(RED, e, NON))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sock.close()
+            os.unlink(self.socket_path)
+            for pm in self.pm_dict.values():
+                pm.tmux.close()
+        return 0
+
+
+def fanout(config, target_list, sequence_list, args, tracer=None, timings=None, archive=None):
+    """
+    Runs the sequences against many sessions and tmux servers concurrently
+    with a PetMux instance per target.
+
+    :param      config:         The configuration
+    :type       config:         dict
+    :param      target_list:    The targets, e.g. session or session@socket
+    :type       target_list:    list(str)
+    :param      sequence_list:  The sequences to run
+    :type       sequence_list:  list(str)
+    :param      args:           The command line arguments
+    :type       args:           argparse.Namespace
+    :param      tracer:         The tracer that records the run, if any
+    :type       tracer:         Tracer
+    :param      timings:        The timings history, if any
+    :type       timings:        Timings
+    :param      archive:        The archive of the pane output, if any
+    :type       archive:        Archive
+
+    :returns:   The number of targets that failed
+    :rtype:     int
+    """
+    def run_target(target):
+        session, _, socket = target.partition('@')
+        start = time.time()
+        pm = None
+        try:
+            pm = PetMux(config, session, is_debug=args.quiet == False, is_dryrun=args.dryrun, is_control=args.control, is_batch=args.batch,
+                        is_parallel=args.parallel, socket=socket or args.socket, is_detached=True, tracer=tracer,
+                        is_reconcile=args.reconcile, timings=timings, archive=archive)
+            if args.kill:
+                pm.kill()
+            if args.dag:
+                result = pm.run_dag(sequence_list, args.jobs)
+                return result, time.time() - start
+            for sequence in sequence_list:
+                while sequence:
+                    sequence = pm.run(sequence)
+            result = 0
+        except SystemExit as e:
+            result = e.code
+        except Exception as e:
+            print("{}{}: {}{}".format(RED, target, e, NON))
+            result = e
+        finally:
+            if pm:
+                pm.tmux.close()
+        return result, time.time() - start
+
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        result_list = list(executor.map(run_target, target_list))
+    # Report the results per target
+    fail_cnt = 0
+    width = max(len(target) for target in target_list + ['TARGET'])
+    print("\n{:<{}}  {:<6}  {:>8}".format('TARGET', width, 'RESULT', 'TIME'))
+    for target, (result, elapsed) in zip(target_list, result_list):
+        if result:
+            fail_cnt += 1
+            status = "{}FAIL{}  ".format(RED, NON)
+        else:
+            status = "{}PASS{}  ".format(GRN, NON)
+        print("{:<{}}  {}  {:>7.2f}s{}".format(target, width, status, elapsed, "  ({})".format(result) if result else ""))
+    print("{} of {} targets passed in {:.2f}s".format(len(target_list) - fail_cnt, len(target_list), time.time() - start))
+    return fail_cnt
+
+
+def simulate(config, sequence_list, args):
+    """
+    Runs the sequences against a simulated tmux server (see SimTmux) and
+    reports the issues, the SEQUENCE cycles and the projected time
+
+    :param      config:         The configuration
+    :type       config:         Plan
+    :param      sequence_list:  The sequences to run, all if empty
+    :type       sequence_list:  list(str)
+    :param      args:           The command line arguments
+    :type       args:           argparse.Namespace
+
+    :returns:   The number of issues and SEQUENCE cycles that never end
+    :rtype:     int
+    """
+    pm = PetMux(config, args.session, is_debug=args.quiet == False, is_control=args.control, is_batch=args.batch,
+                is_reconcile=args.reconcile, is_simulated=True)
+    sim = pm.tmux
+    issue_list = pm.plan.check(pm.key_func_dict.keys()) + pm.plan.validate()
+    try:
+        if args.kill:
+            pm.kill()
+        for sequence in sequence_list or pm.plan._ordered():
+            run_list = []
+            while sequence:
+                if sequence not in pm.sequence_list:
+                    sim._issue("No sequence {}".format(sequence))
+                    break
+                if sequence in run_list:
+                    # The simulation runs the same way again
+                    print("{}Stopping the simulation at the cycle back to {}{}".format(YEL, sequence, NON))
+                    break
+                run_list.append(sequence)
+                sequence = pm.run(sequence)
+    except SystemExit as e:
+        print("{}Simulation aborted with {}{}".format(YEL, e.code, NON))
+    finally:
+        pm.tmux.close()
+    issue_list += sim.issue_list
+    cycle_list = pm.plan.cycles()
+    # Report the results
+    print("\nSimulated {} tmux commands".format(sim.cmd_cnt))
+    for issue in issue_list:
+        print("{}Issue: {}{}".format(RED, issue, NON))
+    for seq_list, is_endless in cycle_list:
+        if is_endless:
+            print("{}Cycle never ends: {}{}".format(RED, ' -> '.join(seq_list), NON))
+        else:
+            print("{}Cycle: {}{}".format(YEL, ', '.join(seq_list), NON))
+    print("Projected time {:.2f}s, up to {:.2f}s if every EXTRACT and WAIT_FOR times out".format(sim.clock, sim.clock + sim.wait_max))
+    return len(issue_list) + sum(1 for seq_list, is_endless in cycle_list if is_endless)
+
+
+def watch(pm, file_name, run_list, use_cache=True):
+    """
+    Applies each change of the configuration file to the sequences that were
+    run (see PetMux.update), until interrupted
+
+    :param      pm:         The petmux instance that ran the sequences
+    :type       pm:         PetMux
+    :param      file_name:  The configuration file
+    :type       file_name:  str
+    :param      run_list:   The sequences that were run
+    :type       run_list:   list(str)
+    :param      use_cache:  Indicates if the plan cache is used
+    :type       use_cache:  boolean
+    """
+    watcher = FileWatcher(file_name)
+    print("{}Watching {}{} (Ctrl-C to stop){}".format(GRN, file_name, '' if watcher.fd is not None else ' by polling', NON))
+    try:
+        while True:
+            watcher.wait()
+            start = time.time()
+            try:
+                plan = Plan.load(file_name, use_cache)
+            except Exception as e:
+                # NOTE: A bad edit is reported and the next change is waited for
+                print("{}Couldn't load {}: {}{}".format(RED, file_name, e, NON))
+                continue
+            if not plan:
+                continue
+            update_cnt = pm.update(plan, run_list)
+            if update_cnt:
+                print("{}Updated {} in {:.2f}s{}".format(GRN, update_cnt, time.time() - start, NON))
+            else:
+                print("{}No changes to apply{}".format(GRN, NON))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+def arg_parser():
+    """
+    Builds the command line argument parser
+
+    :returns:   The argument parser
+    :rtype:     argparse.ArgumentParser
+    """
     parser = argparse.ArgumentParser(description="PetMux: Programmed Executive TMUX")
     parser.add_argument('-r', '--run', action="store", help='Run sequence(s): --run <sequence|"sequence1 [sequence2 ..]">')
     parser.add_argument('-f', '--file', action="store", default='petmux.yaml', help="input configuration file: --file <your.petmux.config.file>.<yaml|json>>")
     parser.add_argument('-s', '--session', action="store", default=None, help="Specify tmux session: --session <your.session.name>")
     parser.add_argument('-k', '--kill', action="store_true", help="Kill the windows")
     parser.add_argument('-l', '--list', action="store_true", help="List available sequences")
+    parser.add_argument('-C', '--control', action="store_true", help="Send tmux commands over a persistent control mode connection")
+    parser.add_argument('-b', '--batch', action="store_true", help="Batch tmux commands that don't need a result")
+    parser.add_argument('-p', '--parallel', action="store_true", help="Run the CMDS of each pane concurrently until a BARRIER")
+    parser.add_argument('-L', '--socket', action="store", default=None, help="Specify tmux server socket: --socket <name|path>")
+    parser.add_argument('--reconcile', action="store_true", help="Only create or kill the windows and panes that differ from the live state")
+    parser.add_argument('-D', '--dag', action="store_true", help="Run the sequences concurrently in the order of their DEPENDS and PROVIDES")
+    parser.add_argument('-w', '--watch', action="store_true", help="Watch the configuration file and update only the changed windows, panes and sequences")
+    group_fanout = parser.add_argument_group('Fanout')
+    group_fanout.add_argument('-F', '--fanout', action="store", default=None, help='Run against many targets concurrently: --fanout "session[@socket] [session[@socket] ..]"')
+    group_fanout.add_argument('-j', '--jobs', action="store", type=int, default=8, help="Maximum concurrent targets, or sequences with --dag: --jobs <number>")
     group_debug = parser.add_argument_group('Debug')
     group_debug.add_argument('-q', '--quiet', action="store_true", help="Supress debug output")
     group_debug.add_argument('-d', '--dryrun', action="store_true", help="Dry run. Print shell commands instead of executing")
+    group_debug.add_argument('--simulate', action="store_true", help="Run against a simulated tmux server, report the issues and projected time")
     group_debug.add_argument('-i', '--interactive', action="store_true", help="Interactively step through the sequence")
+    group_debug.add_argument('--no-cache', action="store_true", help="Don't use the compiled configuration cache")
+    group_debug.add_argument('-t', '--trace', action="store", default=None, help="Record a Chrome trace (Perfetto) of the run and summarize the time spent: --trace <trace.json>")
+    group_timings = parser.add_argument_group('Timings')
+    group_timings.add_argument('--record', action="store_true", help="Record how long EXTRACT, WAIT_FOR and PAUSE take in the timings history")
+    group_timings.add_argument('--adaptive', action="store_true", help="Wait the times learned from the timings history for EXTRACT and PAUSE")
+    group_timings.add_argument('--history', action="store", default=None, help="Specify the timings history file: --history <history.json>")
+    group_archive = parser.add_argument_group('Archive')
+    group_archive.add_argument('--archive', action="store", nargs='?', const='', default=None, help="Add the CAPTURE, LOG and ARCHIVE pane output to a searchable archive: --archive [<archive.db>]")
+    group_archive.add_argument('--search', action="store", default=None, help="Search the archive: --search <query>")
+    group_daemon = parser.add_argument_group('Daemon')
+    group_daemon.add_argument('--daemon', action="store_true", help="Run as a daemon that keeps the configurations and tmux connections loaded")
+    group_daemon.add_argument('--daemon-socket', action="store", default=None, help="Specify the daemon socket: --daemon-socket <path>")
+    group_daemon.add_argument('--no-daemon', action="store_true", help="Don't send the request to a running daemon")
+    return parser
 
+
+def main(argv):
+    # Process the command line arguments
+    parser = arg_parser()
     # parser.add_argument('sequence', action='store', default="test", help='Run sequence')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+
+    if args.daemon:
+        sys.exit(Daemon(args.daemon_socket).serve())
+    if args.search:
+        archive = Archive(args.archive or Archive.default_file())
+        try:
+            row_list = archive.search(args.search)
+        except sqlite3.OperationalError as e:
+            print("{}Bad search {}: {}{}".format(RED, args.search, e, NON))
+            sys.exit(1)
+        for row in row_list:
+            stamp = datetime.datetime.fromtimestamp(row['time']).strftime('%Y-%m-%d %H:%M:%S')
+            print("{}#{} {} {}:{}.{} [{}]{} {}".format(CYN, row['run'], stamp, row['session'], row['window'], row['pane'], row['sequence'], NON, row['text']))
+        if not row_list:
+            print("{}No matches{}".format(YEL, NON))
+        sys.exit(0)
+    # Forward the request to a running daemon, unless it needs this process
+    if (args.run or args.list) and not (args.no_daemon or args.fanout or args.trace or args.interactive or args.record or args.adaptive or args.simulate or args.archive is not None or args.watch):
+        result = Daemon.request(argv, args.daemon_socket)
+        if result is not None:
+            sys.exit(result)
 
-    if args.run or args.list:
+    if args.simulate:
+        config = Plan.load(args.file, not args.no_cache)
+        if config and simulate(config, args.run.split() if args.run else [], args):
+            sys.exit(1)
+    elif args.run or args.list:
         # Load the configuration file
-        with open(args.file, 'r') as file:
-            ext = os.path.splitext(args.file)[1]
-            if  ext == '.yaml' or ext == '.yml':
-                config = yaml.load(file, Loader=yaml.FullLoader)
-            elif ext == '.json':
-                config = json.load(file)
-
-            if config:
-                # Create PetMux object
-                pm = PetMux(config, args.session, args.quiet == False, args.dryrun, args.interactive)
-                # Use the petmux object
+        config = Plan.load(args.file, not args.no_cache)
+        tracer = Tracer(args.trace) if args.trace and args.run else None
+        timings = None
+        if (args.record or args.adaptive) and args.run:
+            timings = Timings(args.history or Timings.default_file(args.file), args.record, args.adaptive)
+        archive = None
+        if config and args.archive is not None and args.run:
+            archive = Archive(args.archive or Archive.default_file())
+            archive.start(args.file, argv)
+        if config and args.fanout and args.run:
+            fail_cnt = fanout(config, args.fanout.split(), args.run.split(), args, tracer, timings, archive)
+            if tracer:
+                tracer.write()
+                tracer.summary()
+            if timings:
+                timings.save()
+            if archive:
+                archive.close()
+            if fail_cnt:
+                sys.exit(1)
+        elif config:
+            # Create PetMux object
+            pm = PetMux(config, args.session, is_debug=args.quiet == False, is_dryrun=args.dryrun, is_interactive=args.interactive,
+                        is_control=args.control, is_batch=args.batch, is_parallel=args.parallel, socket=args.socket,
+                        tracer=tracer, is_reconcile=args.reconcile, timings=timings, archive=archive)
+            # Use the petmux object
+            fail_cnt = 0
+            try:
                 if args.kill:
                     pm.kill()
                 if args.list:
                     pm.list(args.run)
+                elif args.run and args.dag:
+                    fail_cnt = pm.run_dag(args.run.split(), args.jobs)
                 elif args.run:
                     for sequence in args.run.split():
                         while sequence:
                             sequence = pm.run(sequence)
+                if args.watch and args.run:
+                    watch(pm, args.file, args.run.split(), not args.no_cache)
+            finally:
+                pm.tmux.close()
+                if tracer:
+                    tracer.write()
+                    tracer.summary()
+                if timings:
+                    timings.save()
+                if archive:
+                    archive.close()
+            if fail_cnt:
+                sys.exit(1)
     else:
         parser.print_usage()
 
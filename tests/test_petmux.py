@@ -0,0 +1,150 @@
+"""
+Tests of petmux against the fake tmux of the benchmarks (bench/tmux), so they
+don't need a tmux server
+"""
+import sys
+import os
+import asyncio
+import json
+import socket
+import threading
+
+import pytest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TEST_DIR, '..', 'src'))
+import petmux
+
+
+@pytest.fixture
+def stub(monkeypatch, tmp_path):
+    """
+    Puts the fake tmux first on the PATH, logging to a temporary file
+    """
+    monkeypatch.setenv('PATH', os.path.join(TEST_DIR, '..', 'bench') + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('PETMUX_STUB_LOG', str(tmp_path / 'stub.log'))
+    monkeypatch.delenv('TMUX', raising=False)
+
+
+def run_thread(func, timeout=10):
+    """
+    Runs a function on a thread, so a hang fails the test instead of the run
+
+    :returns:   The result of the function
+    """
+    result_list = []
+    thread = threading.Thread(target=lambda: result_list.append(func()), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), 'hung'
+    return result_list[0]
+
+
+def test_parallel_prompt_async(stub):
+    config = {
+        'setup': {
+            'NEW_WINDOW': 'w',
+            'NEW_PANES': [{'a': {'SHELL': 'true'}}, {'b': {'SHELL': 'true'}}],
+        },
+        'test': {
+            'WINDOW': 'w',
+            'CMDS': [
+                {'PANE': 'a', 'SHELL': 'true'},
+                {'PANE': 'b', 'SHELL': 'true'},
+                {'PROMPT': ['Name? ', 'NAME']},
+                {'PANE': 'a', 'SHELL': 'echo ${NAME}'},
+            ],
+        },
+    }
+
+    async def on_prompt(prompt):
+        await asyncio.sleep(0)
+        return 'bob'
+
+    pm = petmux.PetMux(config, 'test', is_debug=False, is_parallel=True, is_detached=True, on_prompt=on_prompt)
+    assert run_thread(lambda: asyncio.run(pm.run_async('setup'))) is None
+    assert run_thread(lambda: asyncio.run(pm.run_async('test'))) is None
+    assert pm.tmux.get_env()['NAME'] == 'bob'
+
+
+def test_plan_cache_unreadable(monkeypatch, tmp_path):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    config_file = tmp_path / 'config.json'
+    config_file.write_text('{"test": {"CMDS": [{"SHELL": "true"}]}}')
+    assert isinstance(petmux.Plan.load(str(config_file)), petmux.Plan)
+    cache_list = list((tmp_path / 'cache' / 'petmux').iterdir())
+    assert len(cache_list) == 1
+    # A plan pickled by another petmux fails to unpickle, so it is compiled again
+    cache_list[0].write_bytes(b'\x80\x04garbage')
+    assert isinstance(petmux.Plan.load(str(config_file)), petmux.Plan)
+
+
+def test_run_dag_empty(stub, capsys):
+    pm = petmux.PetMux({'test': {'CMDS': [{'SHELL': 'true'}]}}, '', is_debug=False, is_detached=True)
+    assert pm.run_dag([]) == 0
+    assert 'No sequences to run' in capsys.readouterr().out
+
+
+def test_pane_logger_rotates_bytes(tmp_path):
+    log_file = tmp_path / 'pane.log'
+    logger = petmux.PaneLogger(str(log_file), max_size=100, compress=None, is_timestamp=False)
+    # 41 characters, but 121 bytes in UTF-8
+    logger.write('€'.encode('utf-8') * 40 + b'\n')
+    logger.write(b'x\n')
+    logger.close()
+    assert (tmp_path / 'pane.log.1').read_bytes() == '€'.encode('utf-8') * 40 + b'\n'
+    assert log_file.read_bytes() == b'x\n'
+
+
+def test_daemon_request(stub, tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    config = {
+        'setup': {'NEW_WINDOW': 'w', 'NEW_PANES': [{'a': {'SHELL': 'true'}}]},
+        'test': {'WINDOW': 'w', 'CMDS': [{'PROMPT': ['Name? ', 'NAME']}, {'PANE': 'a', 'SHELL': 'echo ${NAME}'}]},
+    }
+    (tmp_path / 'config.json').write_text(json.dumps(config))
+    cwd = os.getcwd()
+    daemon = petmux.Daemon(str(tmp_path / 'petmux.sock'))
+    server, client = socket.socketpair()
+    thread = threading.Thread(target=daemon.handle, args=(server,), daemon=True)
+    thread.start()
+    out_list = []
+    with client, client.makefile('rwb') as file:
+        stream = petmux.Daemon.Stream(file)
+        stream.send({'argv': ['-f', 'config.json', '-r', 'setup test'], 'cwd': str(tmp_path), 'env': {'TMUX': '/tmp/x,1,0'}})
+        for line in file:
+            msg = json.loads(line)
+            if 'out' in msg:
+                out_list.append(msg['out'])
+            elif 'in' in msg:
+                stream.send({'in': 'bob\n'})
+            elif 'exit' in msg:
+                break
+    thread.join(10)
+    assert msg == {"exit": 0}, "".join(out_list)
+    # The request's directory, environment and streams are the PetMux's own
+    assert os.getcwd() == cwd
+    assert 'TMUX' not in os.environ
+    assert 'Name? ' in ''.join(out_list)
+    pm, = daemon.pm_dict.values()
+    assert not pm.tmux.is_control
+    assert pm.tmux.get_env()['NAME'] == 'bob'
+    assert 'echo bob' in (tmp_path / 'stub.log').read_text()
+
+
+def test_parallel_prompt_off_loop(stub):
+    config = {
+        'setup': {'NEW_WINDOW': 'w', 'NEW_PANES': [{'a': {'SHELL': 'true'}}, {'b': {'SHELL': 'true'}}]},
+        'test': {'WINDOW': 'w', 'CMDS': [{'PANE': 'a', 'SHELL': 'true'}, {'PROMPT': ['Name? ', 'NAME']}]},
+    }
+    thread_list = []
+
+    def on_prompt(prompt):
+        thread_list.append(threading.current_thread())
+        return 'bob'
+
+    pm = petmux.PetMux(config, 'test', is_debug=False, is_parallel=True, is_detached=True, on_prompt=on_prompt)
+    pm.run('setup')
+    pm.run('test')
+    # The serial steps don't block the loop, which runs on this thread
+    assert thread_list and thread_list[0] is not threading.current_thread()